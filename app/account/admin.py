@@ -1,10 +1,28 @@
 from django.contrib.admin import ModelAdmin, register
 from django.contrib.auth import get_user_model
 
+from .models import OutgoingEmail
+
 
 User = get_user_model()
 
 
+@register(OutgoingEmail)
+class OutgoingEmailAdmin(ModelAdmin):
+    list_display = (
+        "to",
+        "subject",
+        "status",
+        "attempts",
+        "next_attempt_at",
+        "sent_at",
+        "created_at",
+    )
+    list_filter = ("status",)
+    readonly_fields = ("created_at", "sent_at")
+    search_fields = ("to", "subject")
+
+
 @register(User)
 class UserAdmin(ModelAdmin):
     list_display = (
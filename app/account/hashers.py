@@ -0,0 +1,104 @@
+"""
+Password hashing on a small bounded thread pool.
+
+PBKDF2 keeps a core busy for hundreds of milliseconds per call, so a burst of
+logins or registrations hashed on request threads can take every core the
+process has and starve the event loop serving websockets. Here every hash runs
+in one of PASSWORD_HASHING_WORKERS threads (hashlib releases the GIL), so at
+most that many cores hash at once. Up to PASSWORD_HASHING_QUEUE_SIZE more
+callers wait for a thread; anyone past that gets HasherSaturated, a 503,
+straight away instead of queueing behind them.
+
+Hashing is called deep inside Django's sync authentication code, so the
+request that needs a hash waits for it on its own thread; under ASGI every
+request's sync code runs in its own thread-sensitive context, so other
+requests carry on, and hash in parallel up to PASSWORD_HASHING_WORKERS.
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from rest_framework.exceptions import APIException
+from rest_framework.status import HTTP_503_SERVICE_UNAVAILABLE
+from time import perf_counter
+from typing import Callable, Optional, Tuple, TypeVar
+
+from api.metrics import (
+    PASSWORD_HASHING_REJECTED,
+    PASSWORD_HASHING_SECONDS,
+    PASSWORD_HASHING_WAIT_SECONDS,
+    PASSWORD_HASHING_WAITING,
+)
+
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_pool: Optional[Tuple[ThreadPoolExecutor, threading.BoundedSemaphore]] = None
+
+
+class HasherSaturated(APIException):
+    default_code = "hasher_saturated"
+    default_detail = "Too many password checks in progress, try again shortly."
+    status_code = HTTP_503_SERVICE_UNAVAILABLE
+
+
+def get_pool() -> Tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+    """Returns the executor and the semaphore bounding its running and queued calls."""
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            workers = settings.PASSWORD_HASHING_WORKERS
+            _pool = (
+                ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hasher"),
+                threading.BoundedSemaphore(
+                    workers + settings.PASSWORD_HASHING_QUEUE_SIZE
+                ),
+            )
+
+    return _pool
+
+
+def run_hasher(func: Callable[..., T], *args) -> T:
+    executor, slots = get_pool()
+
+    if not slots.acquire(blocking=False):
+        PASSWORD_HASHING_REJECTED.inc()
+        raise HasherSaturated()
+
+    queued_at = perf_counter()
+    PASSWORD_HASHING_WAITING.inc()
+
+    def run() -> T:
+        started_at = perf_counter()
+        PASSWORD_HASHING_WAITING.dec()
+        PASSWORD_HASHING_WAIT_SECONDS.observe(started_at - queued_at)
+
+        try:
+            return func(*args)
+        finally:
+            PASSWORD_HASHING_SECONDS.observe(perf_counter() - started_at)
+
+    try:
+        return executor.submit(run).result()
+    finally:
+        slots.release()
+
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    Django's PBKDF2 hasher with the work done on the hashing pool. Hashes are
+    interchangeable with Django's, and changing PASSWORD_HASHING_ITERATIONS
+    rehashes each password at its user's next login.
+    """
+
+    @property
+    def iterations(self) -> int:
+        return settings.PASSWORD_HASHING_ITERATIONS
+
+    # verify() and harden_runtime() both hash through encode()
+    def encode(self, password: str, salt: str, iterations: Optional[int] = None):
+        return run_hasher(super().encode, password, salt, iterations)
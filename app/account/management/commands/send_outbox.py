@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from time import sleep
+
+from account.outbox import claim_batch, send_batch
+
+
+class Command(BaseCommand):
+    help = "Sends queued emails from the outbox, retrying failures with backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            default=settings.OUTBOX_BATCH_SIZE,
+            help="Emails claimed per batch.",
+            type=int,
+        )
+        parser.add_argument(
+            "--concurrency",
+            default=settings.OUTBOX_CONCURRENCY,
+            help="Connections sending at the same time.",
+            type=int,
+        )
+        parser.add_argument(
+            "--interval",
+            default=settings.OUTBOX_POLL_INTERVAL,
+            help="Seconds to wait when the outbox has nothing due.",
+            type=float,
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once nothing is due instead of polling.",
+        )
+
+    def handle(self, *args, **options):
+        concurrency = max(options["concurrency"], 1)
+
+        try:
+            while True:
+                emails = claim_batch(options["batch_size"])
+
+                if emails:
+                    sent, failed = send_batch(emails, concurrency)
+                    self.stdout.write(f"Sent {sent} emails, {failed} failed.")
+                    continue
+
+                if options["once"]:
+                    return
+
+                sleep(options["interval"])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped.")
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-19 12:43
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('body', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('from_email', models.CharField(max_length=255)),
+                ('html_body', models.TextField(blank=True, default='')),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('failed', 'Failed'), ('pending', 'Pending'), ('sent', 'Sent')], default='pending', max_length=10)),
+                ('subject', models.CharField(max_length=255)),
+                ('to', models.EmailField(max_length=254)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='account_out_status_8ae43e_idx')],
+            },
+        ),
+    ]
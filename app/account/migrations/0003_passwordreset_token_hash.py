@@ -0,0 +1,55 @@
+# Generated by Django 5.0.6 on 2026-10-19 13:05
+
+from django.db import migrations, models
+from hashlib import sha256
+
+
+BATCH_SIZE = 1000
+
+
+def hash_tokens(apps, schema_editor):
+    PasswordReset = apps.get_model('account', 'PasswordReset')
+    batch = []
+
+    for reset in PasswordReset.objects.only('id', 'token').iterator(
+        chunk_size=BATCH_SIZE
+    ):
+        reset.token_hash = sha256(reset.token.encode()).hexdigest()
+        batch.append(reset)
+
+        if len(batch) == BATCH_SIZE:
+            PasswordReset.objects.bulk_update(batch, ['token_hash'])
+            batch = []
+
+    PasswordReset.objects.bulk_update(batch, ['token_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0002_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='passwordreset',
+            name='token_hash',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_tokens, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='passwordreset',
+            name='token',
+        ),
+        migrations.AlterField(
+            model_name='passwordreset',
+            name='token_hash',
+            field=models.CharField(db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='passwordreset',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-19 18:40
+
+from django.db import migrations
+
+
+def clear_bodies(apps, schema_editor):
+    OutgoingEmail = apps.get_model('account', 'OutgoingEmail')
+    OutgoingEmail.objects.filter(status__in=('failed', 'sent')).update(
+        body='', html_body=''
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0003_passwordreset_token_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_bodies, migrations.RunPython.noop),
+    ]
@@ -3,17 +3,116 @@ from django.contrib.auth.models import (
     PermissionsMixin,
     UserManager as DjangoUserManager,
 )
-from django.db.models import BooleanField, CharField, DateTimeField, EmailField, Model
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db.models import (
+    BooleanField,
+    CharField,
+    DateTimeField,
+    EmailField,
+    Index,
+    Model,
+    PositiveSmallIntegerField,
+    QuerySet,
+    TextField,
+)
+from django.utils import timezone
+from hashlib import sha256
 
 
-class PasswordReset(Model):
+class OutgoingEmail(Model):
+    """
+    An email waiting in the outbox for the send_outbox command. Claiming a
+    batch pushes next_attempt_at forward as a lease, so a sender that dies
+    mid-batch only delays those emails. Bodies can carry secrets such as
+    password reset links, so they are cleared once the email is sent or
+    given up on.
+    """
+
+    FAILED = "failed"
+    PENDING = "pending"
+    SENT = "sent"
+
+    attempts = PositiveSmallIntegerField(default=0)
+    body = TextField(blank=True, default="")
     created_at = DateTimeField(auto_now_add=True)
+    from_email = CharField(max_length=255)
+    html_body = TextField(blank=True, default="")
+    last_error = TextField(blank=True, default="")
+    next_attempt_at = DateTimeField(default=timezone.now)
+    sent_at = DateTimeField(blank=True, null=True)
+    status = CharField(
+        choices=((FAILED, "Failed"), (PENDING, "Pending"), (SENT, "Sent")),
+        default=PENDING,
+        max_length=10,
+    )
+    subject = CharField(max_length=255)
+    to = EmailField()
+
+    class Meta:
+        indexes = (Index(fields=("status", "next_attempt_at")),)
+
+    def __str__(self):
+        return f"OutgoingEmail(id={self.id}, to='{self.to}', status='{self.status}')"
+
+    def clear_body(self) -> None:
+        self.body = ""
+        self.html_body = ""
+
+    def to_message(self, connection=None) -> EmailMultiAlternatives:
+        message = EmailMultiAlternatives(
+            body=self.body,
+            connection=connection,
+            from_email=self.from_email,
+            subject=self.subject,
+            to=(self.to,),
+        )
+
+        if self.html_body:
+            message.attach_alternative(self.html_body, "text/html")
+
+        return message
+
+
+def hash_token(token: str) -> str:
+    return sha256(token.encode()).hexdigest()
+
+
+class PasswordResetQuerySet(QuerySet):
+    def get_expiry_cutoff(self):
+        return timezone.now() - timedelta(seconds=settings.PASSWORD_RESET_TIMEOUT)
+
+    def active(self) -> "PasswordResetQuerySet":
+        return self.filter(created_at__gte=self.get_expiry_cutoff())
+
+    def expired(self) -> "PasswordResetQuerySet":
+        return self.filter(created_at__lt=self.get_expiry_cutoff())
+
+    def for_token(self, token: str) -> "PasswordResetQuerySet":
+        """Unexpired resets for the token, found through the token_hash index."""
+        return self.active().filter(token_hash=hash_token(token))
+
+
+class PasswordReset(Model):
+    """
+    Only a hash of the token is stored, so the table is useless to whoever
+    reads it. Resets older than PASSWORD_RESET_TIMEOUT are ignored and removed
+    by the purge_password_resets command.
+    """
+
+    objects = PasswordResetQuerySet.as_manager()
+
+    created_at = DateTimeField(auto_now_add=True, db_index=True)
     email = EmailField()
-    token = CharField(max_length=100)
+    token_hash = CharField(db_index=True, max_length=64)
 
     def __str__(self):
         return f"PasswordReset(id={self.id}, email='{self.email}')"
 
+    def set_token(self, token: str) -> None:
+        self.token_hash = hash_token(token)
+
 
 class UserManager(DjangoUserManager):
     def _create_user(self, email, password, username, **extra_fields):
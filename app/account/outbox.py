@@ -0,0 +1,174 @@
+"""
+Database-backed email outbox.
+
+Requests only enqueue OutgoingEmail rows; the send_outbox command claims
+due rows in batches, sends them from a bounded thread pool and retries
+failures with jittered exponential backoff until OUTBOX_MAX_ATTEMPTS.
+"""
+
+import logging
+import random
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.utils import timezone
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+from api.metrics import OUTBOX_EMAILS, OUTBOX_SEND_SECONDS
+from .models import OutgoingEmail
+
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_email(
+    to: str, subject: str, body: str = "", html_body: str = ""
+) -> OutgoingEmail:
+    return OutgoingEmail.objects.create(
+        body=body,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        html_body=html_body,
+        subject=subject,
+        to=to,
+    )
+
+
+def get_retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter, so failed batches don't retry in step."""
+    delay = min(
+        settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1),
+        settings.OUTBOX_RETRY_MAX_SECONDS,
+    )
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim_batch(size: int) -> List[OutgoingEmail]:
+    """
+    Leases up to size due emails to this sender. skip_locked lets several
+    senders claim disjoint batches concurrently.
+    """
+    now = timezone.now()
+
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(next_attempt_at__lte=now, status=OutgoingEmail.PENDING)
+            .order_by("next_attempt_at")[:size]
+        )
+        OutgoingEmail.objects.filter(id__in=[email.id for email in emails]).update(
+            next_attempt_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+        )
+
+    return emails
+
+
+def describe(exception: Exception) -> str:
+    return str(exception) or exception.__class__.__name__
+
+
+def send_chunk(emails: List[OutgoingEmail]) -> List[Optional[str]]:
+    """
+    Sends emails over one connection; returns an error or None for each. A
+    connection that can't be opened fails every email of the chunk, so they
+    back off like any other failure.
+    """
+    errors: List[Optional[str]] = []
+    connection = get_connection()
+
+    try:
+        connection.open()
+    except Exception as exception:
+        return [describe(exception)] * len(emails)
+
+    try:
+        for email in emails:
+            start = perf_counter()
+
+            try:
+                connection.send_messages([email.to_message(connection)])
+                errors.append(None)
+            except Exception as exception:
+                errors.append(describe(exception))
+
+            OUTBOX_SEND_SECONDS.observe(perf_counter() - start)
+    finally:
+        try:
+            connection.close()
+        except Exception as exception:
+            # the emails went out already
+            logger.warning(
+                "Failed to close the email connection: %s",
+                describe(exception),
+                extra={"event": "outbox.send"},
+            )
+
+    return errors
+
+
+def send_batch(emails: List[OutgoingEmail], concurrency: int) -> Tuple[int, int]:
+    """Sends a claimed batch and records the outcome; returns (sent, failed)."""
+    if not emails:
+        return 0, 0
+
+    chunks = [emails[index::concurrency] for index in range(concurrency)]
+    chunks = [chunk for chunk in chunks if chunk]
+
+    with ThreadPoolExecutor(
+        max_workers=len(chunks), thread_name_prefix="outbox"
+    ) as executor:
+        results = list(executor.map(send_chunk, chunks))
+
+    now = timezone.now()
+    sent = failed = 0
+
+    for chunk, errors in zip(chunks, results):
+        for email, error in zip(chunk, errors):
+            if error is None:
+                email.clear_body()
+                email.sent_at = now
+                email.status = OutgoingEmail.SENT
+                sent += 1
+                OUTBOX_EMAILS.labels("sent").inc()
+                continue
+
+            email.attempts += 1
+            email.last_error = error
+            failed += 1
+
+            if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                email.clear_body()
+                email.status = OutgoingEmail.FAILED
+                OUTBOX_EMAILS.labels("failed").inc()
+                logger.error(
+                    "Giving up on %s: %s", email, error, extra={"event": "outbox.send"}
+                )
+            else:
+                email.next_attempt_at = now + timedelta(
+                    seconds=get_retry_delay(email.attempts)
+                )
+                OUTBOX_EMAILS.labels("retried").inc()
+                logger.warning(
+                    "Failed to send %s, retrying: %s",
+                    email,
+                    error,
+                    extra={"event": "outbox.send"},
+                )
+
+    OutgoingEmail.objects.bulk_update(
+        emails,
+        (
+            "attempts",
+            "body",
+            "html_body",
+            "last_error",
+            "next_attempt_at",
+            "sent_at",
+            "status",
+        ),
+    )
+
+    return sent, failed
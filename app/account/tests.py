@@ -1,3 +1,212 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
+from django.contrib.auth.tokens import PasswordResetTokenGenerator
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from io import StringIO
+from rest_framework.test import APITestCase
+from unittest.mock import patch
 
-# Create your tests here.
+from .hashers import HasherSaturated, get_pool
+from .models import OutgoingEmail, PasswordReset, hash_token
+from .outbox import claim_batch, enqueue_email, send_batch
+
+
+User = get_user_model()
+
+
+@override_settings(
+    PASSWORD_HASHERS=["account.hashers.PooledPBKDF2PasswordHasher"],
+    PASSWORD_HASHING_ITERATIONS=1000,
+)
+class TestPooledPasswordHasher(TestCase):
+    def test_hash_and_verify(self):
+        encoded = make_password("password")
+
+        self.assertTrue(encoded.startswith("pbkdf2_sha256$1000$"))
+        self.assertTrue(check_password("password", encoded))
+        self.assertFalse(check_password("wrong", encoded))
+
+        with override_settings(PASSWORD_HASHING_ITERATIONS=2000):
+            self.assertTrue(identify_hasher(encoded).must_update(encoded))
+
+    def test_saturated(self):
+        _, slots = get_pool()
+        held = 0
+
+        while slots.acquire(blocking=False):
+            held += 1
+
+        try:
+            with self.assertRaises(HasherSaturated):
+                make_password("password")
+
+            response = self.client.post(
+                reverse("token-obtain-pair"),
+                {"email": "user@example.com", "password": "password"},
+            )
+            self.assertEqual(response.status_code, 503)
+        finally:
+            for _ in range(held):
+                slots.release()
+
+        self.assertTrue(check_password("password", make_password("password")))
+
+
+class TestOutbox(TestCase):
+    def test_claim_batch(self):
+        due = enqueue_email("due@example.com", "Due")
+        later = enqueue_email("later@example.com", "Later")
+        later.next_attempt_at = timezone.now() + timedelta(minutes=5)
+        later.save()
+
+        self.assertEqual(claim_batch(10), [due])
+        # leased to the first claim
+        self.assertEqual(claim_batch(10), [])
+
+    def test_send_batch(self):
+        for index in range(3):
+            enqueue_email(f"user{index}@example.com", "Hello", html_body="<p>Hi</p>")
+
+        self.assertEqual(send_batch(claim_batch(10), 2), (3, 0))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].alternatives, [("<p>Hi</p>", "text/html")])
+        self.assertEqual(
+            set(OutgoingEmail.objects.values_list("status", "body", "html_body")),
+            {(OutgoingEmail.SENT, "", "")},
+        )
+        self.assertEqual(claim_batch(10), [])
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_send_batch_retries(self):
+        email = enqueue_email("user@example.com", "Hello", body="Hi")
+
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.send_messages",
+            side_effect=OSError("Connection refused"),
+        ):
+            self.assertEqual(send_batch(claim_batch(10), 1), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual(email.attempts, 1)
+            self.assertEqual(email.last_error, "Connection refused")
+            self.assertEqual(email.status, OutgoingEmail.PENDING)
+            self.assertEqual(email.body, "Hi")
+            self.assertGreater(email.next_attempt_at, timezone.now())
+
+            email.next_attempt_at = timezone.now()
+            email.save()
+            self.assertEqual(send_batch(claim_batch(10), 1), (0, 1))
+            email.refresh_from_db()
+            self.assertEqual(email.status, OutgoingEmail.FAILED)
+            self.assertEqual(email.body, "")
+
+    def test_send_batch_connection_error(self):
+        emails = [enqueue_email(f"user{index}@example.com", "Hi") for index in range(2)]
+
+        with patch(
+            "django.core.mail.backends.locmem.EmailBackend.open",
+            side_effect=OSError("Connection refused"),
+        ):
+            self.assertEqual(send_batch(claim_batch(10), 1), (0, 2))
+
+        for email in emails:
+            email.refresh_from_db()
+            self.assertEqual(email.attempts, 1)
+            self.assertEqual(email.last_error, "Connection refused")
+            self.assertEqual(email.status, OutgoingEmail.PENDING)
+            self.assertGreater(email.next_attempt_at, timezone.now())
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]
+)
+class TestPasswordResetView(APITestCase):
+    def test_queues_email(self):
+        User.objects.create_user(
+            email="user@example.com", password="password", username="user"
+        )
+
+        response = self.client.post(
+            reverse("password-reset"), {"email": "user@example.com"}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PasswordReset.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.to, "user@example.com")
+        self.assertIn("password-change?token=", email.html_body)
+
+
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]
+)
+class TestPasswordResetToken(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            email="user@example.com", password="password", username="user"
+        )
+        self.token = PasswordResetTokenGenerator().make_token(self.user)
+        self.reset = PasswordReset(email=self.user.email)
+        self.reset.set_token(self.token)
+        self.reset.save()
+
+    def expire(self, reset: PasswordReset) -> None:
+        PasswordReset.objects.filter(id=reset.id).update(
+            created_at=timezone.now() - timedelta(days=30)
+        )
+
+    def test_stores_hash(self):
+        self.assertEqual(self.reset.token_hash, hash_token(self.token))
+        self.assertNotIn(self.token, self.reset.token_hash)
+        self.assertEqual(PasswordReset.objects.for_token(self.token).get(), self.reset)
+
+    def test_verify(self):
+        url = reverse("password-reset-token-verification")
+
+        response = self.client.post(url, {"token": self.token})
+        self.assertEqual(response.status_code, 200)
+
+        self.expire(self.reset)
+        response = self.client.post(url, {"token": self.token})
+        self.assertEqual(response.status_code, 400)
+
+    def test_purge(self):
+        expired = PasswordReset.objects.create(email="old@example.com")
+        self.expire(expired)
+        stdout = StringIO()
+
+        call_command("purge_password_resets", batch_size=1, stdout=stdout)
+
+        self.assertEqual(list(PasswordReset.objects.all()), [self.reset])
+        self.assertIn("Deleted 1", stdout.getvalue())
+
+    def test_purge_interval(self):
+        stdout = StringIO()
+
+        def expire_next(seconds):
+            if len(sleep.call_args_list) > 1:
+                raise KeyboardInterrupt
+            self.expire(self.reset)
+
+        # a reset that expires between runs goes on the next one
+        with patch(
+            "account.management.commands.purge_password_resets.sleep",
+            side_effect=expire_next,
+        ) as sleep:
+            call_command("purge_password_resets", interval=60, stdout=stdout)
+
+        sleep.assert_called_with(60)
+        self.assertFalse(PasswordReset.objects.exists())
+        self.assertEqual(
+            stdout.getvalue().splitlines(),
+            [
+                "Deleted 0 expired password resets.",
+                "Deleted 1 expired password resets.",
+                "Stopped.",
+            ],
+        )
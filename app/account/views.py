@@ -2,22 +2,20 @@ import logging
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
-from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
 from django.db.models import Q
 from django.template.loader import get_template
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
-from rest_framework.status import (
-    HTTP_201_CREATED,
-    HTTP_400_BAD_REQUEST,
-    HTTP_500_INTERNAL_SERVER_ERROR,
-)
+from rest_framework.status import HTTP_201_CREATED, HTTP_400_BAD_REQUEST
 from rest_framework.views import APIView
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
+from api.db_routers import ReplicaReadMixin
 from .models import PasswordReset
+from .outbox import enqueue_email
 from .serializers import (
     PasswordChangeSerializer,
     PasswordResetSerializer,
@@ -28,6 +26,8 @@ from .serializers import (
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
 
 class PasswordChangeView(APIView):
     def post(self, request: Request) -> Response:
@@ -38,33 +38,35 @@ class PasswordChangeView(APIView):
 
         password = serializer.validated_data.get("password")
         token = serializer.validated_data.get("token")
-        reset = PasswordReset.objects.filter(token=token).first()
+        reset = PasswordReset.objects.for_token(token).first()
 
         if reset is None:
             warning = "Reset record not found for the provided token."
-            logging.warning(warning)
+            logger.warning(warning)
             return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
 
         user = User.objects.filter(email=reset.email).first()
 
         if user is None:
             warning = "User not found."
-            logging.warning(warning)
+            logger.warning(warning)
             return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
 
         if not PasswordResetTokenGenerator().check_token(user, token):
             warning = "Invalid token."
-            logging.warning(warning)
+            logger.warning(warning)
             return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
 
+        # hashes first: a saturated hashing pool must not use up the reset
+        user.set_password(password)
+
         reset.delete()
-        logging.info(f"Deleted {reset}.")
+        logger.info("Deleted %s.", reset, extra={"event": "password.change"})
 
-        user.set_password(password)
         user.save()
 
         success_message = f"Updated password for {user}."
-        logging.info(success_message)
+        logger.info(success_message, extra={"event": "password.change"})
 
         # Maybe send email notification?
 
@@ -76,8 +78,8 @@ class PasswordResetView(APIView):
         serializer = PasswordResetSerializer(data=request.data)
 
         if not serializer.is_valid():
-            logging.warning(
-                f"Invalid data provided to PasswordReset: {serializer.errors}"
+            logger.warning(
+                "Invalid data provided to PasswordReset: %s", serializer.errors
             )
             return Response(serializer.errors, status=HTTP_400_BAD_REQUEST)
 
@@ -86,9 +88,6 @@ class PasswordResetView(APIView):
         if user:
             token_generator = PasswordResetTokenGenerator()
             token = token_generator.make_token(user)
-            reset = PasswordReset(email=user.email, token=token)
-            reset.save()
-            logging.info("Created {reset}.")
 
             template = get_template("account/reset_password_email.html")
             context = {
@@ -96,21 +95,25 @@ class PasswordResetView(APIView):
             }
             html_content = template.render(context)
 
-            email = EmailMultiAlternatives(
-                alternatives=((html_content, "text/html"),),
-                from_email="no-reply@telegraph.ianhenderson.info",
-                subject="Change password for Telegraph",
-                to=(user.email,),
-            )
-
-            try:
-                email.send()
-            except Exception as exception:
-                error = f"Failed to send password reset email to {user}."
-                logging.error(f"{error}: {exception}")
-                return Response({"error": error}, status=HTTP_500_INTERNAL_SERVER_ERROR)
+            # the outbox sends it, so a slow or failing mail server never holds
+            # up the request; the reset and its email commit together
+            with transaction.atomic():
+                reset = PasswordReset(email=user.email)
+                reset.set_token(token)
+                reset.save()
+                email = enqueue_email(
+                    html_body=html_content,
+                    subject="Change password for Telegraph",
+                    to=user.email,
+                )
 
-            logging.info(f"Sent password reset email to {user}.")
+            logger.info("Created %s.", reset, extra={"event": "password.reset"})
+            logger.info(
+                "Queued password reset email to %s as %s.",
+                user,
+                email,
+                extra={"event": "password.reset"},
+            )
 
         return Response({"success": "Email was sent if account exists"})
 
@@ -120,37 +123,40 @@ class PasswordResetTokenVerificationView(APIView):
         serializer = PasswordResetTokenVerificationSerializer(data=request.data)
 
         if not serializer.is_valid():
-            logging.warning(
-                f"Invalid data provided to PasswordResetTokenVerificationView: {serializer.errors}"
+            logger.warning(
+                "Invalid data provided to PasswordResetTokenVerificationView: %s",
+                serializer.errors,
             )
             return Response(serializer.errors, status=HTTP_400_BAD_REQUEST)
 
         token = serializer.validated_data.get("token")
-        reset = PasswordReset.objects.filter(token=token).first()
+        reset = PasswordReset.objects.for_token(token).first()
 
         if reset is None:
-            warning = "PasswordReset record not found for token '{token}'."
-            logging.warning(warning)
+            warning = "PasswordReset record not found for the provided token."
+            logger.warning(warning)
             return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
 
         user = User.objects.filter(email=reset.email).first()
 
         if not user:
             warning = f"No user found for {reset}."
-            logging.warning(warning)
+            logger.warning(warning)
             return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
 
         if not PasswordResetTokenGenerator().check_token(user, token):
             warning = "Invalid token."
-            logging.warning(warning)
+            logger.warning(warning)
             return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
 
-        logging.info(f"Validated token for {reset}.")
+        logger.info(
+            "Validated token for %s.", reset, extra={"event": "password.reset.verify"}
+        )
 
         return Response({"success": "Valid token."})
 
 
-class UserReadOnlyViewSet(ReadOnlyModelViewSet):
+class UserReadOnlyViewSet(ReplicaReadMixin, ReadOnlyModelViewSet):
     lookup_field = "username"
     permission_classes = (IsAuthenticated,)
     queryset = User.objects.all()
@@ -171,7 +177,9 @@ class UserReadOnlyViewSet(ReadOnlyModelViewSet):
                 queryset |= User.objects.filter(part_query)
 
         serializer = self.get_serializer(queryset, many=True)
-        logging.info(f"User search executed where q='{query}'.")
+        logger.info(
+            "User search executed where q='%s'.", query, extra={"event": "user.search"}
+        )
 
         return Response(serializer.data)
 
@@ -182,10 +190,10 @@ class UserRegistrationView(APIView):
 
         if not serializer.is_valid():
             warning = "Invalid data provided to UserRegistration"
-            logging.warning(f"{warning}: {serializer.errors}")
+            logger.warning("%s: %s", warning, serializer.errors)
             return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
 
         user = serializer.save()
-        logging.info(f"Created {user}.")
+        logger.info("Created %s.", user, extra={"event": "user.register"})
 
         return Response(serializer.data, status=HTTP_201_CREATED)
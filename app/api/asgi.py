@@ -13,19 +13,29 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
-from chat.routing import websocket_urlpatterns
-from .middleware import JwtAuthMiddleware
-
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
 
+# set up Django before importing anything that touches models, so workers
+# started by daphne directly can import this module
 django_asgi_app = get_asgi_application()
 
+from chat.routing import websocket_urlpatterns  # noqa: E402
+from .connections import (  # noqa: E402
+    ConnectionLimitMiddleware,
+    install_drain_handler,
+)
+from .middleware import JwtAuthMiddleware  # noqa: E402
+
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
-            JwtAuthMiddleware(URLRouter(websocket_urlpatterns))
+            ConnectionLimitMiddleware(
+                JwtAuthMiddleware(URLRouter(websocket_urlpatterns))
+            )
         ),
     }
 )
+
+install_drain_handler()
@@ -0,0 +1,17 @@
+from rest_framework_simplejwt.authentication import (
+    JWTAuthentication as BaseJWTAuthentication,
+)
+
+from .db_routers import bind_user
+
+
+class JWTAuthentication(BaseJWTAuthentication):
+    """simplejwt's authentication, attributing the request's writes to its user."""
+
+    def authenticate(self, request):
+        result = super().authenticate(request)
+
+        if result is not None:
+            bind_user(result[0].id)
+
+        return result
@@ -0,0 +1,349 @@
+import asyncio
+import collections
+import logging
+import time
+
+from channels_redis.core import RedisChannelLayer
+from copy import deepcopy
+from typing import List, Optional, Tuple
+
+from .metrics import (
+    CHANNEL_LAYER_DELIVERIES,
+    CHANNEL_LAYER_FANOUT_SECONDS,
+    CHANNEL_LAYER_FANOUT_WIDTH,
+    CHANNEL_LAYER_SECONDS,
+)
+
+
+# Delivery half of RedisChannelLayer.group_send, unchanged from channels_redis.
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+# Drops expired members of a group and returns the rest, or nil once the group
+# has at least ARGV[2] members (0 disables the check), in one round trip.
+GROUP_MEMBERS_LUA = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+    local threshold = tonumber(ARGV[2])
+    if threshold > 0 and redis.call('ZCARD', KEYS[1]) >= threshold then
+        return false
+    end
+    return redis.call('ZRANGE', KEYS[1], 0, -1)
+"""
+
+
+# Sent to this process's fan-out channel to wake the receive lock holder.
+WAKE_MESSAGE_TYPE = "layer.wake"
+
+
+class LocalFanout:
+    """
+    Stands in for the receive buffer of a worker's fan-out channel. Envelopes
+    pulled off redis for that channel are delivered to the worker's local
+    group members instead of being queued.
+    """
+
+    def __init__(self, channel_layer) -> None:
+        self.channel_layer = channel_layer
+
+    def put_nowait(self, envelope: dict) -> None:
+        # wake-ups only had to interrupt the receive lock holder's BZPOPMIN
+        if envelope.get("type") == WAKE_MESSAGE_TYPE:
+            self.channel_layer.wake_sent_at = None
+            return
+
+        self.channel_layer.deliver_local(envelope["group"], envelope["message"])
+
+
+class HybridRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that delivers group messages to channels living in
+    this process straight from an in-process group table, and only goes
+    through redis for channels owned by other workers.
+
+    Groups with at least `fanout_threshold` members switch to hierarchical
+    fan-out: the message is published once per worker that has members in the
+    group, and each worker delivers it to its own local members. Every worker
+    must run this layer for that mode to reach all members.
+
+    Attributes:
+        fanout_channel (str):
+            The process-specific channel other workers publish fan-out
+            envelopes to.
+        local_groups (Dict[str, Dict[str, float]]):
+            A dictionary mapping group names to the process-local channel names
+            that were added to them and when, so memberships expire after
+            group_expiry like the ones in redis.
+        stats (Dict[str, float]):
+            Counters for deliveries that stayed in-process ("local") versus
+            deliveries published to redis ("remote"), plus the number, total
+            width and total duration of hierarchical fan-outs.
+        wake_sent_at (Optional[float]):
+            When the wake-up still in flight to the receive lock holder was
+            sent.
+    """
+
+    def __init__(self, *args, fanout_threshold: int = 0, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fanout_threshold = fanout_threshold
+        self.fanout_channel = f"specific.{self.client_prefix}!fanout"
+        self.local_groups = collections.defaultdict(dict)
+        self.receive_buffer[self.fanout_channel] = LocalFanout(self)
+        self.stats = {
+            "fanout_seconds": 0.0,
+            "fanout_sends": 0,
+            "fanout_width": 0,
+            "local": 0,
+            "remote": 0,
+        }
+        self.wake_sent_at: Optional[float] = None
+
+    def _workers_key(self, group: str) -> bytes:
+        return f"{self.prefix}:workers:{group}".encode("utf8")
+
+    def get_local_hit_rate(self) -> float:
+        total = self.stats["local"] + self.stats["remote"]
+        return self.stats["local"] / total if total else 0.0
+
+    def is_local_channel(self, channel: str) -> bool:
+        return "!" in channel and self.non_local_name(channel).endswith(
+            self.client_prefix + "!"
+        )
+
+    async def group_add(self, group, channel):
+        with CHANNEL_LAYER_SECONDS.labels("group_add").time():
+            await self._group_add(group, channel)
+
+    async def _group_add(self, group, channel):
+        await super().group_add(group, channel)
+
+        if not self.is_local_channel(channel):
+            return
+
+        self.local_groups[group][channel] = time.time()
+
+        # refreshed on every add, as send_fanout drops workers whose entry is
+        # older than group_expiry
+        if self.fanout_threshold:
+            connection = self.connection(self.consistent_hash(group))
+            workers_key = self._workers_key(group)
+            pipe = connection.pipeline()
+            pipe.zadd(workers_key, {self.fanout_channel: time.time()})
+            pipe.expire(workers_key, self.group_expiry)
+            await pipe.execute()
+
+    async def group_discard(self, group, channel):
+        with CHANNEL_LAYER_SECONDS.labels("group_discard").time():
+            await self._group_discard(group, channel)
+
+    async def _group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+
+        if group not in self.local_groups:
+            return
+
+        self.local_groups[group].pop(channel, None)
+
+        if not self.local_groups[group]:
+            del self.local_groups[group]
+
+            if self.fanout_threshold:
+                connection = self.connection(self.consistent_hash(group))
+                await connection.zrem(self._workers_key(group), self.fanout_channel)
+
+    async def group_discard_many(self, memberships: List[Tuple[str, str]]) -> None:
+        """
+        group_discard for many (group, channel) pairs at once, with one
+        pipeline per redis shard.
+        """
+        with CHANNEL_LAYER_SECONDS.labels("group_discard_many").time():
+            pipelines = {}
+
+            def get_pipeline(group: str):
+                index = self.consistent_hash(group)
+                if index not in pipelines:
+                    pipelines[index] = self.connection(index).pipeline()
+                return pipelines[index]
+
+            for group, channel in memberships:
+                assert self.valid_group_name(group), "Group name not valid"
+                assert self.valid_channel_name(channel), "Channel name not valid"
+                get_pipeline(group).zrem(self._group_key(group), channel)
+
+                if group not in self.local_groups:
+                    continue
+
+                self.local_groups[group].pop(channel, None)
+
+                if not self.local_groups[group]:
+                    del self.local_groups[group]
+
+                    if self.fanout_threshold:
+                        get_pipeline(group).zrem(
+                            self._workers_key(group), self.fanout_channel
+                        )
+
+            await asyncio.gather(*(pipe.execute() for pipe in pipelines.values()))
+
+    async def group_send(self, group, message):
+        with CHANNEL_LAYER_SECONDS.labels("group_send").time():
+            await self._group_send(group, message)
+
+    async def _group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        if self.deliver_local(group, message):
+            await self.wake_receiver()
+
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        # Discards old channels based on group_expiry, like RedisChannelLayer
+        members = await connection.eval(
+            GROUP_MEMBERS_LUA,
+            1,
+            key,
+            int(time.time()) - self.group_expiry,
+            self.fanout_threshold,
+        )
+
+        if members is None:
+            return await self.send_fanout(group, message)
+
+        channel_names = [
+            name
+            for name in (x.decode("utf8") for x in members)
+            if not self.is_local_channel(name)
+        ]
+
+        if channel_names:
+            await self.send_remote(group, channel_names, message)
+
+    def deliver_local(self, group: str, message: dict) -> int:
+        members = self.local_groups.get(group, {})
+        cutoff = time.time() - self.group_expiry
+        channels = [channel for channel, added in members.items() if added > cutoff]
+
+        # drops expired members the way group_send does in redis
+        if len(channels) < len(members):
+            for channel in set(members).difference(channels):
+                del members[channel]
+            if not members:
+                del self.local_groups[group]
+
+        for channel in channels:
+            self.receive_buffer[channel].put_nowait(deepcopy(message))
+
+        self.stats["local"] += len(channels)
+        CHANNEL_LAYER_DELIVERIES.labels("local").inc(len(channels))
+        return len(channels)
+
+    async def wake_receiver(self) -> None:
+        """
+        The coroutine holding receive_lock waits on redis rather than on its
+        own receive buffer, so without traffic from redis it would never see
+        a local delivery to its channel. A no-op on the fan-out channel wakes
+        it; at most one is in flight per brpop_timeout.
+        """
+        if self.receive_lock is None or not self.receive_lock.locked():
+            return
+
+        now = time.monotonic()
+        if self.wake_sent_at is not None and now - self.wake_sent_at < (
+            self.brpop_timeout
+        ):
+            return
+
+        self.wake_sent_at = now
+        try:
+            await self.send(self.fanout_channel, {"type": WAKE_MESSAGE_TYPE})
+        except Exception as exception:
+            self.wake_sent_at = None
+            logging.error(f"Failed to wake the receive lock holder: {exception}")
+
+    async def send_fanout(self, group: str, message: dict) -> None:
+        """
+        Publishes the message once to every other worker with local members in
+        the group; each of them delivers it through LocalFanout.
+        """
+        start = time.perf_counter()
+        connection = self.connection(self.consistent_hash(group))
+        workers_key = self._workers_key(group)
+        await connection.zremrangebyscore(
+            workers_key, min=0, max=int(time.time()) - self.group_expiry
+        )
+
+        worker_channels = [
+            name
+            for name in (
+                x.decode("utf8") for x in await connection.zrange(workers_key, 0, -1)
+            )
+            if name != self.fanout_channel
+        ]
+        envelope = {"group": group, "message": message}
+
+        results = await asyncio.gather(
+            *[self.send(channel, envelope) for channel in worker_channels],
+            return_exceptions=True,
+        )
+
+        for channel, result in zip(worker_channels, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to fan out {group} to {channel}: {result}")
+
+        elapsed = time.perf_counter() - start
+        self.stats["fanout_seconds"] += elapsed
+        self.stats["fanout_sends"] += 1
+        self.stats["fanout_width"] += len(worker_channels)
+        self.stats["remote"] += len(worker_channels)
+        CHANNEL_LAYER_DELIVERIES.labels("remote").inc(len(worker_channels))
+        CHANNEL_LAYER_FANOUT_SECONDS.observe(elapsed)
+        CHANNEL_LAYER_FANOUT_WIDTH.observe(len(worker_channels))
+
+    async def send_remote(self, group: str, channel_names: list, message: dict):
+        """
+        Publishes the message to channels owned by other workers. Mirrors the
+        delivery half of RedisChannelLayer.group_send.
+        """
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channel_names, message)
+
+        for connection_index, channel_redis_keys in connection_to_channel_keys.items():
+            connection = self.connection(connection_index)
+
+            # Discard old messages based on expiry
+            pipe = connection.pipeline()
+            for key in channel_redis_keys:
+                pipe.zremrangebyscore(
+                    key, min=0, max=int(time.time()) - int(self.expiry)
+                )
+            await pipe.execute()
+
+            args = [channel_keys_to_message[key] for key in channel_redis_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_redis_keys]
+            args += [time.time(), self.expiry]
+
+            channels_over_capacity = await connection.eval(
+                GROUP_SEND_LUA, len(channel_redis_keys), *channel_redis_keys, *args
+            )
+            if channels_over_capacity > 0:
+                logging.info(
+                    f"{channels_over_capacity} of {len(channel_names)} channels "
+                    f"over capacity in group {group}."
+                )
+
+        self.stats["remote"] += len(channel_names)
+        CHANNEL_LAYER_DELIVERIES.labels("remote").inc(len(channel_names))
@@ -0,0 +1,264 @@
+"""
+Websocket connections open in this worker process.
+
+ConnectionLimitMiddleware counts every websocket for its whole lifetime and
+turns new ones away with WS_4503_SERVICE_UNAVAILABLE once
+WS_MAX_CONNECTIONS_PER_WORKER are open, before any authentication work is
+spent on them. A client should retry, and usually lands on another worker.
+
+A worker that gets SIGUSR1 drains: it turns every new websocket away, sends
+each open one a connection.drain message through its own channel, spread over
+WS_DRAIN_WINDOW_SECONDS, and then stops itself with SIGTERM. The message
+queues up behind the events already sent to the channel, so those reach the
+client before it is told to reconnect.
+
+Every frame a client sends counts as a heartbeat. Once per
+WS_HEARTBEAT_INTERVAL a reaper task closes the connections that sent nothing
+for WS_IDLE_TIMEOUT seconds, typically half-open mobile sockets nobody reads.
+Their groups are discarded WS_REAP_BATCH_SIZE connections at a time, in one
+pipeline per redis shard with HybridRedisChannelLayer, so fan-out stops
+reaching them without waiting for the close handshake to time out.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import signal
+import threading
+
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from .metrics import WEBSOCKET_DRAINED, WEBSOCKET_REAPED, WEBSOCKET_REJECTED
+from .websocket_codes import WS_4503_SERVICE_UNAVAILABLE
+
+
+logger = logging.getLogger(__name__)
+
+
+async def group_discard_many(channel_layer, memberships: List[Tuple[str, str]]):
+    """Discards (group, channel) pairs, batched where the layer supports it."""
+    if hasattr(channel_layer, "group_discard_many"):
+        return await channel_layer.group_discard_many(memberships)
+
+    await asyncio.gather(
+        *(
+            channel_layer.group_discard(group, channel)
+            for group, channel in memberships
+        )
+    )
+
+
+class ConnectionRegistry:
+    """
+    Registered consumers have to implement get_group_names(), returning the
+    groups their channel is in, and reap(groups_discarded), closing the
+    connection.
+
+    Attributes:
+        active (int):
+            Websockets currently open in this process, including ones still
+            authenticating.
+        consumers (Dict[str, AsyncWebsocketConsumer]):
+            A dictionary mapping channel names to the accepted consumers that
+            can be drained and reaped.
+        draining (bool):
+            Whether the process is shutting down and refuses new websockets.
+        last_seen (Dict[str, float]):
+            A dictionary mapping channel names to the monotonic time their
+            client last sent a frame.
+        reaper (Optional[asyncio.Task]):
+            The task closing idle connections, started by the first register()
+            on an event loop.
+    """
+
+    def __init__(self) -> None:
+        self.active = 0
+        self.consumers: Dict[str, AsyncWebsocketConsumer] = {}
+        self.draining = False
+        self.last_seen: Dict[str, float] = {}
+        self.reaper: Optional[asyncio.Task] = None
+
+    def is_full(self) -> bool:
+        limit = settings.WS_MAX_CONNECTIONS_PER_WORKER
+        return bool(limit) and self.active >= limit
+
+    def register(self, consumer: AsyncWebsocketConsumer) -> None:
+        self.consumers[consumer.channel_name] = consumer
+        self.touch(consumer.channel_name)
+
+        # one reaper per event loop, like the presence tracker's flush task
+        loop = asyncio.get_running_loop()
+        has_reaper = (
+            self.reaper is not None
+            and not self.reaper.done()
+            and self.reaper.get_loop() is loop
+        )
+        if settings.WS_IDLE_TIMEOUT and not has_reaper:
+            self.reaper = loop.create_task(self.run_reaper())
+
+    def unregister(self, consumer: AsyncWebsocketConsumer) -> None:
+        self.consumers.pop(consumer.channel_name, None)
+        self.last_seen.pop(consumer.channel_name, None)
+
+    def touch(self, channel: str) -> None:
+        if channel in self.consumers:
+            self.last_seen[channel] = monotonic()
+
+    async def reap(self, timeout: float) -> int:
+        """Closes the connections idle for more than timeout seconds."""
+        cutoff = monotonic() - timeout
+        idle = [
+            self.consumers[channel]
+            for channel, seen in self.last_seen.items()
+            if seen < cutoff
+        ]
+        channel_layer = get_channel_layer()
+        size = settings.WS_REAP_BATCH_SIZE
+
+        for start in range(0, len(idle), size):
+            batch = idle[start : start + size]
+            memberships = [
+                (group, consumer.channel_name)
+                for consumer in batch
+                for group in consumer.get_group_names()
+            ]
+
+            try:
+                await group_discard_many(channel_layer, memberships)
+                groups_discarded = True
+            except Exception as exception:
+                # the consumers retry on disconnect
+                logger.error(
+                    "Failed to discard groups of idle connections: %s",
+                    exception,
+                    extra={"event": "ws.reap"},
+                )
+                groups_discarded = False
+
+            for consumer in batch:
+                self.unregister(consumer)
+                await consumer.reap(groups_discarded)
+
+            # lets live connections be served between batches
+            await asyncio.sleep(0)
+
+        if idle:
+            WEBSOCKET_REAPED.inc(len(idle))
+            logger.info(
+                "Reaped %d idle websocket connections.",
+                len(idle),
+                extra={"event": "ws.reap"},
+            )
+
+        return len(idle)
+
+    async def run_reaper(self) -> None:
+        while True:
+            await asyncio.sleep(settings.WS_HEARTBEAT_INTERVAL)
+
+            try:
+                await self.reap(settings.WS_IDLE_TIMEOUT)
+            except Exception as exception:
+                logger.error(
+                    "Failed to reap connections: %s",
+                    exception,
+                    extra={"event": "ws.reap"},
+                )
+
+    async def drain(self, window: float, timeout: float = 5.0) -> None:
+        """
+        Asks every registered consumer to reconnect, one at a time at evenly
+        spaced intervals over window seconds, and waits up to timeout seconds
+        longer for them to close.
+        """
+        self.draining = True
+        channels = list(self.consumers)
+        random.shuffle(channels)
+        interval = window / len(channels) if channels else 0
+        channel_layer = get_channel_layer()
+
+        logger.info(
+            "Draining %d websocket connections over %ss.",
+            len(channels),
+            window,
+            extra={"event": "ws.drain"},
+        )
+
+        for channel in channels:
+            # the reconnect delay is per client, so reconnects don't line up
+            delay = random.uniform(0, settings.WS_RECONNECT_DELAY_SECONDS)
+            try:
+                await channel_layer.send(
+                    channel, {"type": "connection.drain", "delay": round(delay, 3)}
+                )
+                WEBSOCKET_DRAINED.inc()
+            except Exception as exception:
+                logger.error(
+                    "Failed to drain %s: %s",
+                    channel,
+                    exception,
+                    extra={"event": "ws.drain"},
+                )
+            await asyncio.sleep(interval)
+
+        deadline = monotonic() + timeout
+        while self.consumers and monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    async def drain_and_stop(self) -> None:
+        await self.drain(settings.WS_DRAIN_WINDOW_SECONDS)
+        # daphne stops on SIGTERM, closing whatever is still open
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+connection_registry = ConnectionRegistry()
+
+
+def install_drain_handler() -> None:
+    """Drains this process on SIGUSR1, which the serve command sends to stop it."""
+    # signal handlers can only be set from the main thread, which runserver's
+    # autoreloader doesn't import the application in
+    if threading.current_thread() is not threading.main_thread():
+        return
+
+    def on_signal(signum, frame) -> None:
+        if connection_registry.draining:
+            return
+
+        connection_registry.draining = True
+        loop = asyncio.get_event_loop()
+        coroutine = connection_registry.drain_and_stop()
+        loop.call_soon_threadsafe(loop.create_task, coroutine)
+
+    signal.signal(signal.SIGUSR1, on_signal)
+
+
+async def reject_connection(receive, send, reason: str) -> None:
+    """Completes the handshake so the client sees the close code, then closes."""
+    WEBSOCKET_REJECTED.labels(reason).inc()
+    message = await receive()
+
+    if message["type"] == "websocket.connect":
+        await send({"type": "websocket.accept"})
+        await send({"code": WS_4503_SERVICE_UNAVAILABLE, "type": "websocket.close"})
+
+
+class ConnectionLimitMiddleware(BaseMiddleware):
+    async def __call__(self, scope, receive, send):
+        if connection_registry.draining:
+            return await reject_connection(receive, send, "draining")
+
+        if connection_registry.is_full():
+            return await reject_connection(receive, send, "full")
+
+        connection_registry.active += 1
+        try:
+            return await super().__call__(scope, receive, send)
+        finally:
+            connection_registry.active -= 1
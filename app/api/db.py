@@ -0,0 +1,75 @@
+"""
+Bounded thread pool for database work done from async code.
+
+channels' database_sync_to_async closes the connection around every call
+unless CONN_MAX_AGE keeps it alive, and runs every websocket query through a
+single shared thread. Here each call runs in one of DB_POOL_SIZE threads
+instead. With persistent connections every thread holds one connection, so
+the executor doubles as a bounded connection pool. Each call records its
+user's writes for the replica router once, in track_writes().
+"""
+
+import functools
+
+from channels.db import DatabaseSyncToAsync
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from time import perf_counter
+from typing import Optional
+
+from .db_routers import track_writes
+from .metrics import (
+    DB_POOL_IN_USE,
+    DB_POOL_SIZE,
+    DB_POOL_WAIT_SECONDS,
+    DB_POOL_WAITING,
+)
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.DB_POOL_SIZE, thread_name_prefix="db-pool"
+        )
+        DB_POOL_SIZE.set(settings.DB_POOL_SIZE)
+
+    return _executor
+
+
+def database_sync_to_async(func):
+    """Drop-in replacement for channels.db.database_sync_to_async."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        queued_at = perf_counter()
+        started = False
+        DB_POOL_WAITING.inc()
+
+        def run():
+            nonlocal started
+            started = True
+            DB_POOL_WAITING.dec()
+            DB_POOL_WAIT_SECONDS.observe(perf_counter() - queued_at)
+            DB_POOL_IN_USE.inc()
+
+            try:
+                with track_writes():
+                    return func(*args, **kwargs)
+            finally:
+                DB_POOL_IN_USE.dec()
+
+        try:
+            return await DatabaseSyncToAsync(
+                run, thread_sensitive=False, executor=get_executor()
+            )()
+        finally:
+            # cancelled before a pool thread picked it up
+            if not started:
+                DB_POOL_WAITING.dec()
+
+    return wrapper
@@ -0,0 +1,175 @@
+"""
+Primary/replica database routing.
+
+Reads are only sent to a replica inside replica_reads(), which
+ReplicaReadMixin opens around read-only views. Everything else, and every
+write, uses the primary. A user who wrote within DB_REPLICA_STICKY_SECONDS
+reads from the primary, so they always see their own writes. Replicas whose
+lag exceeds DB_REPLICA_MAX_LAG_SECONDS are skipped.
+
+Writes are attributed to the user bound with bind_user(): by
+api.authentication for REST requests, by TrackWritesMiddleware for session
+users and by JwtAuthMiddleware for websockets. Inside track_writes(), which
+wraps every REST request and every call on the api.db pool, the user's write
+is recorded once when the block exits rather than once per statement.
+"""
+
+import logging
+import random
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+_replica_reads: ContextVar[bool] = ContextVar("replica_reads", default=False)
+_user_id: ContextVar[Optional[int]] = ContextVar("db_user_id", default=None)
+# ids of the users who wrote inside the current track_writes() block
+_writers: ContextVar[Optional[Set[int]]] = ContextVar("db_writers", default=None)
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+def bind_user(user_id: Optional[int]) -> None:
+    """Attributes the current context's writes and reads to a user."""
+    _user_id.set(user_id)
+
+
+def get_recent_write_key(user_id: int) -> str:
+    return f"db:recent_write:{user_id}"
+
+
+def record_write(user_id: int) -> None:
+    cache.set(get_recent_write_key(user_id), True, settings.DB_REPLICA_STICKY_SECONDS)
+
+
+@contextmanager
+def track_writes() -> Iterator[None]:
+    """
+    Scopes the bound user to the block and records their writes in the block
+    once, when it exits.
+    """
+    user_token = _user_id.set(_user_id.get())
+    writers_token = _writers.set(set())
+    try:
+        yield
+    finally:
+        writers = _writers.get()
+        _writers.reset(writers_token)
+        _user_id.reset(user_token)
+
+        for user_id in writers:
+            record_write(user_id)
+
+
+@contextmanager
+def replica_reads() -> Iterator[None]:
+    reads_token = _replica_reads.set(True)
+    user_token = _user_id.set(_user_id.get())
+    try:
+        yield
+    finally:
+        _user_id.reset(user_token)
+        _replica_reads.reset(reads_token)
+
+
+class ReplicaLagMonitor:
+    """
+    Measures replica lag at most once per DB_REPLICA_LAG_CHECK_INTERVAL
+    seconds per replica.
+
+    Attributes:
+        lags (Dict[str, Tuple[float, float]]):
+            A dictionary mapping replica aliases to when their lag was last
+            measured and the lag in seconds.
+    """
+
+    def __init__(self) -> None:
+        self.lags: Dict[str, Tuple[float, float]] = {}
+
+    def get_lag(self, alias: str) -> float:
+        checked_at, lag = self.lags.get(alias, (None, None))
+
+        if checked_at is None or (
+            monotonic() - checked_at > settings.DB_REPLICA_LAG_CHECK_INTERVAL
+        ):
+            lag = self.measure_lag(alias)
+            self.lags[alias] = (monotonic(), lag)
+
+        return lag
+
+    def is_healthy(self, alias: str) -> bool:
+        return self.get_lag(alias) <= settings.DB_REPLICA_MAX_LAG_SECONDS
+
+    def measure_lag(self, alias: str) -> float:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                return float(cursor.fetchone()[0] or 0)
+        except Exception as exception:
+            logger.warning("Failed to measure lag of %s: %s", alias, exception)
+            return float("inf")
+
+
+class PrimaryReplicaRouter:
+    def __init__(self) -> None:
+        self.lag_monitor = ReplicaLagMonitor()
+        self.replicas: List[str] = [
+            alias for alias in settings.DATABASES if alias.startswith("replica_")
+        ]
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *self.replicas}
+        return obj1._state.db in databases and obj2._state.db in databases
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or not _replica_reads.get():
+            return DEFAULT_DB_ALIAS
+
+        user_id = _user_id.get()
+
+        if user_id is not None and cache.get(get_recent_write_key(user_id)):
+            return DEFAULT_DB_ALIAS
+
+        healthy = [
+            alias for alias in self.replicas if self.lag_monitor.is_healthy(alias)
+        ]
+        return random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        user_id = _user_id.get()
+
+        if self.replicas and user_id is not None:
+            writers = _writers.get()
+
+            if writers is None:
+                record_write(user_id)
+            else:
+                writers.add(user_id)
+
+        return DEFAULT_DB_ALIAS
+
+
+class ReplicaReadMixin:
+    """
+    Serves a read-only DRF view from a replica unless the logged-in user wrote
+    recently.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads():
+            return super().dispatch(request, *args, **kwargs)
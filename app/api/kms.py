@@ -1,23 +1,55 @@
 import logging
+import threading
 
 from base64 import urlsafe_b64decode, urlsafe_b64encode
 from botocore.exceptions import ClientError
 from cryptography.fernet import Fernet
+from django.core.exceptions import ImproperlyConfigured
+from functools import lru_cache
 from os import getenv
+from typing import Iterable, List, Optional
 
+from api.metrics import KMS_SECONDS
 from api.settings import boto3_session
 
 
+@lru_cache(maxsize=64)
+def get_fernet(data_key: str) -> Fernet:
+    # messages share a handful of data keys, so keys are parsed once each
+    return Fernet(data_key)
+
+
 class KmsClient:
     client = boto3_session.client("kms")
 
     def __init__(self):
-        self.current_data_key = self.get_data_key()
+        self._data_key: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def current_data_key(self) -> str:
+        # created on first use rather than at import, so management commands
+        # and worker boot don't wait on KMS; /ready warms it
+        if self._data_key is None:
+            with self._lock:
+                if self._data_key is None:
+                    self._data_key = self.get_data_key()
+
+        return self._data_key
 
+    @KMS_SECONDS.labels("decrypt").time()
     def decrypt(self, ciphertext: str) -> str or None:
+        return self._decrypt(ciphertext)
+
+    @KMS_SECONDS.labels("decrypt_many").time()
+    def decrypt_many(self, ciphertexts: Iterable[str]) -> List[Optional[str]]:
+        """Decrypts a page of ciphertexts, timed as one operation."""
+        return [self._decrypt(ciphertext) for ciphertext in ciphertexts]
+
+    def _decrypt(self, ciphertext: str) -> str or None:
         try:
             data_key, encoded_data = ciphertext.split(":", 1)
-            fernet = Fernet(data_key)
+            fernet = get_fernet(data_key)
             decrypted_data = fernet.decrypt(urlsafe_b64decode(encoded_data))
         except Exception as exception:
             logging.error(f"Decryption Error: {exception}")
@@ -25,8 +57,17 @@ class KmsClient:
 
         return decrypted_data.decode("utf-8")
 
+    @KMS_SECONDS.labels("encrypt").time()
     def encrypt(self, plaintext: str) -> str or None:
-        fernet = Fernet(self.current_data_key)
+        return self._encrypt(plaintext)
+
+    @KMS_SECONDS.labels("encrypt_many").time()
+    def encrypt_many(self, plaintexts: Iterable[str]) -> List[Optional[str]]:
+        """Encrypts a batch of plaintexts, timed as one operation."""
+        return [self._encrypt(plaintext) for plaintext in plaintexts]
+
+    def _encrypt(self, plaintext: str) -> str or None:
+        fernet = get_fernet(self.current_data_key)
 
         try:
             encrypted_data = fernet.encrypt(plaintext.encode("utf-8"))
@@ -43,7 +84,7 @@ class KmsClient:
 
         if not alias_name:
             logging.critical("Missing .env var AWS_KMS_KEY_ALIAS_NAME")
-            exit(1)
+            raise ImproperlyConfigured("Missing .env var AWS_KMS_KEY_ALIAS_NAME")
 
         try:
             response = self.client.generate_data_key(
@@ -51,7 +92,7 @@ class KmsClient:
             )
         except ClientError as error:
             logging.critical(f"Failed to generate data key: {error}")
-            exit(1)
+            raise
 
         logging.info("Created KMS data key.")
 
@@ -0,0 +1,129 @@
+import asyncio
+import json
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+from time import perf_counter
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports health and latency for every redis shard of the channel layer, "
+        "exiting with status 1 if any shard is unreachable."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--group",
+            action="append",
+            default=[],
+            dest="groups",
+            help="Group name to map to its shard, e.g. chat_room_1. Repeatable.",
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            help="Print the report as JSON.",
+        )
+        parser.add_argument(
+            "--samples",
+            default=5,
+            help="Number of PINGs sent to each shard.",
+            type=int,
+        )
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+
+        if not hasattr(channel_layer, "connection"):
+            raise CommandError(f"{channel_layer} is not a redis channel layer.")
+
+        report = asyncio.run(
+            self.check_shards(channel_layer, options["samples"], options["groups"])
+        )
+
+        failed = [shard for shard in report["shards"] if shard["status"] != "ok"]
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_report(report)
+
+        if failed:
+            raise CommandError(
+                f"{len(failed)} of {len(report['shards'])} shards are unhealthy."
+            )
+
+    def write_report(self, report: dict) -> None:
+        for shard in report["shards"]:
+            if shard["status"] != "ok":
+                self.stdout.write(
+                    self.style.ERROR(
+                        f"[{shard['index']}] {shard['host']}: {shard['error']}"
+                    )
+                )
+                continue
+
+            self.stdout.write(
+                f"[{shard['index']}] {shard['host']}: "
+                f"min={shard['latency_ms']['min']}ms "
+                f"avg={shard['latency_ms']['avg']}ms "
+                f"max={shard['latency_ms']['max']}ms "
+                f"clients={shard['connected_clients']} "
+                f"memory={shard['used_memory_human']}"
+            )
+
+        for group, index in report["groups"].items():
+            self.stdout.write(f"{group} -> shard {index}")
+
+    async def check_shard(self, channel_layer, index: int, samples: int) -> dict:
+        host = channel_layer.hosts[index]
+        shard = {
+            "host": host.get("address") or f"{host.get('host')}:{host.get('port')}",
+            "index": index,
+        }
+        connection = channel_layer.connection(index)
+        latencies = []
+
+        try:
+            for _ in range(max(samples, 1)):
+                start = perf_counter()
+                await connection.ping()
+                latencies.append((perf_counter() - start) * 1000)
+
+            info = await connection.info()
+        except Exception as exception:
+            return {**shard, "error": str(exception), "status": "error"}
+
+        return {
+            **shard,
+            "connected_clients": info.get("connected_clients"),
+            "latency_ms": {
+                "avg": round(sum(latencies) / len(latencies), 3),
+                "max": round(max(latencies), 3),
+                "min": round(min(latencies), 3),
+            },
+            "status": "ok",
+            "used_cpu_sys": info.get("used_cpu_sys"),
+            "used_cpu_user": info.get("used_cpu_user"),
+            "used_memory_human": info.get("used_memory_human"),
+        }
+
+    async def check_shards(self, channel_layer, samples: int, groups: list) -> dict:
+        try:
+            shards = await asyncio.gather(
+                *[
+                    self.check_shard(channel_layer, index, samples)
+                    for index in range(channel_layer.ring_size)
+                ]
+            )
+        finally:
+            # the pools belong to this short-lived event loop
+            await channel_layer.close_pools()
+
+        return {
+            "groups": {
+                group: channel_layer.consistent_hash(group) for group in groups
+            },
+            "shards": shards,
+        }
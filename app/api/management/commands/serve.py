@@ -0,0 +1,193 @@
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from prometheus_client import multiprocess
+from time import monotonic, sleep
+from typing import Dict, List, Optional
+
+
+def get_worker_command(fd: int, options: Dict) -> List[str]:
+    return [
+        sys.executable,
+        "-m",
+        "daphne",
+        "--fd",
+        str(fd),
+        "--proxy-headers",
+        "--application-close-timeout",
+        str(options["graceful_timeout"]),
+        "api.asgi:application",
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves the ASGI application from several daphne worker processes "
+        "sharing one listening socket. SIGHUP replaces the workers one at a "
+        "time; SIGTERM and SIGINT stop them gracefully. A stopping worker "
+        "drains its websockets over --drain-window seconds first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--port", default=8000, type=int)
+        parser.add_argument(
+            "--workers",
+            default=settings.SERVE_WORKERS or os.cpu_count() or 1,
+            help="Worker processes; defaults to SERVE_WORKERS or the CPU count.",
+            type=int,
+        )
+        parser.add_argument(
+            "--max-connections",
+            default=settings.WS_MAX_CONNECTIONS_PER_WORKER,
+            help="Open websockets per worker before new ones get 4503; 0 for no limit.",
+            type=int,
+        )
+        parser.add_argument(
+            "--drain-window",
+            default=settings.WS_DRAIN_WINDOW_SECONDS,
+            help="Seconds a stopping worker spreads closing its websockets over.",
+            type=float,
+        )
+        parser.add_argument(
+            "--graceful-timeout",
+            default=30,
+            help="Seconds a stopping worker gets after draining before it is killed.",
+            type=int,
+        )
+        parser.add_argument(
+            "--reload-warmup",
+            default=5.0,
+            help="Seconds a replacement worker runs before the old one stops.",
+            type=float,
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.pending_signal: Optional[int] = None
+        self.workers: Dict[int, subprocess.Popen] = {}
+        self.owned_metrics_dir: Optional[str] = None
+        self.sock = self.bind(options["host"], options["port"])
+        self.env = self.get_worker_env()
+
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self.on_signal)
+
+        self.stdout.write(
+            f"Serving on {options['host']}:{options['port']} with "
+            f"{options['workers']} workers."
+        )
+
+        for _ in range(options["workers"]):
+            self.spawn()
+
+        try:
+            self.supervise()
+        finally:
+            self.sock.close()
+            if self.owned_metrics_dir:
+                shutil.rmtree(self.owned_metrics_dir, ignore_errors=True)
+
+    def bind(self, host: str, port: int) -> socket.socket:
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(socket.SOMAXCONN)
+        sock.set_inheritable(True)
+        return sock
+
+    def get_worker_env(self) -> Dict[str, str]:
+        env = dict(
+            os.environ,
+            WS_DRAIN_WINDOW_SECONDS=str(self.options["drain_window"]),
+            WS_MAX_CONNECTIONS_PER_WORKER=str(self.options["max_connections"]),
+        )
+
+        # every worker's metrics have to be aggregated for /metrics
+        if self.options["workers"] > 1 and not env.get("PROMETHEUS_MULTIPROC_DIR"):
+            self.owned_metrics_dir = tempfile.mkdtemp(prefix="prometheus-")
+            env["PROMETHEUS_MULTIPROC_DIR"] = self.owned_metrics_dir
+
+        return env
+
+    def on_signal(self, signum, frame) -> None:
+        self.pending_signal = signum
+
+    def spawn(self) -> subprocess.Popen:
+        fd = self.sock.fileno()
+        worker = subprocess.Popen(
+            get_worker_command(fd, self.options), env=self.env, pass_fds=(fd,)
+        )
+        self.workers[worker.pid] = worker
+        self.stdout.write(f"Started worker {worker.pid}.")
+        return worker
+
+    def reap(self, worker: subprocess.Popen) -> None:
+        self.workers.pop(worker.pid, None)
+
+        metrics_dir = self.env.get("PROMETHEUS_MULTIPROC_DIR")
+        if metrics_dir:
+            multiprocess.mark_process_dead(worker.pid, metrics_dir)
+
+    def stop(self, workers: List[subprocess.Popen]) -> None:
+        """
+        Asks workers to drain, after which they stop themselves, and kills the
+        ones still running at the deadline.
+        """
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGUSR1)
+
+        timeout = self.options["drain_window"] + self.options["graceful_timeout"]
+        deadline = monotonic() + timeout
+
+        for worker in workers:
+            try:
+                worker.wait(max(deadline - monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.stderr.write(f"Killing worker {worker.pid}.")
+                worker.kill()
+                worker.wait()
+
+            self.reap(worker)
+
+    def reload(self) -> None:
+        # one at a time, so capacity never drops by more than one worker
+        for old in list(self.workers.values()):
+            self.spawn()
+            sleep(self.options["reload_warmup"])
+            self.stop([old])
+
+        self.stdout.write("Reloaded workers.")
+
+    def supervise(self) -> None:
+        while True:
+            signum, self.pending_signal = self.pending_signal, None
+
+            if signum == signal.SIGHUP:
+                self.reload()
+            elif signum is not None:
+                self.stdout.write("Stopping workers.")
+                self.stop(list(self.workers.values()))
+                return
+
+            for worker in list(self.workers.values()):
+                if worker.poll() is not None:
+                    self.stderr.write(
+                        f"Worker {worker.pid} exited with {worker.returncode}; "
+                        "restarting it."
+                    )
+                    self.reap(worker)
+                    # a worker that dies at boot shouldn't spin the supervisor
+                    sleep(1)
+                    self.spawn()
+
+            sleep(0.5)
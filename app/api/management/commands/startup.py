@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+
+from contextlib import ExitStack, contextmanager, suppress
+from django.apps import apps
+from django.conf import settings
+from django.contrib.staticfiles.finders import get_finders
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.utils import timezone
+from time import perf_counter, sleep
+from typing import Dict, Iterator, Optional
+
+from api.models import StartupStep
+
+
+# postgres advisory lock key shared by every container running startup
+STARTUP_LOCK_KEY = 0x74656C65
+
+
+@contextmanager
+def advisory_lock(connection, key: int) -> Iterator[bool]:
+    """
+    Holds a session-level postgres advisory lock, so containers sharing the
+    database take turns; yields whether a lock was taken. Other databases
+    run unlocked.
+    """
+    if connection.vendor != "postgresql":
+        yield False
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", [key])
+
+    try:
+        yield True
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [key])
+
+
+def find_fixture(name: str) -> str:
+    directories = [str(directory) for directory in settings.FIXTURE_DIRS]
+    directories += [
+        os.path.join(app_config.path, "fixtures")
+        for app_config in apps.get_app_configs()
+    ]
+
+    for directory in directories:
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate):
+            return candidate
+
+    raise CommandError(f"Fixture '{name}' not found.")
+
+
+def get_static_fingerprint() -> str:
+    """Hashes the path, size and mtime of every file collectstatic would copy."""
+    digest = hashlib.sha256()
+    entries = []
+
+    for finder in get_finders():
+        for path, storage in finder.list([]):
+            stat = os.stat(storage.path(path))
+            entries.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+
+    for entry in sorted(entries):
+        digest.update(entry.encode())
+
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = (
+        "Prepares the database and static files before a server starts, skipping "
+        "steps that are already up to date, and writes per-phase timings to "
+        "STARTUP_REPORT_PATH for the /ready probe."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--collectstatic",
+            action="store_true",
+            help="Also collect static files when they changed.",
+        )
+        parser.add_argument(
+            "--fixture",
+            action="append",
+            default=[],
+            dest="fixtures",
+            help="Fixture to load when its contents changed. Repeatable.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Run every step even if it looks up to date.",
+        )
+        parser.add_argument(
+            "--wait",
+            default=60.0,
+            help="Seconds to wait for the database to accept connections.",
+            type=float,
+        )
+
+    def handle(self, *args, **options):
+        self.force = options["force"]
+        self.phases: Dict[str, Dict] = {}
+        started_at = perf_counter()
+
+        # a report left by the previous run would make /ready pass too early
+        with suppress(FileNotFoundError):
+            os.remove(settings.STARTUP_REPORT_PATH)
+
+        with self.phase("database") as phase:
+            self.wait_for_database(options["wait"])
+            phase["status"] = "ready"
+
+        # the api and outbox containers start from the same entrypoint
+        with ExitStack() as stack:
+            with self.phase("lock") as phase:
+                locked = stack.enter_context(
+                    advisory_lock(connections[DEFAULT_DB_ALIAS], STARTUP_LOCK_KEY)
+                )
+                phase["status"] = "acquired" if locked else "skipped"
+
+            with self.phase("migrate") as phase:
+                phase["status"] = self.migrate()
+
+            for name in options["fixtures"]:
+                with self.phase(f"loaddata:{name}") as phase:
+                    phase["status"] = self.load_fixture(name)
+
+            if options["collectstatic"]:
+                with self.phase("collectstatic") as phase:
+                    phase["status"] = self.collect_static()
+
+        report = {
+            "finished_at": timezone.now().isoformat(),
+            "phases": self.phases,
+            "seconds": round(perf_counter() - started_at, 3),
+        }
+
+        with open(settings.STARTUP_REPORT_PATH, "w") as file:
+            json.dump(report, file)
+
+        self.stdout.write(f"Startup finished in {report['seconds']}s.")
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[Dict]:
+        phase = {"status": None}
+        start = perf_counter()
+        yield phase
+        phase["seconds"] = round(perf_counter() - start, 3)
+        self.phases[name] = phase
+        self.stdout.write(f"{name}: {phase['status']} in {phase['seconds']}s")
+
+    def is_current(self, name: str, fingerprint: str) -> bool:
+        return not self.force and StartupStep.objects.filter(
+            fingerprint=fingerprint, name=name
+        ).exists()
+
+    def wait_for_database(self, timeout: float) -> None:
+        deadline = perf_counter() + timeout
+        connection = connections[DEFAULT_DB_ALIAS]
+
+        while True:
+            try:
+                connection.ensure_connection()
+                return
+            except OperationalError as error:
+                if perf_counter() > deadline:
+                    raise CommandError(f"Database unavailable: {error}")
+
+                connection.close()
+                sleep(0.5)
+
+    def migrate(self) -> str:
+        executor = MigrationExecutor(connections[DEFAULT_DB_ALIAS])
+        plan = executor.migration_plan(executor.loader.graph.leaf_nodes())
+
+        if not plan and not self.force:
+            return "skipped"
+
+        call_command("migrate", interactive=False, verbosity=0)
+        return f"applied {len(plan)}"
+
+    def load_fixture(self, name: str) -> str:
+        with open(find_fixture(name), "rb") as file:
+            fingerprint = hashlib.sha256(file.read()).hexdigest()
+
+        step = f"loaddata:{name}"
+
+        if self.is_current(step, fingerprint):
+            return "skipped"
+
+        call_command("loaddata", name, verbosity=0)
+        StartupStep.objects.update_or_create(
+            name=step, defaults={"fingerprint": fingerprint}
+        )
+        return "loaded"
+
+    def collect_static(self) -> str:
+        # static files live in the container, so their fingerprint does too
+        fingerprint = get_static_fingerprint()
+        fingerprint_path = os.path.join(settings.STATIC_ROOT, ".startup-fingerprint")
+        previous: Optional[str] = None
+
+        if os.path.isfile(fingerprint_path):
+            with open(fingerprint_path) as file:
+                previous = file.read().strip()
+
+        if previous == fingerprint and not self.force:
+            return "skipped"
+
+        call_command("collectstatic", interactive=False, verbosity=0)
+
+        with open(fingerprint_path, "w") as file:
+            file.write(fingerprint)
+
+        return "collected"
@@ -0,0 +1,158 @@
+"""
+Prometheus metrics for the websocket and REST hot paths.
+
+When PROMETHEUS_MULTIPROC_DIR is set, every worker process writes its samples
+there and the metrics view aggregates them.
+"""
+
+from os import getenv
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+# Websocket connections
+WEBSOCKET_CONNECTS = Counter(
+    "chat_websocket_connects_total", "Accepted websocket connections."
+)
+WEBSOCKET_DISCONNECTS = Counter(
+    "chat_websocket_disconnects_total", "Closed websocket connections."
+)
+WEBSOCKET_ACTIVE_CONNECTIONS = Gauge(
+    "chat_websocket_active_connections",
+    "Currently open websocket connections.",
+    multiprocess_mode="livesum",
+)
+WEBSOCKET_REJECTED = Counter(
+    "chat_websocket_rejected_total",
+    "Websocket handshakes turned away by this worker, by reason.",
+    ("reason",),
+)
+WEBSOCKET_DRAINED = Counter(
+    "chat_websocket_drained_total",
+    "Websocket connections asked to reconnect because their worker is stopping.",
+)
+WEBSOCKET_REAPED = Counter(
+    "chat_websocket_reaped_total",
+    "Websocket connections closed for sending nothing within WS_IDLE_TIMEOUT.",
+)
+
+# ChatConsumer
+COMMAND_SECONDS = Histogram(
+    "chat_command_seconds",
+    "Time spent handling a websocket command in ChatConsumer.receive.",
+    ("command",),
+)
+DB_SECONDS = Histogram(
+    "chat_db_seconds",
+    "Time spent in a database call made on behalf of a websocket event.",
+    ("operation",),
+)
+
+# Database pool, see api.db
+DB_POOL_SIZE = Gauge(
+    "db_pool_size",
+    "Threads, and so connections, in the database pool.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_IN_USE = Gauge(
+    "db_pool_in_use",
+    "Database pool threads currently running a query.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAITING = Gauge(
+    "db_pool_waiting",
+    "Database calls queued for a free pool thread.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "db_pool_wait_seconds", "Time a database call waited for a free pool thread."
+)
+
+# Channel layer
+CHANNEL_LAYER_SECONDS = Histogram(
+    "channel_layer_seconds",
+    "Latency of channel layer group operations.",
+    ("operation",),
+)
+CHANNEL_LAYER_DELIVERIES = Counter(
+    "channel_layer_deliveries_total",
+    "Group message deliveries, split by whether they stayed in-process.",
+    ("route",),
+)
+CHANNEL_LAYER_FANOUT_WIDTH = Histogram(
+    "channel_layer_fanout_width",
+    "Number of workers a hierarchical fan-out was published to.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+CHANNEL_LAYER_FANOUT_SECONDS = Histogram(
+    "channel_layer_fanout_seconds", "Time spent publishing a hierarchical fan-out."
+)
+
+# KMS
+KMS_SECONDS = Histogram(
+    "kms_seconds", "Time spent encrypting or decrypting with KmsClient.", ("operation",)
+)
+
+# Per-event profiling, see api.profiling
+EVENT_QUERIES = Histogram(
+    "event_db_queries",
+    "Database queries run per websocket command or REST request.",
+    ("event",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+EVENT_QUERY_SECONDS = Histogram(
+    "event_db_query_seconds",
+    "Database query time per websocket command or REST request.",
+    ("event",),
+)
+
+# Email outbox, see account.outbox
+OUTBOX_EMAILS = Counter(
+    "account_outbox_emails_total",
+    "Outbox send attempts by result: sent, retried or failed.",
+    ("result",),
+)
+OUTBOX_SEND_SECONDS = Histogram(
+    "account_outbox_send_seconds", "Time spent sending one outbox email."
+)
+
+# Password hashing pool, see account.hashers
+PASSWORD_HASHING_WAITING = Gauge(
+    "account_password_hashing_waiting",
+    "Password hashes queued for a free hashing thread.",
+    multiprocess_mode="livesum",
+)
+PASSWORD_HASHING_WAIT_SECONDS = Histogram(
+    "account_password_hashing_wait_seconds",
+    "Time a password hash waited for a free hashing thread.",
+)
+PASSWORD_HASHING_SECONDS = Histogram(
+    "account_password_hashing_seconds", "Time spent computing one password hash."
+)
+PASSWORD_HASHING_REJECTED = Counter(
+    "account_password_hashing_rejected_total",
+    "Password hashes refused because the hashing pool was saturated.",
+)
+
+# REST
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds",
+    "REST request latency per view.",
+    ("view", "method", "status"),
+)
+
+
+def render_metrics() -> bytes:
+    if getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+
+    return generate_latest(REGISTRY)
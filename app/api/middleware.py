@@ -1,12 +1,23 @@
-from channels.db import database_sync_to_async
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from channels.middleware import BaseMiddleware
 from django.contrib.auth import get_user_model
 from jwt import DecodeError, ExpiredSignatureError
 import logging
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from rest_framework_simplejwt.tokens import UntypedToken
+from time import perf_counter
 from urllib.parse import parse_qs
 
+from .db import database_sync_to_async
+from .db_routers import bind_user, track_writes
+from .metrics import HTTP_REQUEST_SECONDS
+from .profiling import (
+    Profile,
+    activate_profile,
+    aprofile_stream,
+    finish_profile,
+    profile_stream,
+)
 from .websocket_codes import WS_4001_UNAUTHORIZED
 
 
@@ -54,7 +65,123 @@ class JwtAuthMiddleware(BaseMiddleware):
 
             return await self.close_connection(send, WS_4001_UNAUTHORIZED)
 
+        # the connection's writes keep this user's reads on the primary
+        bind_user(user_id)
+
         return await super().__call__(scope, receive, send)
 
     async def close_connection(self, send, code: int):
         await send({"code": code, "type": "websocket.close"})
+
+
+class SyncAndAsyncMiddleware:
+    """
+    Base for middleware that runs natively in both handlers, so ASGI requests
+    aren't switched to a thread for it. Subclasses implement both __call__
+    and __acall__.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+class TrackWritesMiddleware(SyncAndAsyncMiddleware):
+    """
+    Attributes each REST request's writes to its user, so their next reads
+    skip the replicas. JWT users are bound by api.authentication once DRF
+    authenticates them.
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        with track_writes():
+            # only looks up a session when the request has a session cookie
+            if request.user.is_authenticated:
+                bind_user(request.user.id)
+
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with track_writes():
+            user = await request.auser()
+            if user.is_authenticated:
+                bind_user(user.id)
+
+            return await self.get_response(request)
+
+
+class MetricsMiddleware(SyncAndAsyncMiddleware):
+    """Records REST latency per resolved view name."""
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        start = perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    def observe(self, request, response, start: float) -> None:
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+
+        HTTP_REQUEST_SECONDS.labels(view, request.method, response.status_code).observe(
+            perf_counter() - start
+        )
+
+
+class ProfilingMiddleware(SyncAndAsyncMiddleware):
+    """
+    Profiles each REST request under its resolved view name. A streamed body
+    counts toward its request, and the profile finishes with the stream.
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        current = Profile()
+        with activate_profile(current):
+            response = self.get_response(request)
+
+        return self.finish(request, response, current)
+
+    async def __acall__(self, request):
+        current = Profile()
+        with activate_profile(current):
+            response = await self.get_response(request)
+
+        return self.finish(request, response, current)
+
+    def finish(self, request, response, current: Profile):
+        match = request.resolver_match
+        current.name = match.view_name if match else "unmatched"
+
+        if not response.streaming:
+            finish_profile(current)
+        elif response.is_async:
+            response.streaming_content = aprofile_stream(
+                response.streaming_content, current
+            )
+        else:
+            response.streaming_content = profile_stream(
+                response.streaming_content, current
+            )
+
+        return response
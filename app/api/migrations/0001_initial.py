@@ -0,0 +1,22 @@
+# Generated by Django 5.0.6 on 2026-10-19 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StartupStep',
+            fields=[
+                ('fingerprint', models.CharField(max_length=64)),
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db.models import CharField, DateTimeField, Model
+
+
+class StartupStep(Model):
+    """
+    Fingerprint of the inputs a step of the startup command last ran with,
+    kept in the database so a fresh database reruns every step.
+    """
+
+    fingerprint = CharField(max_length=64)
+    name = CharField(max_length=255, primary_key=True)
+    updated_at = DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"StartupStep(name='{self.name}')"
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Model
+from django.utils.functional import cached_property
+from typing import Optional
+
+
+def get_estimated_count(model: type[Model], using: str) -> Optional[int]:
+    """
+    Postgres' planner estimate of a table's rows, kept fresh by autovacuum.
+    None where there is no estimate.
+    """
+    connection = connections[using]
+
+    if connection.vendor != "postgresql":
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [model._meta.db_table],
+        )
+        row = cursor.fetchone()
+
+    # -1 until the table is first analyzed
+    return row[0] if row and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for admin changelists of huge tables. An unfiltered queryset
+    larger than ESTIMATED_COUNT_THRESHOLD rows is counted from planner
+    statistics instead of a full scan; filtered and smaller querysets are
+    counted exactly.
+    """
+
+    @cached_property
+    def count(self) -> int:
+        queryset = self.object_list
+        query = getattr(queryset, "query", None)
+
+        if query is not None and not query.where and not query.distinct:
+            estimate = get_estimated_count(queryset.model, queryset.db)
+
+            if estimate is not None and estimate >= settings.ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+
+        return super().count
@@ -0,0 +1,201 @@
+"""
+Per-event profiling: database query count, query time and wall time for each
+websocket command and REST request, with optional sampled cProfile output.
+
+Queries are attributed through a context variable, so queries run by
+database_sync_to_async in channels' thread pool count toward the event that
+issued them. A profile can be activated several times before it finishes,
+which is how a streamed response's body counts toward its request.
+"""
+
+import cProfile
+import logging
+import random
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from os import makedirs, path
+from time import perf_counter, time
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional
+
+from .metrics import EVENT_QUERIES, EVENT_QUERY_SECONDS
+
+
+class Profile:
+    def __init__(self, name: Optional[str] = None) -> None:
+        self.name = name
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.statements: List[str] = []
+        self.wall_seconds = 0.0
+
+        sample_rate = settings.PROFILING_SAMPLE_RATE
+        self.profiler = (
+            cProfile.Profile()
+            if sample_rate and random.random() < sample_rate
+            else None
+        )
+
+    def __str__(self):
+        return (
+            f"Profile(name='{self.name}', queries={self.queries}, "
+            f"query_seconds={self.query_seconds:.6f}, "
+            f"wall_seconds={self.wall_seconds:.6f})"
+        )
+
+
+_current_profile: ContextVar[Optional[Profile]] = ContextVar(
+    "current_profile", default=None
+)
+
+# lists that finished profiles are appended to, see capture_profiles()
+_collectors: List[List[Profile]] = []
+
+
+def record_query(execute, sql, params, many, context):
+    profile = _current_profile.get()
+
+    if profile is None:
+        return execute(sql, params, many, context)
+
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.queries += 1
+        profile.query_seconds += perf_counter() - start
+        profile.statements.append(sql)
+
+
+def install_query_recorder(sender, connection, **kwargs) -> None:
+    """connection_created receiver, connected in ApiConfig.ready."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def capture_profiles() -> Iterator[List[Profile]]:
+    profiles: List[Profile] = []
+    _collectors.append(profiles)
+    try:
+        yield profiles
+    finally:
+        _collectors.remove(profiles)
+
+
+@contextmanager
+def profile(name: Optional[str] = None) -> Iterator[Profile]:
+    """
+    Records queries and wall time for the block. A PROFILING_SAMPLE_RATE
+    fraction of blocks also runs under cProfile; under asyncio that includes
+    every task the event loop ran in the meantime.
+    """
+    current = Profile(name)
+    try:
+        with activate_profile(current):
+            yield current
+    finally:
+        finish_profile(current)
+
+
+@contextmanager
+def activate_profile(current: Profile) -> Iterator[Profile]:
+    """Adds the block's queries and wall time to an unfinished profile."""
+    token = _current_profile.set(current)
+
+    if current.profiler is not None:
+        try:
+            current.profiler.enable()
+        except ValueError:
+            # another profiler is already active on this thread
+            current.profiler = None
+
+    start = perf_counter()
+    try:
+        yield current
+    finally:
+        current.wall_seconds += perf_counter() - start
+        _current_profile.reset(token)
+
+        if current.profiler is not None:
+            current.profiler.disable()
+
+
+def finish_profile(current: Profile) -> None:
+    if current.profiler is not None:
+        dump_profile(current.profiler, current.name)
+
+    EVENT_QUERIES.labels(current.name).observe(current.queries)
+    EVENT_QUERY_SECONDS.labels(current.name).observe(current.query_seconds)
+
+    for collector in _collectors:
+        collector.append(current)
+
+
+def profile_stream(content: Iterable[bytes], current: Profile) -> Iterator[bytes]:
+    """
+    Activates the profile while each chunk is produced, not while it is sent,
+    and finishes it with the stream.
+    """
+    iterator = iter(content)
+    try:
+        while True:
+            with activate_profile(current):
+                chunk = next(iterator, None)
+
+            if chunk is None:
+                return
+
+            yield chunk
+    finally:
+        finish_profile(current)
+
+
+async def aprofile_stream(
+    content: AsyncIterable[bytes], current: Profile
+) -> AsyncIterator[bytes]:
+    """profile_stream for async streaming responses."""
+    iterator = aiter(content)
+    try:
+        while True:
+            with activate_profile(current):
+                chunk = await anext(iterator, None)
+
+            if chunk is None:
+                return
+
+            yield chunk
+    finally:
+        finish_profile(current)
+
+
+def dump_profile(profiler: cProfile.Profile, name: Optional[str]) -> None:
+    output_dir = settings.PROFILING_OUTPUT_DIR
+    filename = f"{(name or 'event').replace(':', '_')}-{int(time() * 1000)}.prof"
+
+    try:
+        makedirs(output_dir, exist_ok=True)
+        profiler.dump_stats(path.join(output_dir, filename))
+    except OSError as error:
+        logging.error(f"Failed to write profile {filename}: {error}")
+
+
+class QueryBudgetTestMixin:
+    """TestCase mixin asserting per-event query budgets."""
+
+    @contextmanager
+    def assertQueryBudget(self, name: str, budget: int) -> Iterator[List[Profile]]:
+        with capture_profiles() as profiles:
+            yield profiles
+
+        matching = [current for current in profiles if current.name == name]
+        self.assertTrue(matching, f"No '{name}' event was profiled.")
+
+        for current in matching:
+            self.assertLessEqual(
+                current.queries,
+                budget,
+                f"{name} ran {current.queries} queries, budget is {budget}:\n"
+                + "\n".join(current.statements),
+            )
@@ -0,0 +1,47 @@
+"""
+Async redis clients for application data, sharded over REDIS_HOSTS.
+
+Keys are hashed the same way channels_redis hashes group names, so every
+host acts as a shard. redis.asyncio pools are bound to the event loop they
+were first used on, so clients are kept per loop.
+"""
+
+import asyncio
+import binascii
+
+from django.conf import settings
+from redis.asyncio import Redis
+from typing import Dict, List
+from weakref import WeakKeyDictionary
+
+
+_clients: "WeakKeyDictionary[asyncio.AbstractEventLoop, List[Redis]]" = (
+    WeakKeyDictionary()
+)
+
+
+def get_shard_index(key: str) -> int:
+    return abs(binascii.crc32(key.encode("utf8"))) % len(settings.REDIS_HOSTS)
+
+
+def get_shard(index: int) -> Redis:
+    loop = asyncio.get_running_loop()
+
+    if loop not in _clients:
+        _clients[loop] = [Redis.from_url(host) for host in settings.REDIS_HOSTS]
+
+    return _clients[loop][index]
+
+
+def get_redis(key: str) -> Redis:
+    """Returns the client for the shard that owns key."""
+    return get_shard(get_shard_index(key))
+
+
+def group_by_shard(keys: List[str]) -> Dict[int, List[str]]:
+    shards: Dict[int, List[str]] = {}
+
+    for key in keys:
+        shards.setdefault(get_shard_index(key), []).append(key)
+
+    return shards
@@ -17,6 +17,8 @@ from datetime import timedelta
 from os import getenv, path
 from pathlib import Path
 
+from api.log import parse_sample_rates
+
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,8 +45,33 @@ if is_dev or is_unit_tests:
         },
     }
 else:
-    # handle prod logging
-    pass
+    LOGGING = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "filters": {
+            "sampling": {
+                "()": "api.log.SamplingFilter",
+                # e.g. "message.created=0.01,message.sent=0.01,ws.connect=0.1"
+                "rates": parse_sample_rates(getenv("LOG_SAMPLE_RATES", "")),
+            },
+        },
+        "formatters": {
+            "json": {
+                "()": "api.log.JsonFormatter",
+            },
+        },
+        "handlers": {
+            "console": {
+                "class": "logging.StreamHandler",
+                "filters": ["sampling"],
+                "formatter": "json",
+            },
+        },
+        "root": {
+            "handlers": ["console"],
+            "level": getenv("LOG_LEVEL", "INFO"),
+        },
+    }
 
 
 # Quick-start development settings - unsuitable for production
@@ -60,13 +87,79 @@ ALLOWED_HOSTS = ["::1", "localhost"]
 
 ASGI_APPLICATION = "api.asgi.application"
 
+# Comma-separated list of redis URLs. channels_redis consistently hashes group
+# names (chat_room_*, chat_user_*) across every host, so each host listed here
+# acts as a shard for group membership and fan-out.
+REDIS_HOSTS = [
+    host.strip()
+    for host in getenv("REDIS_HOSTS", "redis://redis:6379").split(",")
+    if host.strip()
+]
+
+# HybridRedisChannelLayer delivers group messages to channels in the sending
+# process directly and only publishes to redis for channels on other workers.
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {"hosts": [("redis", "6379")]},
+        "BACKEND": getenv(
+            "CHANNEL_LAYER_BACKEND", "api.channel_layers.HybridRedisChannelLayer"
+        ),
+        "CONFIG": {
+            "capacity": int(getenv("CHANNEL_LAYER_CAPACITY", 100)),
+            "expiry": int(getenv("CHANNEL_LAYER_EXPIRY", 60)),
+            "group_expiry": int(getenv("CHANNEL_LAYER_GROUP_EXPIRY", 86400)),
+            "hosts": REDIS_HOSTS,
+        },
     }
 }
 
+if CHANNEL_LAYERS["default"]["BACKEND"] == "api.channel_layers.HybridRedisChannelLayer":
+    # Groups at least this large are published once per worker instead of once
+    # per member channel. 0 disables hierarchical fan-out.
+    CHANNEL_LAYERS["default"]["CONFIG"]["fanout_threshold"] = int(
+        getenv("CHANNEL_LAYER_FANOUT_THRESHOLD", 500)
+    )
+
+# Per-user logs of delivered events that reconnecting clients replay from
+# with resume_from=<delivery id>. Unit tests keep them in process.
+DELIVERY_LOG_BACKEND = getenv(
+    "DELIVERY_LOG_BACKEND",
+    "chat.delivery_log.LocalDeliveryLog"
+    if is_unit_tests
+    else "chat.delivery_log.RedisDeliveryLog",
+)
+DELIVERY_LOG_MAXLEN = int(getenv("DELIVERY_LOG_MAXLEN", 1000))
+DELIVERY_LOG_REPLAY_LIMIT = int(getenv("DELIVERY_LOG_REPLAY_LIMIT", 500))
+DELIVERY_LOG_TTL = int(getenv("DELIVERY_LOG_TTL", 7 * 24 * 60 * 60))
+
+# Presence: connections heartbeat every PRESENCE_HEARTBEAT_INTERVAL seconds and
+# count as gone PRESENCE_TTL seconds after the last one. Changes are published
+# per room at most once per PRESENCE_FLUSH_INTERVAL seconds.
+PRESENCE_BACKEND = getenv(
+    "PRESENCE_BACKEND",
+    "chat.presence.LocalPresenceStore"
+    if is_unit_tests
+    else "chat.presence.RedisPresenceStore",
+)
+PRESENCE_FLUSH_INTERVAL = float(getenv("PRESENCE_FLUSH_INTERVAL", 1))
+PRESENCE_HEARTBEAT_INTERVAL = float(getenv("PRESENCE_HEARTBEAT_INTERVAL", 20))
+PRESENCE_QUERY_LIMIT = int(getenv("PRESENCE_QUERY_LIMIT", 500))
+PRESENCE_TTL = int(getenv("PRESENCE_TTL", 60))
+
+# typing=true is relayed at most once per TYPING_THROTTLE_SECONDS per room and
+# user, and clients drop it after TYPING_TTL_SECONDS without a refresh.
+TYPING_THROTTLE_SECONDS = float(getenv("TYPING_THROTTLE_SECONDS", 2))
+TYPING_TTL_SECONDS = float(getenv("TYPING_TTL_SECONDS", 5))
+
+# Positive room membership checks are cached per process, and with
+# MEMBERSHIP_CACHE_SHARED also in CACHES for every worker.
+MEMBERSHIP_CACHE_LOCAL_TTL = float(getenv("MEMBERSHIP_CACHE_LOCAL_TTL", 5))
+MEMBERSHIP_CACHE_MAX_ENTRIES = int(getenv("MEMBERSHIP_CACHE_MAX_ENTRIES", 100000))
+MEMBERSHIP_CACHE_SHARED = (
+    getenv("MEMBERSHIP_CACHE_SHARED", "false" if is_unit_tests else "true").lower()
+    == "true"
+)
+MEMBERSHIP_CACHE_TTL = int(getenv("MEMBERSHIP_CACHE_TTL", 300))
+
 INSTALLED_APPS = [
     "daphne",
     "corsheaders",
@@ -78,6 +171,7 @@ INSTALLED_APPS = [
     "django.contrib.staticfiles",
     "rest_framework",
     "rest_framework_simplejwt",
+    "api",
     "account",
     "chat",
 ]
@@ -91,6 +185,9 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "api.middleware.TrackWritesMiddleware",
+    "api.middleware.MetricsMiddleware",
+    "api.middleware.ProfilingMiddleware",
 ]
 
 CORS_ALLOWED_ORIGINS = [getenv("WEB_UI_URL", "http://localhost:3000")]
@@ -139,6 +236,63 @@ elif is_unit_tests:
             "NAME": BASE_DIR / "db.sqlite3",
         }
     }
+else:
+    DATABASES = {
+        "default": {
+            "CONN_HEALTH_CHECKS": True,
+            "CONN_MAX_AGE": int(getenv("DB_CONN_MAX_AGE", 600)),
+            "ENGINE": "django.db.backends.postgresql",
+            "HOST": getenv("DB_HOST"),
+            "NAME": getenv("DB_NAME"),
+            "OPTIONS": {"connect_timeout": int(getenv("DB_CONNECT_TIMEOUT", 5))},
+            "PASSWORD": getenv("DB_PASSWORD"),
+            "PORT": getenv("DB_PORT", 5432),
+            "USER": getenv("DB_USER"),
+        }
+    }
+
+# Read replicas share the primary's name and credentials. Tests mirror them to
+# the primary so there is only one test database.
+DB_REPLICA_HOSTS = [
+    host.strip() for host in getenv("DB_REPLICA_HOSTS", "").split(",") if host.strip()
+]
+
+for index, host in enumerate(DB_REPLICA_HOSTS):
+    DATABASES[f"replica_{index}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "TEST": {"MIRROR": "default"},
+    }
+
+DATABASE_ROUTERS = ["api.db_routers.PrimaryReplicaRouter"]
+
+# Seconds a user keeps reading from the primary after writing.
+DB_REPLICA_STICKY_SECONDS = int(getenv("DB_REPLICA_STICKY_SECONDS", 5))
+# Replicas lagging further behind than this are skipped.
+DB_REPLICA_MAX_LAG_SECONDS = float(getenv("DB_REPLICA_MAX_LAG_SECONDS", 2))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(getenv("DB_REPLICA_LAG_CHECK_INTERVAL", 5))
+
+# Threads that api.db.database_sync_to_async runs queries in. Each thread keeps
+# one persistent connection, so this also caps connections per process. SQLite
+# locks tables across connections, so unit tests use a single thread.
+DB_POOL_SIZE = int(getenv("DB_POOL_SIZE", 1 if is_unit_tests else 10))
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Shared between workers so replica stickiness follows a user across them.
+
+if is_unit_tests:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": getenv("CACHE_URL", REDIS_HOSTS[0]),
+        }
+    }
 
 
 # Password validation
@@ -159,6 +313,22 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Every hash runs on a pool of PASSWORD_HASHING_WORKERS threads, see account.hashers
+PASSWORD_HASHERS = [
+    "account.hashers.PooledPBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+PASSWORD_HASHING_ITERATIONS = int(getenv("PASSWORD_HASHING_ITERATIONS", 720000))
+PASSWORD_HASHING_WORKERS = int(getenv("PASSWORD_HASHING_WORKERS", 2))
+# Callers allowed to wait for a worker before others are refused with a 503
+PASSWORD_HASHING_QUEUE_SIZE = int(getenv("PASSWORD_HASHING_QUEUE_SIZE", 8))
+
+# Seconds a reset token stays valid, checked in SQL before the token itself
+PASSWORD_RESET_TIMEOUT = int(getenv("PASSWORD_RESET_TIMEOUT", 60 * 60 * 24 * 3))
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
@@ -180,15 +350,43 @@ STATIC_ROOT = path.join(BASE_DIR, "staticfiles")
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Worker processes started by the serve command; 0 for one per CPU
+SERVE_WORKERS = int(getenv("SERVE_WORKERS", 0))
+# Open websockets per worker before new ones are closed with 4503; 0 for no limit
+WS_MAX_CONNECTIONS_PER_WORKER = int(getenv("WS_MAX_CONNECTIONS_PER_WORKER", 10000))
+# Seconds over which a stopping worker spreads closing its websockets
+WS_DRAIN_WINDOW_SECONDS = float(getenv("WS_DRAIN_WINDOW_SECONDS", 20))
+# Upper bound of the random delay drained clients are told to wait before
+# reconnecting
+WS_RECONNECT_DELAY_SECONDS = float(getenv("WS_RECONNECT_DELAY_SECONDS", 5))
+# Clients send a heartbeat at least every WS_HEARTBEAT_INTERVAL seconds, and
+# connections that sent nothing for WS_IDLE_TIMEOUT seconds are closed, their
+# groups discarded WS_REAP_BATCH_SIZE connections at a time. 0 disables reaping
+WS_HEARTBEAT_INTERVAL = float(getenv("WS_HEARTBEAT_INTERVAL", 25))
+WS_IDLE_TIMEOUT = float(getenv("WS_IDLE_TIMEOUT", 75))
+WS_REAP_BATCH_SIZE = int(getenv("WS_REAP_BATCH_SIZE", 500))
+
+# Written by the startup command and served by the /ready probe
+STARTUP_REPORT_PATH = getenv("STARTUP_REPORT_PATH", "/tmp/startup.json")
+
+# Room exports, see chat.export
+EXPORT_CHUNK_SIZE = int(getenv("EXPORT_CHUNK_SIZE", 1000))
+EXPORT_DECRYPT_WORKERS = int(getenv("EXPORT_DECRYPT_WORKERS", 4))
+
+# Unfiltered admin lists of bigger tables show Postgres' estimated row count
+ESTIMATED_COUNT_THRESHOLD = int(getenv("ESTIMATED_COUNT_THRESHOLD", 100000))
+
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "api.authentication.JWTAuthentication",
         "rest_framework.authentication.SessionAuthentication",
     ),
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 10,
 }
 
+EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+
 if is_dev:
     EMAIL_HOST = "mailhog"
     EMAIL_PORT = "1025"
@@ -199,6 +397,25 @@ else:
     # Django SES
     EMAIL_BACKEND = "django_ses.SESBackend"
 
+# e.g. django.core.mail.backends.console.EmailBackend, or
+# django.core.mail.backends.filebased.EmailBackend with EMAIL_FILE_PATH, to try
+# the outbox without sending anything
+EMAIL_BACKEND = getenv("EMAIL_BACKEND") or EMAIL_BACKEND
+EMAIL_FILE_PATH = getenv("EMAIL_FILE_PATH", "/tmp/emails")
+DEFAULT_FROM_EMAIL = getenv(
+    "DEFAULT_FROM_EMAIL", "no-reply@telegraph.ianhenderson.info"
+)
+
+# Email outbox, see account.outbox and the send_outbox command
+OUTBOX_BATCH_SIZE = int(getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_CONCURRENCY = int(getenv("OUTBOX_CONCURRENCY", 4))
+# Seconds a claimed batch is reserved for its sender before others may retry it
+OUTBOX_LEASE_SECONDS = int(getenv("OUTBOX_LEASE_SECONDS", 300))
+OUTBOX_MAX_ATTEMPTS = int(getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_POLL_INTERVAL = float(getenv("OUTBOX_POLL_INTERVAL", 2))
+OUTBOX_RETRY_BASE_SECONDS = float(getenv("OUTBOX_RETRY_BASE_SECONDS", 30))
+OUTBOX_RETRY_MAX_SECONDS = float(getenv("OUTBOX_RETRY_MAX_SECONDS", 3600))
+
 # AWS, Boto3
 boto3_session = boto3.Session(region_name=getenv("AWS_REGION"))
 AWS_ACCESS_KEY_ID = getenv("AWS_ACCESS_KEY_ID")
@@ -208,6 +425,16 @@ AWS_REGION = getenv("AWS_REGION")
 AWS_SES_REGION_NAME = getenv("AWS_REGION", "us-east-1")
 AWS_SES_REGION_ENDPOINT = getenv("AWS_SES_REGION_ENDPOINT")
 
+# Prometheus
+# Set PROMETHEUS_MULTIPROC_DIR when running more than one worker process.
+METRICS_TOKEN = getenv("METRICS_TOKEN")
+
+# Profiling
+# Fraction of websocket commands and REST requests run under cProfile. The
+# .prof files are written to PROFILING_OUTPUT_DIR.
+PROFILING_SAMPLE_RATE = float(getenv("PROFILING_SAMPLE_RATE", 0))
+PROFILING_OUTPUT_DIR = getenv("PROFILING_OUTPUT_DIR", "/tmp/profiles")
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=7),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=365),
@@ -0,0 +1,691 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from io import StringIO
+from prometheus_client import REGISTRY
+from rest_framework_simplejwt.tokens import AccessToken
+from time import monotonic, time
+from unittest.mock import AsyncMock, MagicMock, call, patch
+
+from . import db
+from .authentication import JWTAuthentication
+from .channel_layers import HybridRedisChannelLayer, LocalFanout
+from .db_routers import PrimaryReplicaRouter, bind_user, replica_reads, track_writes
+from .kms import kms_client
+from .log import JsonFormatter, SamplingFilter, parse_sample_rates
+from .middleware import TrackWritesMiddleware
+from .management.commands import serve
+from .management.commands.channel_layer_health import Command as HealthCommand
+from .management.commands.startup import Command as StartupCommand, advisory_lock
+from .models import StartupStep
+from .pagination import EstimatedCountPaginator
+
+
+class TestHybridRedisChannelLayer(TestCase):
+    def setUp(self):
+        self.layer = HybridRedisChannelLayer(hosts=["redis://localhost:6379"])
+        self.local_channel = f"specific.{self.layer.client_prefix}!abc"
+        self.remote_channel = "specific.otherprefix!abc"
+
+    def test_is_local_channel(self):
+        self.assertTrue(self.layer.is_local_channel(self.local_channel))
+        self.assertFalse(self.layer.is_local_channel(self.remote_channel))
+        self.assertFalse(self.layer.is_local_channel("plain-channel"))
+
+    def test_deliver_local(self):
+        self.layer.local_groups["chat_room_1"][self.local_channel] = time()
+        message = {"type": "message.created", "message": {"id": 1}}
+
+        self.assertEqual(self.layer.deliver_local("chat_room_1", message), 1)
+        self.assertEqual(self.layer.deliver_local("chat_room_2", message), 0)
+
+        delivered = self.layer.receive_buffer[self.local_channel].get_nowait()
+        self.assertEqual(delivered, message)
+        self.assertIsNot(delivered, message)
+        self.assertEqual(self.layer.stats["local"], 1)
+
+    def test_deliver_local_skips_expired_members(self):
+        self.layer.local_groups["chat_room_1"][self.local_channel] = (
+            time() - self.layer.group_expiry - 1
+        )
+
+        self.assertEqual(self.layer.deliver_local("chat_room_1", {"type": "test"}), 0)
+        self.assertNotIn("chat_room_1", self.layer.local_groups)
+
+    async def test_local_delivery_wakes_receive_lock_holder(self):
+        # stands in for the process's channel list in redis
+        redis_queue = asyncio.Queue()
+
+        async def receive_single(channel):
+            return await redis_queue.get()
+
+        async def send(channel, message):
+            await redis_queue.put((channel, message))
+
+        channels = [f"specific.{self.layer.client_prefix}!{name}" for name in "ab"]
+        for channel in channels:
+            self.layer.local_groups["chat_room_1"][channel] = time()
+        connection = MagicMock(eval=AsyncMock(return_value=[]))
+
+        with (
+            patch.object(self.layer, "connection", return_value=connection),
+            patch.object(self.layer, "receive_single", receive_single),
+            patch.object(self.layer, "send", send),
+        ):
+            receives = [
+                asyncio.ensure_future(self.layer.receive(channel))
+                for channel in channels
+            ]
+            # one of them now holds receive_lock, blocked on redis
+            await asyncio.sleep(0.05)
+            self.assertTrue(self.layer.receive_lock.locked())
+
+            await self.layer.group_send("chat_room_1", {"type": "test"})
+            received = await asyncio.wait_for(asyncio.gather(*receives), 1)
+
+        self.assertEqual(received, [{"type": "test"}, {"type": "test"}])
+        self.assertIsNone(self.layer.wake_sent_at)
+
+    @patch("api.channel_layers.RedisChannelLayer.group_add", new_callable=AsyncMock)
+    async def test_group_add_refreshes_workers_entry(self, group_add):
+        self.layer.fanout_threshold = 2
+        pipe = MagicMock(execute=AsyncMock())
+        connection = MagicMock(pipeline=MagicMock(return_value=pipe))
+        workers_key = self.layer._workers_key("chat_room_1")
+        later = time() + self.layer.group_expiry + 1
+
+        with patch.object(self.layer, "connection", return_value=connection):
+            await self.layer.group_add("chat_room_1", self.local_channel)
+            # a second member joining after the first entry would have aged out
+            with patch("api.channel_layers.time.time", return_value=later):
+                await self.layer.group_add(
+                    "chat_room_1", f"specific.{self.layer.client_prefix}!def"
+                )
+
+        self.assertEqual(pipe.zadd.call_count, 2)
+        pipe.zadd.assert_called_with(workers_key, {self.layer.fanout_channel: later})
+        pipe.expire.assert_called_with(workers_key, self.layer.group_expiry)
+        self.assertEqual(pipe.execute.await_count, 2)
+
+    async def test_group_discard_many(self):
+        self.layer.fanout_threshold = 2
+        other_channel = f"specific.{self.layer.client_prefix}!def"
+        self.layer.local_groups["chat_room_1"][self.local_channel] = time()
+        self.layer.local_groups["chat_room_2"][self.local_channel] = time()
+        self.layer.local_groups["chat_room_2"][other_channel] = time()
+        pipe = MagicMock(execute=AsyncMock())
+        connection = MagicMock(pipeline=MagicMock(return_value=pipe))
+
+        with patch.object(self.layer, "connection", return_value=connection):
+            await self.layer.group_discard_many(
+                [
+                    ("chat_room_1", self.local_channel),
+                    ("chat_room_2", self.local_channel),
+                    ("chat_room_3", self.remote_channel),
+                ]
+            )
+
+        self.assertEqual(
+            pipe.zrem.call_args_list,
+            [
+                call(self.layer._group_key("chat_room_1"), self.local_channel),
+                # the worker leaves the fan-out of a room it no longer serves
+                call(self.layer._workers_key("chat_room_1"), self.layer.fanout_channel),
+                call(self.layer._group_key("chat_room_2"), self.local_channel),
+                call(self.layer._group_key("chat_room_3"), self.remote_channel),
+            ],
+        )
+        self.assertNotIn("chat_room_1", self.layer.local_groups)
+        self.assertEqual(list(self.layer.local_groups["chat_room_2"]), [other_channel])
+        # one pipeline per shard, and the test layer has one shard
+        self.assertEqual(connection.pipeline.call_count, 1)
+        pipe.execute.assert_awaited_once()
+
+    async def test_group_send_reads_members_in_one_round_trip(self):
+        self.layer.fanout_threshold = 2
+        connection = MagicMock(eval=AsyncMock(return_value=None))
+
+        with (
+            patch.object(self.layer, "connection", return_value=connection),
+            patch.object(self.layer, "send_fanout", AsyncMock()) as send_fanout,
+            patch.object(self.layer, "send_remote", AsyncMock()) as send_remote,
+        ):
+            # nil from the script means the group is large
+            await self.layer.group_send("chat_room_1", {"type": "test"})
+            send_fanout.assert_awaited_once_with("chat_room_1", {"type": "test"})
+
+            connection.eval.return_value = [
+                self.local_channel.encode(),
+                self.remote_channel.encode(),
+            ]
+            await self.layer.group_send("chat_room_1", {"type": "test"})
+            send_remote.assert_awaited_once_with(
+                "chat_room_1", [self.remote_channel], {"type": "test"}
+            )
+
+        self.assertEqual(connection.eval.await_count, 2)
+        self.assertEqual(connection.eval.await_args.args[-1], 2)
+
+    def test_get_local_hit_rate(self):
+        self.assertEqual(self.layer.get_local_hit_rate(), 0.0)
+        self.layer.stats = {"local": 3, "remote": 1}
+        self.assertEqual(self.layer.get_local_hit_rate(), 0.75)
+
+    def test_fanout_envelope_delivers_locally(self):
+        self.layer.local_groups["chat_room_1"][self.local_channel] = time()
+        fanout = self.layer.receive_buffer[self.layer.fanout_channel]
+        self.assertIsInstance(fanout, LocalFanout)
+
+        fanout.put_nowait({"group": "chat_room_1", "message": {"type": "test"}})
+
+        delivered = self.layer.receive_buffer[self.local_channel].get_nowait()
+        self.assertEqual(delivered, {"type": "test"})
+        self.assertTrue(self.layer.is_local_channel(self.layer.fanout_channel))
+
+
+class TestDatabasePool(TestCase):
+    def setUp(self):
+        # a fresh executor sized by the overridden setting
+        patcher = patch.object(db, "_executor", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: db._executor and db._executor.shutdown())
+
+    def sample(self, name: str) -> float:
+        return REGISTRY.get_sample_value(name)
+
+    @override_settings(DB_POOL_SIZE=2)
+    async def test_runs_on_at_most_pool_size_threads(self):
+        lock = threading.Lock()
+        running, peak, threads = 0, 0, set()
+
+        @db.database_sync_to_async
+        def query():
+            nonlocal running, peak
+
+            with lock:
+                running += 1
+                peak = max(peak, running)
+                threads.add(threading.current_thread().name)
+
+            threading.Event().wait(0.02)
+
+            with lock:
+                running -= 1
+
+        await asyncio.gather(*[query() for _ in range(6)])
+
+        self.assertEqual(peak, 2)
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith("db-pool") for name in threads))
+        self.assertEqual(self.sample("db_pool_size"), 2)
+
+    async def test_closes_old_connections_around_each_call(self):
+        events = []
+
+        @db.database_sync_to_async
+        def query(value):
+            events.append("query")
+            return value
+
+        with patch(
+            "channels.db.close_old_connections",
+            side_effect=lambda: events.append("close"),
+        ):
+            self.assertEqual(await query(1), 1)
+            self.assertEqual(await query(2), 2)
+
+        self.assertEqual(events, ["close", "query", "close"] * 2)
+
+    @override_settings(DB_POOL_SIZE=1)
+    async def test_metrics(self):
+        release = threading.Event()
+        observed = self.sample("db_pool_wait_seconds_count")
+
+        @db.database_sync_to_async
+        def query():
+            release.wait(1)
+
+        first = asyncio.ensure_future(query())
+        second = asyncio.ensure_future(query())
+
+        async def settled():
+            while (
+                self.sample("db_pool_in_use") != 1
+                or self.sample("db_pool_waiting") != 1
+            ):
+                await asyncio.sleep(0.001)
+
+        # the second call queues behind the first on the only thread
+        await asyncio.wait_for(settled(), 1)
+
+        release.set()
+        await asyncio.gather(first, second)
+
+        self.assertEqual(self.sample("db_pool_in_use"), 0)
+        self.assertEqual(self.sample("db_pool_waiting"), 0)
+        self.assertEqual(self.sample("db_pool_wait_seconds_count"), observed + 2)
+
+
+@override_settings(ESTIMATED_COUNT_THRESHOLD=1000)
+class TestEstimatedCountPaginator(TestCase):
+    def setUp(self):
+        get_user_model().objects.create(email="user@example.com", username="user")
+
+    def get_count(self, queryset, estimate) -> int:
+        with patch("api.pagination.get_estimated_count", return_value=estimate):
+            return EstimatedCountPaginator(queryset, 10).count
+
+    def test_count(self):
+        users = get_user_model().objects.all()
+
+        self.assertEqual(self.get_count(users, 5000), 5000)
+        # small tables, missing estimates and filters are counted exactly
+        self.assertEqual(self.get_count(users, 500), 1)
+        self.assertEqual(self.get_count(users, None), 1)
+        self.assertEqual(self.get_count(users.filter(username="user"), 5000), 1)
+
+
+class TestStartup(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.report_path = os.path.join(directory.name, "startup.json")
+        override = override_settings(STARTUP_REPORT_PATH=self.report_path)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def run_startup(self) -> dict:
+        call_command("startup", fixtures=["users.yaml"], stdout=StringIO())
+
+        with open(self.report_path) as file:
+            return json.load(file)
+
+    def test_skips_up_to_date_steps(self):
+        phases = self.run_startup()["phases"]
+
+        self.assertEqual(phases["database"]["status"], "ready")
+        # advisory locks are postgres only
+        self.assertEqual(phases["lock"]["status"], "skipped")
+        self.assertEqual(phases["migrate"]["status"], "skipped")
+        self.assertEqual(phases["loaddata:users.yaml"]["status"], "loaded")
+        self.assertTrue(get_user_model().objects.filter(username="admin").exists())
+
+        phases = self.run_startup()["phases"]
+        self.assertEqual(phases["loaddata:users.yaml"]["status"], "skipped")
+
+        # a fresh database has no fingerprints and loads again
+        StartupStep.objects.all().delete()
+        phases = self.run_startup()["phases"]
+        self.assertEqual(phases["loaddata:users.yaml"]["status"], "loaded")
+
+    def test_ready(self):
+        url = reverse("ready")
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()["checks"]["startup"])
+
+        self.run_startup()
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("migrate", response.json()["startup"]["phases"])
+        self.assertTrue(kms_client.current_data_key)
+
+    def test_removes_previous_report(self):
+        self.run_startup()
+
+        with patch.object(
+            StartupCommand, "migrate", side_effect=CommandError("Migration failed.")
+        ):
+            with self.assertRaises(CommandError):
+                self.run_startup()
+
+        self.assertFalse(os.path.exists(self.report_path))
+        self.assertEqual(self.client.get(reverse("ready")).status_code, 503)
+
+    def test_advisory_lock(self):
+        connection = MagicMock(vendor="postgresql")
+        cursor = connection.cursor.return_value.__enter__.return_value
+
+        with advisory_lock(connection, 42) as locked:
+            self.assertTrue(locked)
+            cursor.execute.assert_called_once_with("SELECT pg_advisory_lock(%s)", [42])
+
+        self.assertEqual(
+            cursor.execute.call_args_list,
+            [
+                call("SELECT pg_advisory_lock(%s)", [42]),
+                call("SELECT pg_advisory_unlock(%s)", [42]),
+            ],
+        )
+
+        with advisory_lock(MagicMock(vendor="sqlite"), 42) as locked:
+            self.assertFalse(locked)
+
+
+class TestChannelLayerHealth(TestCase):
+    def setUp(self):
+        self.layer = HybridRedisChannelLayer(
+            hosts=["redis://healthy:6379", "redis://unreachable:6379"]
+        )
+        healthy = MagicMock(
+            ping=AsyncMock(),
+            info=AsyncMock(
+                return_value={"connected_clients": 3, "used_memory_human": "1M"}
+            ),
+        )
+        unreachable = MagicMock(
+            ping=AsyncMock(side_effect=ConnectionError("Connection refused."))
+        )
+        self.connections = [healthy, unreachable]
+
+        patches = [
+            patch(
+                "api.management.commands.channel_layer_health.get_channel_layer",
+                return_value=self.layer,
+            ),
+            patch.object(self.layer, "close_pools", new=AsyncMock()),
+            patch.object(
+                self.layer, "connection", side_effect=self.connections.__getitem__
+            ),
+        ]
+
+        for mock in patches:
+            mock.start()
+            self.addCleanup(mock.stop)
+
+    def test_exits_with_error_for_unreachable_shard(self):
+        stdout, stderr = StringIO(), StringIO()
+
+        with self.assertRaises(SystemExit) as context:
+            HealthCommand(stdout=stdout, stderr=stderr).run_from_argv(
+                ["manage.py", "channel_layer_health", "--samples", "2"]
+            )
+
+        self.assertEqual(context.exception.code, 1)
+        self.assertEqual(self.connections[0].ping.await_count, 2)
+        self.assertIn("[0] redis://healthy:6379: min=", stdout.getvalue())
+        self.assertIn("clients=3", stdout.getvalue())
+        self.assertIn(
+            "[1] redis://unreachable:6379: Connection refused.", stdout.getvalue()
+        )
+        self.assertIn("1 of 2 shards are unhealthy.", stderr.getvalue())
+        self.layer.close_pools.assert_awaited_once()
+
+    def test_closes_pools_when_healthy(self):
+        self.connections[1] = self.connections[0]
+        stdout = StringIO()
+
+        call_command("channel_layer_health", "--json", stdout=stdout)
+
+        report = json.loads(stdout.getvalue())
+        self.assertEqual([shard["status"] for shard in report["shards"]], ["ok", "ok"])
+        self.layer.close_pools.assert_awaited_once()
+
+
+class TestServe(TestCase):
+    def setUp(self):
+        self.workers = []
+        self.handlers = {}
+        self.signals = []
+
+        patches = [
+            patch.object(serve.signal, "signal", side_effect=self.handlers.__setitem__),
+            patch.object(serve, "sleep", side_effect=self.sleep),
+        ]
+
+        for mock in patches:
+            mock.start()
+            self.addCleanup(mock.stop)
+
+    def popen(self, command, env, pass_fds):
+        worker = MagicMock(pid=1000 + len(self.workers), returncode=None)
+        worker.poll.return_value = None
+        self.workers.append(worker)
+        return worker
+
+    def sleep(self, seconds):
+        # signals are delivered between supervisor loops
+        if seconds == 0.5 and self.signals:
+            self.handlers[signal.SIGTERM](self.signals.pop(0), None)
+
+    def serve(self, *args):
+        call_command(
+            "serve", "--port", "0", *args, stdout=StringIO(), stderr=StringIO()
+        )
+
+    def test_spawns_workers_on_shared_socket(self):
+        self.signals = [signal.SIGTERM]
+
+        with patch.object(serve.subprocess, "Popen", side_effect=self.popen) as popen:
+            self.serve("--workers", "3")
+
+        self.assertEqual(len(self.workers), 3)
+        fds = {popen_call.kwargs["pass_fds"] for popen_call in popen.call_args_list}
+        self.assertEqual(len(fds), 1)
+        (fd,) = fds.pop()
+
+        for popen_call in popen.call_args_list:
+            command = popen_call.args[0]
+            self.assertEqual(command[command.index("--fd") + 1], str(fd))
+
+        # stopping drains every worker, which then exits on its own
+        for worker in self.workers:
+            worker.send_signal.assert_called_once_with(signal.SIGUSR1)
+            worker.kill.assert_not_called()
+
+    def test_reload_replaces_workers_one_at_a_time(self):
+        self.signals = [signal.SIGHUP, signal.SIGTERM]
+        events = []
+
+        def popen(*args, **kwargs):
+            worker = self.popen(*args, **kwargs)
+            worker.send_signal.side_effect = lambda signum: events.append(
+                ("stop", worker.pid)
+            )
+            events.append(("spawn", worker.pid))
+            return worker
+
+        with patch.object(serve.subprocess, "Popen", side_effect=popen):
+            self.serve("--workers", "2", "--reload-warmup", "0")
+
+        self.assertEqual(
+            events,
+            [
+                ("spawn", 1000),
+                ("spawn", 1001),
+                # each replacement is up before the worker it replaces stops
+                ("spawn", 1002),
+                ("stop", 1000),
+                ("spawn", 1003),
+                ("stop", 1001),
+                ("stop", 1002),
+                ("stop", 1003),
+            ],
+        )
+
+    def test_stop_kills_workers_after_timeout(self):
+        self.signals = [signal.SIGTERM]
+        stuck = []
+
+        def popen(*args, **kwargs):
+            worker = self.popen(*args, **kwargs)
+            worker.wait.side_effect = [subprocess.TimeoutExpired("daphne", 3), 0]
+            stuck.append(worker)
+            return worker
+
+        with patch.object(serve.subprocess, "Popen", side_effect=popen):
+            self.serve(
+                "--workers", "1", "--drain-window", "1", "--graceful-timeout", "2"
+            )
+
+        (worker,) = stuck
+        worker.send_signal.assert_called_once_with(signal.SIGUSR1)
+        # the deadline covers the drain window plus the graceful timeout
+        (timeout,) = worker.wait.call_args_list[0].args
+        self.assertAlmostEqual(timeout, 3, delta=0.5)
+        worker.kill.assert_called_once_with()
+        self.assertEqual(worker.wait.call_args_list[1], call())
+
+
+class TestMetricsView(TestCase):
+    def test_metrics(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"chat_websocket_connects_total", response.content)
+        self.assertIn(b"http_request_seconds", response.content)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class TestStructuredLogging(TestCase):
+    def make_record(self, level=logging.INFO, **extra) -> logging.LogRecord:
+        record = logging.LogRecord(
+            "chat.consumers", level, __file__, 1, "Created %s.", ("room",), None
+        )
+        record.__dict__.update(extra)
+        return record
+
+    def test_parse_sample_rates(self):
+        self.assertEqual(
+            parse_sample_rates("message.created=0.01, ws.connect=0.5,,bad"),
+            {"message.created": 0.01, "ws.connect": 0.5},
+        )
+        self.assertEqual(parse_sample_rates(""), {})
+
+    def test_json_formatter(self):
+        payload = json.loads(
+            JsonFormatter().format(self.make_record(event="room.created"))
+        )
+        self.assertEqual(payload["message"], "Created room.")
+        self.assertEqual(payload["event"], "room.created")
+        self.assertEqual(payload["level"], "INFO")
+        self.assertEqual(payload["logger"], "chat.consumers")
+
+    def test_sampling_filter(self):
+        sampling_filter = SamplingFilter({"message.created": 0.0})
+        self.assertFalse(
+            sampling_filter.filter(self.make_record(event="message.created"))
+        )
+        self.assertTrue(sampling_filter.filter(self.make_record(event="ws.connect")))
+        self.assertTrue(sampling_filter.filter(self.make_record()))
+        self.assertTrue(
+            sampling_filter.filter(
+                self.make_record(level=logging.ERROR, event="message.created")
+            )
+        )
+
+
+class TestPrimaryReplicaRouter(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = PrimaryReplicaRouter()
+        self.router.replicas = ["replica_0"]
+        self.router.lag_monitor.lags["replica_0"] = (monotonic(), 0.0)
+
+    def test_reads_use_primary_outside_replica_reads(self):
+        self.assertEqual(self.router.db_for_read(None), "default")
+
+    def test_reads_use_replica_inside_replica_reads(self):
+        with replica_reads():
+            self.assertEqual(self.router.db_for_read(None), "replica_0")
+
+    def test_lagging_replica_falls_back_to_primary(self):
+        self.router.lag_monitor.lags["replica_0"] = (monotonic(), 60.0)
+
+        with replica_reads():
+            self.assertEqual(self.router.db_for_read(None), "default")
+
+    def test_reads_stick_to_primary_after_write(self):
+        with replica_reads():
+            bind_user(1)
+            self.assertEqual(self.router.db_for_write(None), "default")
+            self.assertEqual(self.router.db_for_read(None), "default")
+
+            bind_user(2)
+            self.assertEqual(self.router.db_for_read(None), "replica_0")
+
+    def test_replica_reads_resets_bound_user(self):
+        with replica_reads():
+            bind_user(1)
+
+        self.router.db_for_write(None)
+        self.assertIsNone(cache.get("db:recent_write:1"))
+
+    def test_track_writes_records_once(self):
+        with patch("api.db_routers.cache.set") as cache_set:
+            with track_writes():
+                bind_user(1)
+                for _ in range(3):
+                    self.router.db_for_write(None)
+
+                cache_set.assert_not_called()
+
+            cache_set.assert_called_once_with("db:recent_write:1", True, 5)
+
+            # the bound user doesn't outlive the block
+            cache_set.reset_mock()
+            self.router.db_for_write(None)
+            cache_set.assert_not_called()
+
+    def test_requests_bind_their_user(self):
+        user = get_user_model().objects.create_user(
+            email="user@example.com", password="password", username="user"
+        )
+        request = RequestFactory().get(
+            "/", HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}"
+        )
+        request.user = AnonymousUser()
+
+        def write(request):
+            JWTAuthentication().authenticate(request)
+            self.router.db_for_write(None)
+            return HttpResponse()
+
+        TrackWritesMiddleware(write)(request)
+
+        self.assertTrue(cache.get(f"db:recent_write:{user.id}"))
+
+    async def test_async_requests_bind_their_user(self):
+        user = await get_user_model().objects.acreate(
+            email="user@example.com", username="user"
+        )
+        request = RequestFactory().get(
+            "/", HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}"
+        )
+        request.auser = AsyncMock(return_value=AnonymousUser())
+
+        def write(request):
+            JWTAuthentication().authenticate(request)
+            self.router.db_for_write(None)
+            return HttpResponse()
+
+        middleware = TrackWritesMiddleware(sync_to_async(write))
+
+        # runs in the ASGI handler without a thread of its own
+        self.assertTrue(iscoroutinefunction(middleware))
+        await middleware(request)
+
+        self.assertTrue(cache.get(f"db:recent_write:{user.id}"))
@@ -18,9 +18,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from .views import metrics, ready
+
 
 urlpatterns = [
     path("account/", include("account.urls")),
     path("chat/", include("chat.urls")),
     path("admin/", admin.site.urls),
+    path("metrics", metrics, name="metrics"),
+    path("ready", ready, name="ready"),
 ]
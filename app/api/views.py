@@ -0,0 +1,62 @@
+import json
+import logging
+
+from django.conf import settings
+from django.db import connection
+from django.http import (
+    HttpRequest,
+    HttpResponse,
+    HttpResponseForbidden,
+    JsonResponse,
+)
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from .kms import kms_client
+from .metrics import render_metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def metrics(request: HttpRequest) -> HttpResponse:
+    token = settings.METRICS_TOKEN
+
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponseForbidden()
+
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE_LATEST)
+
+
+def ready(request: HttpRequest) -> JsonResponse:
+    """
+    Readiness probe: the startup command finished, the database answers and a
+    KMS data key is loaded, so the first message isn't the one to wait for it.
+    """
+    checks = {}
+    startup = None
+
+    try:
+        with open(settings.STARTUP_REPORT_PATH) as file:
+            startup = json.load(file)
+        checks["startup"] = True
+    except (OSError, ValueError):
+        checks["startup"] = False
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        checks["database"] = True
+    except Exception as exception:
+        logger.warning("Readiness database check failed: %s", exception)
+        checks["database"] = False
+
+    try:
+        checks["kms"] = bool(kms_client.current_data_key)
+    except Exception as exception:
+        logger.warning("Readiness KMS check failed: %s", exception)
+        checks["kms"] = False
+
+    return JsonResponse(
+        {"checks": checks, "startup": startup},
+        status=200 if all(checks.values()) else 503,
+    )
@@ -1,2 +1,4 @@
 WS_4000_BAD_REQUEST = 4000
 WS_4001_UNAUTHORIZED = 4001
+WS_4408_REQUEST_TIMEOUT = 4408
+WS_4503_SERVICE_UNAVAILABLE = 4503
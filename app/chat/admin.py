@@ -1,14 +1,31 @@
-from django.contrib.admin import ModelAdmin, register, StackedInline
+from django.contrib.admin import ModelAdmin, display, register, StackedInline
+from django.contrib.admin.views.main import ChangeList
 
+from api.pagination import EstimatedCountPaginator
 from .models import Message, Room, RoomMembership
 
 
+class MessageChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        # one batch for the visible page instead of a decrypt per cell
+        Message.decrypt_contents(self.result_list)
+
+
+class LargeTableAdmin(ModelAdmin):
+    """Skips exact counts, which scan the whole table on every page view."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 @register(Message)
-class MessageAdmin(ModelAdmin):
+class MessageAdmin(LargeTableAdmin):
     fields = (
         "id",
         "sender",
         "room",
+        "seq",
         "content",
         "created_at",
         "display_room_members",
@@ -16,10 +33,12 @@ class MessageAdmin(ModelAdmin):
     list_display = (
         "id",
         "sender",
-        "content",
+        "display_content",
         "room",
+        "seq",
         "display_room_members",
     )
+    list_select_related = ("room", "sender")
     readonly_fields = (
         "content",
         "created_at",
@@ -27,21 +46,41 @@ class MessageAdmin(ModelAdmin):
         "id",
         "room",
         "sender",
+        "seq",
     )
 
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related("room__members")
+
+    @display(description="Content")
+    def display_content(self, message: Message):
+        return message.content
+
 
 class MemberInline(StackedInline):
     extra = 0
     model = Room.members.through
+    raw_id_fields = ("user",)
 
 
 @register(Room)
-class RoomAdmin(ModelAdmin):
+class RoomAdmin(LargeTableAdmin):
     inlines = (MemberInline,)
     list_display = ("id", "display_members", "created_at")
-    readonly_fields = ("id", "created_at")
+    readonly_fields = ("id", "created_at", "last_seq")
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related("members")
 
 
 @register(RoomMembership)
-class RoomMembershipAdmin(ModelAdmin):
+class RoomMembershipAdmin(LargeTableAdmin):
     list_display = ("id", "room", "user", "display_room_members", "date_joined")
+    list_select_related = ("room", "user")
+    raw_id_fields = ("room", "user")
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related("room__members")
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from .signals import invalidate_membership
+
+        # bulk_create sends no signals; Room.add_members invalidates itself
+        post_delete.connect(invalidate_membership, sender="chat.RoomMembership")
+        post_save.connect(invalidate_membership, sender="chat.RoomMembership")
@@ -2,31 +2,88 @@ import asyncio
 import json
 import logging
 
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from math import inf
 from rest_framework.serializers import ValidationError
-from typing import List, Optional
-
-from .models import Room
-from .serializers import MessageSerializer, RoomSerializer
+from time import monotonic
+from typing import Dict, List, Optional, Set
+from urllib.parse import parse_qs
+
+from api.connections import connection_registry
+from api.db import database_sync_to_async
+from api.metrics import (
+    COMMAND_SECONDS,
+    DB_SECONDS,
+    WEBSOCKET_ACTIVE_CONNECTIONS,
+    WEBSOCKET_CONNECTS,
+    WEBSOCKET_DISCONNECTS,
+)
+from api.profiling import profile
+from api.websocket_codes import WS_4408_REQUEST_TIMEOUT, WS_4503_SERVICE_UNAVAILABLE
+from .delivery_log import get_delivery_log
+from .membership import membership_cache
+from .models import Message, Room, RoomMembership
+from .presence import get_presence_tracker
+from .serializers import (
+    AddMembersSerializer,
+    MessageSerializer,
+    QueryPresenceSerializer,
+    RoomSerializer,
+    TypingSerializer,
+)
 from .utils import RoomManager
 
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    # maps websocket command types to handler method names
+    commands = {
+        "add.members": "handle_add_members",
+        "create.message": "handle_create_message",
+        "heartbeat": "handle_heartbeat",
+        "query.presence": "handle_query_presence",
+        "typing": "handle_typing",
+    }
     room_manager = RoomManager()
+    # set when the reaper already discarded this connection's groups
+    groups_discarded = False
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # ids of the messages sent while replaying, to drop live duplicates
+        self.replayed_ids: Set[int] = set()
+        # ids of the rooms this connection's channel is subscribed to; the
+        # room manager is keyed by username and shared by the user's other
+        # connections, which drop its entries when they disconnect
+        self.room_ids: Set[int] = set()
+        # maps room ids to when this connection last sent typing=true there
+        self.typing_sent_at: Dict[int, float] = {}
 
     async def connect(self) -> None:
+        with profile("ws:connect"):
+            await self.subscribe()
+
+    async def subscribe(self) -> None:
         await self.accept()
+        connection_registry.register(self)
+        WEBSOCKET_CONNECTS.inc()
+        WEBSOCKET_ACTIVE_CONNECTIONS.inc()
         user = self.get_user()
-        logging.info(f"Accepted websocket connection for {user}.")
+        logger.info(
+            "Accepted websocket connection for %s.", user, extra={"event": "ws.connect"}
+        )
 
         rooms_ids = await self.get_user_room_ids()
         for room_id in rooms_ids:
             self.room_manager.register(room_id, usernames=[user.username])
+        self.room_ids.update(rooms_ids)
 
         # adds room groups
         tasks = [
@@ -45,53 +102,75 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await asyncio.gather(*tasks)
         except Exception as exception:
             error = "Failed to add groups"
-            logging.error(f"{error}: {exception}")
+            logger.error("%s: %s", error, exception, extra={"event": "ws.connect"})
             await self.send_error(error + ".")
             return await self.close()
 
-        logging.info(f"Subscribed to groups for {user}.")
+        logger.info(
+            "Subscribed to groups for %s.", user, extra={"event": "ws.subscribe"}
+        )
+        get_presence_tracker().connected(user.username, self.channel_name, rooms_ids)
+
+        # Live events queue up behind the replay, so nothing falls in between.
+        resume_from = parse_qs(self.scope["query_string"].decode()).get("resume_from")
+        if resume_from:
+            await self.replay_deliveries(resume_from[0])
+
+    @database_sync_to_async
+    @DB_SECONDS.labels("add_room_members").time()
+    def add_room_members(self, room: Room, usernames: List[str]) -> List[str]:
+        memberships = room.add_members(User.objects.filter(username__in=usernames))
+        return [membership.user.username for membership in memberships]
 
     @database_sync_to_async
-    def create_message(self, message_data: object) -> (str, object):
+    @DB_SECONDS.labels("create_message").time()
+    def create_message(self, message_data: object) -> object:
         serializer = MessageSerializer(data=message_data)
         serializer.is_valid(raise_exception=True)
-        message = serializer.save()
-        return str(message), serializer.data
+        serializer.save()
+        return serializer.data
 
     @database_sync_to_async
+    @DB_SECONDS.labels("create_room").time()
     def create_room(self, usernames: List[str]) -> Optional[Room]:
-        users_query = User.objects.filter(username__in=usernames)
-        member_ids = [user.id for user in users_query]
-        serializer = RoomSerializer(data={"member_ids": member_ids})
+        serializer = RoomSerializer(data={"usernames": usernames})
         serializer.is_valid(raise_exception=True)
         return serializer.save()
 
     async def disconnect(self, close_code) -> None:
+        connection_registry.unregister(self)
+        WEBSOCKET_DISCONNECTS.inc()
+        WEBSOCKET_ACTIVE_CONNECTIONS.dec()
         user = self.get_user()
-        logging.info(f"Disconnected websocket connection for {user}.")
+        logger.info(
+            "Disconnected websocket connection for %s.",
+            user,
+            extra={"event": "ws.disconnect"},
+        )
+        get_presence_tracker().disconnected(user.username, self.channel_name)
 
-        # discards room groups
+        # discards room groups and the user group, unless the reaper did
+        group_names = [] if self.groups_discarded else self.get_group_names()
         tasks = [
             self.channel_layer.group_discard(name, self.channel_name)
-            for name in self.room_manager.get_user_room_names(user.username)
+            for name in group_names
         ]
 
-        # discards user group
-        tasks.append(
-            self.channel_layer.group_discard(
-                self.get_user_group_name(), self.channel_name
-            )
-        )
-
         try:
             await asyncio.gather(*tasks)
         except Exception as exception:
-            return logging.error(f"Failed to discard groups for {user}: {exception}")
+            return logger.error(
+                "Failed to discard groups for %s: %s",
+                user,
+                exception,
+                extra={"event": "ws.disconnect"},
+            )
 
         self.room_manager.remove_user(user.username)
-        logging.info(f"Discarded groups for {user}.")
+        logger.info("Discarded groups for %s.", user, extra={"event": "ws.disconnect"})
 
     @database_sync_to_async
+    @DB_SECONDS.labels("get_room").time()
     def get_room(
         self, room_id: Optional[int], usernames: List[str] = []
     ) -> Optional[Room]:
@@ -100,6 +179,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
             room = Room.objects.filter(id=room_id).first()
         return room or Room.get_room_by_usernames(usernames)
 
+    def get_group_names(self) -> List[str]:
+        """The room groups and the user group this connection is in."""
+        return [
+            self.room_manager.create_name(room_id) for room_id in self.room_ids
+        ] + [self.get_user_group_name()]
+
     def get_user(self) -> User:
         return self.scope["user"]
 
@@ -107,8 +192,189 @@ class ChatConsumer(AsyncWebsocketConsumer):
         return f"chat_user_{username or self.get_user().username}"
 
     @database_sync_to_async
+    @DB_SECONDS.labels("get_room_mate_usernames").time()
+    def get_room_mate_usernames(self, usernames: List[str]) -> List[str]:
+        """The given usernames of users who share a room with the logged-in user."""
+        return list(
+            RoomMembership.objects.filter(
+                room__memberships__user=self.get_user(), user__username__in=usernames
+            )
+            .values_list("user__username", flat=True)
+            .distinct()
+        )
+
+    async def get_room_usernames(self, room: Room) -> List[str]:
+        usernames = membership_cache.get_cached_usernames(room.id)
+        if usernames is None:
+            usernames = await self.load_room_usernames(room)
+        return usernames
+
+    @database_sync_to_async
+    @DB_SECONDS.labels("get_user_room_ids").time()
     def get_user_room_ids(self) -> list[int]:
-        return [membership.room.id for membership in self.get_user().memberships.all()]
+        return list(self.get_user().memberships.values_list("room_id", flat=True))
+
+    async def handle_add_members(self, payload: object):
+        serializer = AddMembersSerializer(data=payload)
+
+        if not serializer.is_valid():
+            warning = "Provide a room_id and a list of usernames."
+            logger.warning(warning, extra={"event": "room.members.added"})
+            return await self.send_warning(warning)
+
+        room_id = serializer.validated_data["room_id"]
+        usernames = serializer.validated_data["usernames"]
+        room = await self.get_room(room_id)
+
+        if not room or not await self.is_user_member_of_room(room):
+            warning = "Logged-in user is not member of room."
+            logger.warning(warning, extra={"event": "room.members.added"})
+            return await self.send_warning(warning)
+
+        try:
+            added = await self.add_room_members(room, usernames)
+        except Exception as exception:
+            error = "Failed to add members"
+            logger.error(
+                "%s: %s", error, exception, extra={"event": "room.members.added"}
+            )
+            return await self.send_error(error + ".")
+
+        logger.info(
+            "Added %d members to %s.",
+            len(added),
+            room,
+            extra={"event": "room.members.added"},
+        )
+
+        if not added:
+            return
+
+        # Existing members hear about it through the room group, new members
+        # through their own groups, which also subscribes them to the room.
+        event = {"type": "room.members.added", "room": room.id, "usernames": added}
+        tasks = [
+            self.channel_layer.group_send(self.room_manager.create_name(room.id), event)
+        ]
+        tasks += [
+            self.channel_layer.group_send(self.get_user_group_name(username), event)
+            for username in added
+        ]
+
+        try:
+            await asyncio.gather(*tasks)
+        except Exception as exception:
+            error = "Failed to send room.members.added event to group(s)"
+            logger.error(
+                "%s: %s", error, exception, extra={"event": "room.members.added"}
+            )
+            return await self.send_error(error + ".")
+
+    async def handle_heartbeat(self, payload: object):
+        # receive() already counted the frame; the reply lets the client tell
+        # a dead server from a quiet one
+        await self.send_event(
+            {"type": "heartbeat", "interval": settings.WS_HEARTBEAT_INTERVAL}
+        )
+
+    async def handle_query_presence(self, payload: object):
+        """
+        Reports whether each queried user is online. Only users who share a
+        room with the logged-in user are reported; the others are left out.
+        """
+        serializer = QueryPresenceSerializer(data=payload)
+
+        if not serializer.is_valid():
+            warning = "Provide a list of usernames."
+            logger.warning(warning, extra={"event": "presence.query"})
+            return await self.send_warning(warning)
+
+        usernames = serializer.validated_data["usernames"]
+
+        if len(usernames) > settings.PRESENCE_QUERY_LIMIT:
+            warning = f"At most {settings.PRESENCE_QUERY_LIMIT} usernames per query."
+            logger.warning(warning, extra={"event": "presence.query"})
+            return await self.send_warning(warning)
+
+        try:
+            usernames = await self.get_room_mate_usernames(usernames)
+            statuses = await get_presence_tracker().get_statuses(usernames)
+        except Exception as exception:
+            error = "Failed to query presence"
+            logger.error("%s: %s", error, exception, extra={"event": "presence.query"})
+            return await self.send_error(error + ".")
+
+        await self.send_event(
+            {
+                "type": "presence.statuses",
+                "statuses": {
+                    username: "online" if online else "offline"
+                    for username, online in statuses.items()
+                },
+            }
+        )
+
+    async def handle_typing(self, payload: object):
+        """
+        Relays typing state to the room without touching the database:
+        membership comes from the rooms this connection subscribed to, and
+        typing=true is sent at most once per TYPING_THROTTLE_SECONDS per room
+        and user, however many connections the user has open. Clients hide
+        the indicator after expires_in seconds without a refresh.
+        """
+        serializer = TypingSerializer(data=payload)
+
+        if not serializer.is_valid():
+            warning = "Provide a room_id and a boolean typing."
+            logger.warning(warning, extra={"event": "typing"})
+            return await self.send_warning(warning)
+
+        room_id = serializer.validated_data["room_id"]
+        typing = serializer.validated_data["typing"]
+        user = self.get_user()
+
+        if room_id not in self.room_ids:
+            warning = "Logged-in user is not member of room."
+            logger.warning(warning, extra={"event": "typing"})
+            return await self.send_warning(warning)
+
+        now = monotonic()
+        throttle_key = f"typing:{room_id}:{user.username}"
+
+        try:
+            if typing:
+                # checked locally first, so repeats cost no cache round trip
+                if now - self.typing_sent_at.get(room_id, -inf) < (
+                    settings.TYPING_THROTTLE_SECONDS
+                ):
+                    return
+                self.typing_sent_at[room_id] = now
+
+                # another connection of the user may have sent it already
+                if not await cache.aadd(
+                    throttle_key, True, settings.TYPING_THROTTLE_SECONDS
+                ):
+                    return
+            # stopping is never throttled, and the next start goes straight out
+            elif self.typing_sent_at.pop(room_id, None) is None:
+                return
+            else:
+                await cache.adelete(throttle_key)
+
+            await self.channel_layer.group_send(
+                self.room_manager.create_name(room_id),
+                {
+                    "type": "typing.indicator",
+                    "expires_in": settings.TYPING_TTL_SECONDS,
+                    "room": room_id,
+                    "typing": typing,
+                    "username": user.username,
+                },
+            )
+        except Exception as exception:
+            error = "Failed to send typing event"
+            logger.error("%s: %s", error, exception, extra={"event": "typing"})
+            return await self.send_error(error + ".")
 
     async def handle_create_message(self, payload: object):
         message_data = payload.get("message")
@@ -121,9 +387,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         room = await self.get_room(room_id, usernames)
 
-        if room and not await self.is_user_member_of_room(room):
+        if room:
+            usernames = await self.get_room_usernames(room)
+
+        if room and user.username not in usernames:
             warning = "Logged-in user is not member of room."
-            logging.warning(warning)
+            logger.warning(warning, extra={"event": "message.created"})
             return await self.send_warning(warning)
 
         new_room = False
@@ -133,91 +402,231 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 room = await self.create_room(usernames)
             except ValidationError as error:
                 message = "Failed to create room"
-                logging.error(f"{message}: {error}")
+                logger.error("%s: %s", message, error, extra={"event": "room.created"})
                 return await self.send_error(message + ".")
 
-            logging.info(f"Created {room}.")
+            logger.info("Created %s.", room, extra={"event": "room.created"})
             new_room = True
+            # prefetched by create_room, so this skips unknown usernames for free
+            usernames = [member.username for member in room.members.all()]
 
         message_data["room"] = room.id
         message_data["sender_id"] = user.id
         message_data["_content"] = message_data["content"]
 
         try:
-            message_str, message = await self.create_message(message_data)
+            message = await self.create_message(message_data)
         except (Exception, ValidationError) as exception:
             error = "Failed to create message"
-            logging.error(f"{error}: {exception}")
+            logger.error("%s: %s", error, exception, extra={"event": "message.created"})
             return await self.send_error(error + ".")
 
-        logging.info(f"Created {message_str}.")
-        message_payload = {"type": "message.created", "message": message}
-        tasks = []
+        logger.info(
+            "Created message %s in room %s.",
+            message["id"],
+            room.id,
+            extra={"event": "message.created"},
+        )
+        message_payload = {
+            "type": "message.created",
+            # the same for every recipient, see chat.delivery_log
+            "delivery_id": str(message["id"]),
+            "message": message,
+        }
+        # logged before the send, so a client resuming in between replays it
+        await self.record_deliveries(usernames, message["id"])
 
         # Send new message to users' individual channels if the room is new.
         if new_room:
-            for username in usernames:
-                tasks.append(
-                    self.channel_layer.group_send(
-                        self.get_user_group_name(username), message_payload
-                    )
+            tasks = [
+                self.channel_layer.group_send(
+                    self.get_user_group_name(username), message_payload
                 )
+                for username in usernames
+            ]
         # Otherwise, send new message to existing room group.
         else:
-            tasks.append(
+            tasks = [
                 self.channel_layer.group_send(
                     self.room_manager.get_name(room.id), message_payload
                 )
-            )
+            ]
 
         try:
             await asyncio.gather(*tasks)
         except Exception as exception:
             error = "Failed to send message.created event to group(s)"
-            logging.error(f"{error}: {exception}")
+            logger.error("%s: %s", error, exception, extra={"event": "message.sent"})
             return await self.send_error(error + ".")
 
-        logging.info(f"Sent {message_str} to groups.")
+        logger.info(
+            "Sent message %s to groups.", message["id"], extra={"event": "message.sent"}
+        )
+
+    async def is_user_member_of_room(self, room: Room) -> bool:
+        return membership_cache.is_cached_member(
+            self.get_user().id, room.id
+        ) or await self.load_is_user_member_of_room(room)
 
     @database_sync_to_async
-    def is_user_member_of_room(self, room: Room) -> bool:
-        return self.get_user() in room.members.all()
+    @DB_SECONDS.labels("is_user_member_of_room").time()
+    def load_is_user_member_of_room(self, room: Room) -> bool:
+        return membership_cache.is_member(self.get_user().id, room.id)
 
-    # magically called by parent class AsyncWebsocketConsumer via event.type
-    async def message_created(self, event: dict) -> None:
-        await self.send_event(event)
+    @database_sync_to_async
+    @DB_SECONDS.labels("get_room_usernames").time()
+    def load_room_usernames(self, room: Room) -> List[str]:
+        return membership_cache.get_usernames(room.id)
 
-        message = event.get("message", {})
-        room_id = message.get("room", None)
+    async def join_room_group(self, room_id: int) -> None:
         user = self.get_user()
 
-        # Early exit if user already associated with room
-        if self.room_manager.user_is_in_room(user.username, room_id):
+        # Early exit if connection already subscribed to room
+        if room_id in self.room_ids:
             return
 
         # Registers user with new room
         self.room_manager.register(room_id=room_id, usernames=[user.username])
+        self.room_ids.add(room_id)
         room_name = self.room_manager.get_name(room_id)
         try:
             await self.channel_layer.group_add(room_name, self.channel_name)
         except Exception as exception:
             error = f"Failed to add group '{room_name}' to {user}"
-            logging.error(f"{error}: {exception}")
+            logger.error("%s: %s", error, exception, extra={"event": "ws.subscribe"})
             return await self.send_error(error + ".")
 
-        logging.info(f"Added new room group for {user}.")
+        get_presence_tracker().joined_room(user.username, room_id)
+        logger.info(
+            "Added new room group for %s.", user, extra={"event": "ws.subscribe"}
+        )
+
+    # magically called by parent class AsyncWebsocketConsumer via event.type
+    async def message_created(self, event: dict) -> None:
+        if event["message"]["id"] in self.replayed_ids:
+            return
+
+        await self.send_event(event)
+        await self.join_room_group(event.get("message", {}).get("room", None))
+
+    async def record_deliveries(self, usernames: List[str], message_id: int) -> None:
+        """
+        Appends message_id to every recipient's delivery log. A failure only
+        costs resumability, so the message is still sent live.
+        """
+        try:
+            await get_delivery_log().append(usernames, message_id)
+        except Exception as exception:
+            logger.error(
+                "Failed to record deliveries: %s",
+                exception,
+                extra={"event": "delivery.recorded"},
+            )
+
+    @database_sync_to_async
+    @DB_SECONDS.labels("load_messages").time()
+    def load_messages(self, message_ids: List[int]) -> List[dict]:
+        """Serializes the messages in the order of message_ids."""
+        messages = Message.objects.filter(id__in=message_ids).select_related("sender")
+        by_id = {message.id: message for message in messages}
+        # deleted messages are skipped
+        ordered = [by_id[id] for id in message_ids if id in by_id]
+        Message.decrypt_contents(ordered)
+        return MessageSerializer(ordered, many=True).data
+
+    async def replay_deliveries(self, resume_from: str) -> None:
+        user = self.get_user()
+        limit = settings.DELIVERY_LOG_REPLAY_LIMIT
+
+        try:
+            message_ids = await get_delivery_log().read(
+                user.username, int(resume_from), limit
+            )
+            messages = await self.load_messages(message_ids)
+        except Exception as exception:
+            logger.error(
+                "Failed to replay deliveries for %s: %s",
+                user,
+                exception,
+                extra={"event": "delivery.replayed"},
+            )
+            return await self.send_error("Failed to resume.")
+
+        for message in messages:
+            await self.send_event(
+                {
+                    "type": "message.created",
+                    "delivery_id": str(message["id"]),
+                    "message": message,
+                }
+            )
+            self.replayed_ids.add(message["id"])
+
+        # the client has to fall back to the REST history for the rest
+        if len(message_ids) >= limit:
+            await self.send_event(
+                {"type": "resume.truncated", "delivery_id": str(message_ids[-1])}
+            )
+
+        logger.info(
+            "Replayed %d deliveries for %s.",
+            len(messages),
+            user,
+            extra={"event": "delivery.replayed"},
+        )
+
+    async def room_members_added(self, event: dict) -> None:
+        await self.send_event(event)
+
+        if self.get_user().username in event["usernames"]:
+            await self.join_room_group(event["room"])
+
+    async def connection_drain(self, event: dict) -> None:
+        """
+        Sent by api.connections while this worker stops. Everything queued
+        before it has been sent, so the client can reconnect with resume_from
+        after delay seconds without missing events.
+        """
+        await self.send_event({"type": "reconnect", "delay": event["delay"]})
+        await self.close(code=WS_4503_SERVICE_UNAVAILABLE)
+
+    async def reap(self, groups_discarded: bool) -> None:
+        """
+        Called by api.connections when the client sent nothing for
+        WS_IDLE_TIMEOUT seconds. disconnect() follows once the close completes
+        or times out.
+        """
+        self.groups_discarded = groups_discarded
+        logger.info(
+            "Closing idle websocket connection for %s.",
+            self.get_user(),
+            extra={"event": "ws.reap"},
+        )
+        await self.close(code=WS_4408_REQUEST_TIMEOUT)
+
+    async def presence_diff(self, event: dict) -> None:
+        await self.send_event(event)
+
+    async def typing_indicator(self, event: dict) -> None:
+        # the typist's own connections don't need their indicator back
+        if event["username"] != self.get_user().username:
+            await self.send_event(event)
 
     async def receive(self, text_data):
+        connection_registry.touch(self.channel_name)
         message = json.loads(text_data)
         command_type = message.get("type")
         payload = message.get("payload")
 
-        if command_type == "create.message":
-            return await self.handle_create_message(payload)
+        handler_name = self.commands.get(command_type)
+
+        if handler_name is None:
+            warning = f"{command_type} isn't a valid command."
+            logger.warning(warning, extra={"event": "ws.receive"})
+            return await self.send_warning(warning)
 
-        warning = f"{command_type} isn't a valid command."
-        logging.warning(warning)
-        await self.send_warning(warning)
+        with profile(f"ws:{command_type}"), COMMAND_SECONDS.labels(command_type).time():
+            await getattr(self, handler_name)(payload)
 
     async def send_error(self, error: str) -> None:
         await self.send(text_data=json.dumps({"error": error}))
@@ -0,0 +1,120 @@
+"""
+Per-user log of delivered messages, so a client that reconnects with
+resume_from=<delivery id> can replay what it missed while offline.
+
+A message's delivery id is its id, the same for every recipient. Each
+recipient's capped log holds the ids of the messages sent to them in the
+order they were sent; the messages themselves, and their encrypted content,
+stay in the database and are re-read on resume. RedisDeliveryLog keeps the
+logs in redis streams shared by all workers; LocalDeliveryLog is an
+in-process stand-in for development and tests.
+"""
+
+import asyncio
+import collections
+
+from abc import ABC, abstractmethod
+from django.conf import settings
+from django.utils.module_loading import import_string
+from typing import Deque, Dict, List
+
+from api.redis_client import get_redis, get_shard, group_by_shard
+
+
+_delivery_logs: Dict[str, "DeliveryLog"] = {}
+
+
+def get_delivery_log() -> "DeliveryLog":
+    path = settings.DELIVERY_LOG_BACKEND
+
+    if path not in _delivery_logs:
+        _delivery_logs[path] = import_string(path)()
+
+    return _delivery_logs[path]
+
+
+def get_missed(logged: List[int], after: int, limit: int) -> List[int]:
+    """
+    Returns up to limit ids logged after the id after. Ids are logged in send
+    order, which concurrent writers can make differ from id order, so the
+    position of after in the log counts, and id order is only the fallback
+    once it was trimmed from the log.
+    """
+    try:
+        missed = logged[logged.index(after) + 1 :]
+    except ValueError:
+        missed = [message_id for message_id in logged if message_id > after]
+
+    return missed[:limit]
+
+
+class DeliveryLog(ABC):
+    @abstractmethod
+    async def append(self, usernames: List[str], message_id: int) -> None:
+        """Appends message_id to each user's log."""
+
+    @abstractmethod
+    async def read(self, username: str, after: int, limit: int) -> List[int]:
+        """Returns up to limit message ids logged for username after the id after."""
+
+
+class LocalDeliveryLog(DeliveryLog):
+    """
+    Keeps each user's log in a bounded deque in this process.
+
+    Attributes:
+        logs (Dict[str, Deque[int]]):
+            A dictionary mapping usernames to their most recent
+            DELIVERY_LOG_MAXLEN message ids.
+    """
+
+    def __init__(self) -> None:
+        self.logs: Dict[str, Deque[int]] = collections.defaultdict(
+            lambda: collections.deque(maxlen=settings.DELIVERY_LOG_MAXLEN)
+        )
+
+    async def append(self, usernames: List[str], message_id: int) -> None:
+        for username in usernames:
+            self.logs[username].append(message_id)
+
+    async def read(self, username: str, after: int, limit: int) -> List[int]:
+        return get_missed(list(self.logs.get(username, ())), after, limit)
+
+
+class RedisDeliveryLog(DeliveryLog):
+    """
+    Keeps each user's log in a redis stream capped at roughly
+    DELIVERY_LOG_MAXLEN entries that expires DELIVERY_LOG_TTL seconds after
+    the last append. Appends are pipelined per shard.
+    """
+
+    def get_key(self, username: str) -> str:
+        return f"delivery_log:{username}"
+
+    async def append(self, usernames: List[str], message_id: int) -> None:
+        async def append_to_shard(index: int, shard_keys: List[str]) -> None:
+            pipe = get_shard(index).pipeline(transaction=False)
+
+            for key in shard_keys:
+                pipe.xadd(
+                    key,
+                    {"message": message_id},
+                    approximate=True,
+                    maxlen=settings.DELIVERY_LOG_MAXLEN,
+                )
+                pipe.expire(key, settings.DELIVERY_LOG_TTL)
+
+            await pipe.execute()
+
+        shards = group_by_shard([self.get_key(username) for username in usernames])
+        await asyncio.gather(
+            *[append_to_shard(index, keys) for index, keys in shards.items()]
+        )
+
+    async def read(self, username: str, after: int, limit: int) -> List[int]:
+        # the log is capped, so reading all of it stays cheap
+        entries = await get_redis(self.get_key(username)).xrange(
+            self.get_key(username)
+        )
+        logged = [int(fields[b"message"]) for _, fields in entries]
+        return get_missed(logged, after, limit)
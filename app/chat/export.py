@@ -0,0 +1,154 @@
+"""
+Streaming export of a room's history as newline-delimited JSON.
+
+Messages are read EXPORT_CHUNK_SIZE at a time by seq keyset on the
+(room, seq) unique index, so no chunk costs more than the first and no
+transaction stays open for the whole export. Each chunk is split into
+EXPORT_DECRYPT_WORKERS slices that are decrypted and encoded on a thread
+pool while the next chunk is fetched. Memory stays at about two chunks
+whatever the size of the room.
+
+aexport_room does the same for StreamingHttpResponse under ASGI, which would
+otherwise collect a synchronous iterator into memory before sending it. Only
+the fetches run on the database pool; the decrypt slices are awaited on the
+event loop, so a long export doesn't hold a pool thread while it decrypts.
+"""
+
+import asyncio
+import json
+import math
+import threading
+import zlib
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.conf import settings
+from typing import AsyncIterator, Iterator, List, Optional
+
+from api.db import database_sync_to_async
+from api.kms import kms_client
+from .models import Message
+
+
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.EXPORT_DECRYPT_WORKERS,
+                thread_name_prefix="export",
+            )
+
+    return _executor
+
+
+def fetch_chunk(room_id: int, after_seq: int, size: int, using: str) -> List[Message]:
+    return list(
+        Message.objects.using(using)
+        .filter(room_id=room_id, seq__gt=after_seq)
+        .select_related("sender")
+        .only("created_at", "id", "room_id", "sender__username", "seq", "_content")
+        .order_by("seq")[:size]
+    )
+
+
+def encode_messages(messages: List[Message]) -> bytes:
+    contents = kms_client.decrypt_many(message._content for message in messages)
+    lines = [
+        json.dumps(
+            {
+                "id": message.id,
+                "seq": message.seq,
+                "created_at": message.created_at.isoformat(),
+                "sender": message.sender.username,
+                "content": content,
+            },
+            separators=(",", ":"),
+        )
+        for message, content in zip(messages, contents)
+    ]
+    return "".join(f"{line}\n" for line in lines).encode()
+
+
+def submit_chunk(messages: List[Message]) -> List[Future]:
+    """Encodes the chunk in EXPORT_DECRYPT_WORKERS slices on the export pool."""
+    # contiguous slices keep seq order when joined
+    step = max(math.ceil(len(messages) / settings.EXPORT_DECRYPT_WORKERS), 1)
+    return [
+        get_executor().submit(encode_messages, messages[start : start + step])
+        for start in range(0, len(messages), step)
+    ]
+
+
+def get_compressor(compress: bool):
+    return zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+
+
+def export_room(
+    room_id: int,
+    using: str = "default",
+    chunk_size: Optional[int] = None,
+    compress: bool = False,
+) -> Iterator[bytes]:
+    """Yields the room's messages in seq order as NDJSON, gzipped if compress."""
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    compressor = get_compressor(compress)
+    after_seq = 0
+    pending: List[Future] = []
+
+    while True:
+        messages = fetch_chunk(room_id, after_seq, chunk_size, using)
+        submitted = submit_chunk(messages)
+
+        if pending:
+            data = b"".join(future.result() for future in pending)
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+
+        if not messages:
+            break
+
+        after_seq = messages[-1].seq
+        pending = submitted
+
+    if compressor:
+        yield compressor.flush()
+
+
+async def aexport_room(
+    room_id: int,
+    using: str = "default",
+    chunk_size: Optional[int] = None,
+    compress: bool = False,
+) -> AsyncIterator[bytes]:
+    """export_room for async callers."""
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    compressor = get_compressor(compress)
+    fetch = database_sync_to_async(fetch_chunk)
+    after_seq = 0
+    pending: List[Future] = []
+
+    while True:
+        messages = await fetch(room_id, after_seq, chunk_size, using)
+        submitted = submit_chunk(messages)
+
+        if pending:
+            parts = await asyncio.gather(*map(asyncio.wrap_future, pending))
+            data = b"".join(parts)
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+
+        if not messages:
+            break
+
+        after_seq = messages[-1].seq
+        pending = submitted
+
+    if compressor:
+        yield compressor.flush()
@@ -0,0 +1,256 @@
+import asyncio
+import json
+import math
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from time import perf_counter
+from typing import Dict, List
+
+from chat.models import Room, RoomMembership
+
+
+User = get_user_model()
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 10000},
+    }
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of values; 0.0 when there are none."""
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "max": round(max(values, default=0.0), 3),
+        "mean": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulates N users across M rooms against ChatConsumer and reports "
+        "connect time, send-to-receive latency and throughput as JSON. Runs "
+        "against a throwaway test database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--layer",
+            choices=("memory", "settings"),
+            default="memory",
+            help="Use an in-memory channel layer or the one from CHANNEL_LAYERS.",
+        )
+        parser.add_argument(
+            "--messages", default=5, help="Messages sent per user.", type=int
+        )
+        parser.add_argument("--output", help="Write the JSON report to this path.")
+        parser.add_argument("--rooms", default=10, help="Number of rooms.", type=int)
+        parser.add_argument(
+            "--settle",
+            default=5.0,
+            help="Maximum seconds to wait after connecting for group subscriptions.",
+            type=float,
+        )
+        parser.add_argument(
+            "--timeout",
+            default=30.0,
+            help="Seconds to wait for every delivery before giving up.",
+            type=float,
+        )
+        parser.add_argument("--users", default=50, help="Number of users.", type=int)
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(
+            autoclobber=True, serialize=False, verbosity=0
+        )
+
+        try:
+            rooms = self.create_fixtures(options["users"], options["rooms"])
+            overrides = {}
+
+            if options["layer"] == "memory":
+                overrides["CHANNEL_LAYERS"] = IN_MEMORY_CHANNEL_LAYERS
+
+            with override_settings(**overrides):
+                report = asyncio.run(self.run_benchmark(rooms, options))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def create_fixtures(self, user_count: int, room_count: int) -> Dict[int, List]:
+        password = make_password(None)
+        users = User.objects.bulk_create(
+            [
+                User(
+                    email=f"bench{index}@example.com",
+                    password=password,
+                    username=f"bench{index}",
+                )
+                for index in range(user_count)
+            ]
+        )
+        rooms = Room.objects.bulk_create([Room() for _ in range(room_count)])
+        members = {
+            room.id: users[index::room_count] for index, room in enumerate(rooms)
+        }
+
+        RoomMembership.objects.bulk_create(
+            [
+                RoomMembership(room_id=room_id, user=user)
+                for room_id, room_users in members.items()
+                for user in room_users
+            ]
+        )
+
+        return {room_id: users for room_id, users in members.items() if users}
+
+    async def wait_for_subscriptions(self, expected: int, timeout: float) -> None:
+        """
+        connect() returns on accept, before the consumer has joined its groups.
+        The in-memory layer can be polled for that; other layers just wait.
+        """
+        from channels.layers import get_channel_layer
+
+        channel_layer = get_channel_layer()
+        deadline = perf_counter() + timeout
+
+        while perf_counter() < deadline:
+            groups = getattr(channel_layer, "groups", None)
+            if groups is not None and (
+                sum(len(channels) for channels in groups.values()) >= expected
+            ):
+                return
+            await asyncio.sleep(0.01)
+
+    async def run_benchmark(self, rooms: Dict[int, List], options: dict) -> dict:
+        from api.asgi import application
+
+        sent_at: Dict[str, float] = {}
+        latencies: List[float] = []
+        # every member of a room receives every message sent to it
+        expected = options["messages"] * sum(
+            len(users) ** 2 for users in rooms.values()
+        )
+        received = asyncio.Event()
+
+        async def connect(user):
+            token = str(AccessToken.for_user(user))
+            communicator = WebsocketCommunicator(
+                application,
+                f"/ws/chat?token={token}",
+                headers=[(b"origin", b"http://localhost")],
+            )
+            start = perf_counter()
+            connected, _ = await communicator.connect(timeout=options["timeout"])
+            return communicator, connected, (perf_counter() - start) * 1000
+
+        async def read(communicator):
+            while True:
+                try:
+                    data = json.loads(await communicator.receive_from(timeout=3600))
+                except Exception:
+                    return
+
+                message = data.get("event", {}).get("message", {})
+                key = message.get("content")
+
+                if key in sent_at:
+                    latencies.append((perf_counter() - sent_at[key]) * 1000)
+                    if len(latencies) >= expected:
+                        received.set()
+
+        async def send(communicator, user, room_id):
+            for index in range(options["messages"]):
+                key = f"{user.username}:{index}"
+                sent_at[key] = perf_counter()
+                await communicator.send_json_to(
+                    {
+                        "type": "create.message",
+                        "payload": {"message": {"content": key, "room_id": room_id}},
+                    }
+                )
+
+        members = [
+            (user, room_id) for room_id, users in rooms.items() for user in users
+        ]
+        connections = await asyncio.gather(*[connect(user) for user, _ in members])
+        communicators = [communicator for communicator, _, _ in connections]
+        connect_times = [elapsed for _, connected, elapsed in connections if connected]
+        readers = [
+            asyncio.create_task(read(communicator)) for communicator in communicators
+        ]
+
+        await self.wait_for_subscriptions(len(members) * 2, options["settle"])
+
+        start = perf_counter()
+        await asyncio.gather(
+            *[
+                send(communicator, user, room_id)
+                for communicator, (user, room_id) in zip(communicators, members)
+            ]
+        )
+
+        timed_out = False
+        if expected:
+            try:
+                await asyncio.wait_for(received.wait(), timeout=options["timeout"])
+            except asyncio.TimeoutError:
+                timed_out = True
+
+        duration = perf_counter() - start
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(
+            *[communicator.disconnect() for communicator in communicators],
+            return_exceptions=True,
+        )
+
+        messages_sent = len(sent_at)
+
+        return {
+            "config": {
+                "layer": options["layer"],
+                "messages_per_user": options["messages"],
+                "rooms": len(rooms),
+                "users": len(members),
+            },
+            "connect_ms": summarize(connect_times),
+            "connections_failed": len(members) - len(connect_times),
+            "deliveries_expected": expected,
+            "deliveries_per_second": round(len(latencies) / duration, 3),
+            "deliveries_received": len(latencies),
+            "duration_seconds": round(duration, 3),
+            "latency_ms": summarize(latencies),
+            "messages_per_second": round(messages_sent / duration, 3),
+            "messages_sent": messages_sent,
+            "timed_out": timed_out,
+        }
@@ -0,0 +1,57 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import export_room
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = "Writes a room's full message history as newline-delimited JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("room_id", type=int)
+        parser.add_argument(
+            "--chunk-size",
+            default=settings.EXPORT_CHUNK_SIZE,
+            help="Messages fetched per query.",
+            type=int,
+        )
+        parser.add_argument(
+            "--database",
+            default="default",
+            help="Database alias to read from, e.g. a replica.",
+        )
+        parser.add_argument(
+            "--gzip", action="store_true", help="Gzip-compress the output."
+        )
+        parser.add_argument(
+            "--output", default="-", help="File to write to; - for stdout."
+        )
+
+    def handle(self, *args, **options):
+        room_id = options["room_id"]
+
+        if not Room.objects.using(options["database"]).filter(id=room_id).exists():
+            raise CommandError(f"Room '{room_id}' does not exist.")
+
+        chunks = export_room(
+            room_id,
+            using=options["database"],
+            chunk_size=options["chunk_size"],
+            compress=options["gzip"],
+        )
+
+        if options["output"] == "-":
+            output = sys.stdout.buffer
+            for chunk in chunks:
+                output.write(chunk)
+            output.flush()
+            return
+
+        with open(options["output"], "wb") as output:
+            for chunk in chunks:
+                output.write(chunk)
+
+        self.stderr.write(f"Exported room '{room_id}' to {options['output']}.")
@@ -0,0 +1,305 @@
+import csv
+import json
+import math
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Model
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from io import StringIO
+from itertools import islice
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from api.kms import kms_client
+from chat.membership import membership_cache
+from chat.models import Message, Room, RoomMembership
+
+
+User = get_user_model()
+
+Record = Dict[str, Optional[str]]
+
+MODELS = {
+    "users": User,
+    "rooms": Room,
+    "memberships": RoomMembership,
+    "messages": Message,
+}
+FIELDS = {
+    "users": "id, email, username, first_name, last_name, password, date_joined",
+    "rooms": "id, created_at",
+    "memberships": "room_id, user_id or username, date_joined",
+    "messages": "room_id, sender_id or sender (a username), content, created_at",
+}
+
+
+def read_records(path: str, format: str) -> Iterator[Record]:
+    with open(path, newline="") as file:
+        if format == "csv":
+            # CSV has no nulls, so empty cells stand in for them
+            for row in csv.DictReader(file):
+                yield {key: value or None for key, value in row.items()}
+            return
+
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def batched(records: Iterable[Record], size: int) -> Iterator[List[Record]]:
+    iterator = iter(records)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def parse_timestamp(value: Optional[str]) -> datetime:
+    if not value:
+        return timezone.now()
+
+    parsed = parse_datetime(value)
+
+    if parsed is None:
+        raise CommandError(f"Invalid timestamp '{value}'.")
+
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def copy_objects(objs: List[Model]) -> None:
+    """Writes objs, which must all be of one model, with a single COPY."""
+    model = type(objs[0])
+    has_ids = objs[0].pk is not None
+    fields = [
+        field
+        for field in model._meta.concrete_fields
+        if has_ids or not field.primary_key
+    ]
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    for obj in objs:
+        row = []
+        for field in fields:
+            value = field.get_db_prep_save(getattr(obj, field.attname), connection)
+            row.append(r"\N" if value is None else value)
+        writer.writerow(row)
+
+    buffer.seek(0)
+    quote_name = connection.ops.quote_name
+    columns = ", ".join(quote_name(field.column) for field in fields)
+
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {quote_name(model._meta.db_table)} ({columns}) "
+            r"FROM STDIN WITH (FORMAT csv, NULL '\N')",
+            buffer,
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk loads users, rooms, memberships or messages from NDJSON or CSV. "
+        "Uses COPY on Postgres and bulk_create elsewhere, where auto_now_add "
+        "timestamps are set to the import time. Fields: "
+        + "; ".join(f"{kind}: {fields}" for kind, fields in FIELDS.items())
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=tuple(FIELDS))
+        parser.add_argument("path", help="NDJSON or CSV file with one record per row.")
+        parser.add_argument(
+            "--batch-size",
+            default=5000,
+            help="Records written per COPY or bulk_create.",
+            type=int,
+        )
+        parser.add_argument(
+            "--format",
+            choices=("csv", "ndjson"),
+            help="Defaults to csv for .csv files and ndjson otherwise.",
+        )
+        parser.add_argument(
+            "--no-copy",
+            action="store_true",
+            help="Use bulk_create even on Postgres.",
+        )
+        parser.add_argument(
+            "--workers",
+            default=4,
+            help="Threads encrypting message content.",
+            type=int,
+        )
+
+    def handle(self, *args, **options):
+        kind = options["kind"]
+        format = options["format"] or (
+            "csv" if options["path"].endswith(".csv") else "ndjson"
+        )
+        build = getattr(self, f"build_{kind}")
+        self.use_copy = connection.vendor == "postgresql" and not options["no_copy"]
+        self.skipped = 0
+        self.workers = max(options["workers"], 1)
+        has_ids = False
+        imported = 0
+        start = perf_counter()
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="import") as executor:
+            self.executor = executor
+
+            for batch in batched(
+                read_records(options["path"], format), options["batch_size"]
+            ):
+                # a message batch's seqs are only taken if the batch commits
+                with transaction.atomic():
+                    objs = build(batch)
+                    if objs:
+                        self.insert(objs)
+
+                has_ids = has_ids or any(obj.pk is not None for obj in objs)
+                imported += len(objs)
+                self.stderr.write(f"Imported {imported} {kind}.", ending="\r")
+
+        if has_ids:
+            self.reset_sequences(MODELS[kind])
+
+        self.stdout.write(
+            f"Imported {imported} {kind} in {perf_counter() - start:.1f}s, "
+            f"skipped {self.skipped}."
+        )
+
+    def insert(self, objs: List[Model]) -> None:
+        if self.use_copy:
+            copy_objects(objs)
+        else:
+            type(objs[0]).objects.bulk_create(objs)
+
+    def reset_sequences(self, model: type[Model]) -> None:
+        """Moves the id sequence past imported ids, so later inserts don't collide."""
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                cursor.execute(sql)
+
+    def get_user_ids(
+        self, batch: List[Record], id_key: str, name_key: str
+    ) -> Dict[str, int]:
+        """Looks up the ids of the batch's users given by username."""
+        usernames = {record.get(name_key) for record in batch if not record.get(id_key)}
+        return dict(
+            User.objects.filter(username__in=usernames).values_list("username", "id")
+        )
+
+    def resolve_user_id(
+        self, record: Record, id_key: str, name_key: str, user_ids: Dict[str, int]
+    ) -> Optional[int]:
+        if record.get(id_key):
+            return int(record[id_key])
+
+        user_id = user_ids.get(record.get(name_key))
+
+        if user_id is None:
+            self.skipped += 1
+
+        return user_id
+
+    def build_users(self, batch: List[Record]) -> List[User]:
+        # imported users without a password hash have to reset it
+        password = make_password(None)
+
+        return [
+            User(
+                date_joined=parse_timestamp(record.get("date_joined")),
+                email=record["email"],
+                first_name=record.get("first_name") or "",
+                id=record.get("id"),
+                last_name=record.get("last_name") or "",
+                password=record.get("password") or password,
+                username=record["username"],
+            )
+            for record in batch
+        ]
+
+    def build_rooms(self, batch: List[Record]) -> List[Room]:
+        return [
+            Room(
+                created_at=parse_timestamp(record.get("created_at")),
+                id=record.get("id"),
+            )
+            for record in batch
+        ]
+
+    def build_memberships(self, batch: List[Record]) -> List[RoomMembership]:
+        user_ids = self.get_user_ids(batch, "user_id", "username")
+        memberships = []
+
+        for record in batch:
+            user_id = self.resolve_user_id(record, "user_id", "username", user_ids)
+
+            if user_id is not None:
+                memberships.append(
+                    RoomMembership(
+                        date_joined=parse_timestamp(record.get("date_joined")),
+                        room_id=int(record["room_id"]),
+                        user_id=user_id,
+                    )
+                )
+
+        # bulk loads send no post_save for chat.signals to act on
+        rooms: Dict[int, List[int]] = {}
+        for membership in memberships:
+            rooms.setdefault(membership.room_id, []).append(membership.user_id)
+        for room_id, room_user_ids in rooms.items():
+            membership_cache.invalidate(room_id, room_user_ids)
+
+        return memberships
+
+    def build_messages(self, batch: List[Record]) -> List[Message]:
+        user_ids = self.get_user_ids(batch, "sender_id", "sender")
+        messages = []
+
+        for record in batch:
+            sender_id = self.resolve_user_id(record, "sender_id", "sender", user_ids)
+
+            if sender_id is not None:
+                messages.append(
+                    Message(
+                        _content=record.get("content") or "",
+                        created_at=parse_timestamp(record.get("created_at")),
+                        room_id=int(record["room_id"]),
+                        sender_id=sender_id,
+                    )
+                )
+
+        # contiguous slices, encrypted in parallel
+        step = max(math.ceil(len(messages) / self.workers), 1)
+        slices = [
+            [message._content for message in messages[start : start + step]]
+            for start in range(0, len(messages), step)
+        ]
+        contents = [
+            content
+            for encrypted in self.executor.map(kms_client.encrypt_many, slices)
+            for content in encrypted
+        ]
+
+        # one allocation per room; seqs follow the order of the input
+        next_seqs = {}
+
+        for room_id, count in Counter(m.room_id for m in messages).items():
+            try:
+                next_seqs[room_id] = Room.allocate_seq(room_id, count) - count + 1
+            except Room.DoesNotExist as exception:
+                raise CommandError(str(exception))
+
+        for message, content in zip(messages, contents):
+            message._content = content
+            message.seq = next_seqs[message.room_id]
+            next_seqs[message.room_id] += 1
+
+        return messages
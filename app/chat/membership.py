@@ -0,0 +1,126 @@
+"""
+Cached room membership checks.
+
+Entries live in a per-process dict for MEMBERSHIP_CACHE_LOCAL_TTL seconds
+and, with MEMBERSHIP_CACHE_SHARED, in Django's cache for MEMBERSHIP_CACHE_TTL
+seconds so workers share them. Only positive answers are cached: a user
+who just joined a room is never refused because of a stale entry, and a
+non-member costs one EXISTS query. RoomMembership changes invalidate both
+layers on commit; other processes' local entries expire within
+MEMBERSHIP_CACHE_LOCAL_TTL.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from time import monotonic
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .models import RoomMembership
+
+
+def get_member_key(room_id: int, user_id: int) -> str:
+    return f"membership:{room_id}:{user_id}"
+
+
+def get_usernames_key(room_id: int) -> str:
+    return f"membership:{room_id}:usernames"
+
+
+class MembershipCache:
+    """
+    Attributes:
+        local (Dict[str, Tuple[float, Any]]):
+            A dictionary mapping cache keys to when they expire and their
+            values, oldest first.
+    """
+
+    def __init__(self) -> None:
+        self.local: Dict[str, Tuple[float, Any]] = {}
+
+    def clear(self) -> None:
+        self.local.clear()
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.get_local(key)
+
+        if value is None and settings.MEMBERSHIP_CACHE_SHARED:
+            value = cache.get(key)
+            if value is not None:
+                self.set_local(key, value)
+
+        return value
+
+    def get_local(self, key: str) -> Optional[Any]:
+        expires_at, value = self.local.get(key, (0.0, None))
+        return value if expires_at > monotonic() else None
+
+    def set(self, key: str, value: Any) -> None:
+        self.set_local(key, value)
+
+        if settings.MEMBERSHIP_CACHE_SHARED:
+            cache.set(key, value, settings.MEMBERSHIP_CACHE_TTL)
+
+    def set_local(self, key: str, value: Any) -> None:
+        self.local.pop(key, None)
+
+        # evicts the oldest entries first
+        while len(self.local) >= settings.MEMBERSHIP_CACHE_MAX_ENTRIES:
+            self.local.pop(next(iter(self.local)))
+
+        self.local[key] = (monotonic() + settings.MEMBERSHIP_CACHE_LOCAL_TTL, value)
+
+    def get_cached_usernames(self, room_id: int) -> Optional[List[str]]:
+        """Local lookup only, for async callers avoiding a thread hop."""
+        return self.get_local(get_usernames_key(room_id))
+
+    def get_usernames(self, room_id: int) -> List[str]:
+        key = get_usernames_key(room_id)
+        usernames = self.get(key)
+
+        if usernames is None:
+            usernames = list(
+                RoomMembership.objects.filter(room_id=room_id).values_list(
+                    "user__username", flat=True
+                )
+            )
+            if usernames:
+                self.set(key, usernames)
+
+        return usernames
+
+    def invalidate(self, room_id: int, user_ids: Iterable[int]) -> None:
+        """Drops the room's entries for the users once the transaction commits."""
+        keys = [get_usernames_key(room_id)]
+        keys += [get_member_key(room_id, user_id) for user_id in user_ids]
+
+        def delete():
+            for key in keys:
+                self.local.pop(key, None)
+
+            if settings.MEMBERSHIP_CACHE_SHARED:
+                cache.delete_many(keys)
+
+        transaction.on_commit(delete)
+
+    def is_cached_member(self, user_id: int, room_id: int) -> bool:
+        """Local lookup only, for async callers avoiding a thread hop."""
+        return bool(self.get_local(get_member_key(room_id, user_id)))
+
+    def is_member(self, user_id: int, room_id: int) -> bool:
+        key = get_member_key(room_id, user_id)
+
+        if self.get(key):
+            return True
+
+        exists = RoomMembership.objects.filter(
+            room_id=room_id, user_id=user_id
+        ).exists()
+
+        if exists:
+            self.set(key, True)
+
+        return exists
+
+
+membership_cache = MembershipCache()
@@ -0,0 +1,53 @@
+# Generated by Django 5.0.6 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_seq(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    Room = apps.get_model('chat', 'Room')
+
+    for room in Room.objects.only('id').iterator():
+        batch = []
+        seq = 0
+
+        for message in (
+            Message.objects.filter(room_id=room.id)
+            .only('id')
+            .order_by('created_at', 'id')
+            .iterator(chunk_size=BATCH_SIZE)
+        ):
+            seq += 1
+            message.seq = seq
+            batch.append(message)
+
+            if len(batch) == BATCH_SIZE:
+                Message.objects.bulk_update(batch, ['seq'])
+                batch = []
+
+        Message.objects.bulk_update(batch, ['seq'])
+        Room.objects.filter(id=room.id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_remove_message_content_message__content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.db import connection, transaction
 from django.db.models import (
     CASCADE,
     Count,
@@ -6,16 +7,34 @@ from django.db.models import (
     ForeignKey,
     ManyToManyField,
     Model,
+    PositiveBigIntegerField,
     TextField,
+    UniqueConstraint,
 )
 
+from typing import Iterable, List
+
 from api.kms import kms_client
 
 User = get_user_model()
 
 
+def set_prefetched(instance: Model, name: str, objects: list) -> None:
+    """Caches objects as if prefetch_related(name) had loaded them."""
+    queryset = getattr(instance, name).get_queryset()
+    queryset._result_cache = objects
+    queryset._prefetch_done = True
+
+    if not hasattr(instance, "_prefetched_objects_cache"):
+        instance._prefetched_objects_cache = {}
+
+    instance._prefetched_objects_cache[name] = queryset
+
+
 class Room(Model):
     created_at = DateTimeField(auto_now_add=True)
+    # seq of the room's newest message
+    last_seq = PositiveBigIntegerField(default=0)
     members = ManyToManyField(User, through="RoomMembership")
 
     class Meta:
@@ -30,6 +49,62 @@ class Room(Model):
 
     display_members.fget.short_description = "Members"
 
+    def add_members(
+        self, users: Iterable[User], is_new: bool = False
+    ) -> List["RoomMembership"]:
+        """
+        Adds every user who isn't a member yet with a single bulk_create and
+        returns the new memberships. A new room skips the lookup of existing
+        members and keeps the new memberships as its prefetched memberships
+        and members, so serializing it doesn't query them again.
+        """
+        users = list({user.id: user for user in users}.values())
+
+        if not is_new:
+            existing_ids = set(
+                self.memberships.filter(user__in=users).values_list(
+                    "user_id", flat=True
+                )
+            )
+            users = [user for user in users if user.id not in existing_ids]
+
+        memberships = RoomMembership.objects.bulk_create(
+            [RoomMembership(room=self, user=user) for user in users]
+        )
+        # bulk_create sends no post_save for chat.signals to act on
+        from .membership import membership_cache
+
+        membership_cache.invalidate(self.id, [user.id for user in users])
+
+        if is_new:
+            set_prefetched(self, "memberships", memberships)
+            set_prefetched(self, "members", users)
+        elif hasattr(self, "_prefetched_objects_cache"):
+            self._prefetched_objects_cache.pop("memberships", None)
+            self._prefetched_objects_cache.pop("members", None)
+
+        return memberships
+
+    @staticmethod
+    def allocate_seq(room_id: int, count: int = 1) -> int:
+        """
+        Reserves the next count sequence numbers of a room and returns the
+        last one. The row stays locked until the surrounding transaction ends,
+        so concurrent writers to the same room queue up instead of colliding.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {Room._meta.db_table} SET last_seq = last_seq + %s "
+                "WHERE id = %s RETURNING last_seq",
+                [count, room_id],
+            )
+            row = cursor.fetchone()
+
+        if row is None:
+            raise Room.DoesNotExist(f"Room '{room_id}' does not exist.")
+
+        return row[0]
+
     def get_room_by_usernames(usernames: list[str]) -> object or None:
         rooms = Room.objects.annotate(num_members=Count("members")).filter(
             num_members=len(usernames)
@@ -60,21 +135,40 @@ class Message(Model):
     created_at = DateTimeField(auto_now_add=True)
     room = ForeignKey(Room, on_delete=CASCADE)
     sender = ForeignKey(User, on_delete=CASCADE)
+    # gapless position within the room, assigned on insert
+    seq = PositiveBigIntegerField(editable=False)
     _content = TextField(db_column="content", default="")
 
     class Meta:
+        constraints = (
+            UniqueConstraint(fields=("room", "seq"), name="unique_message_room_seq"),
+        )
         ordering = ("created_at",)
 
     def __str__(self):
-        return f"Message(id={self.id}, room={self.room.id}, sender='{self.sender.username}')"
+        # ids only, so logging a message never lazy-loads its room or sender
+        return f"Message(id={self.id}, room={self.room_id}, sender={self.sender_id})"
 
     @property
     def content(self):
-        return kms_client.decrypt(self._content)
+        if "_decrypted_content" not in self.__dict__:
+            self._decrypted_content = kms_client.decrypt(self._content)
+
+        return self._decrypted_content
 
     @content.setter
     def content(self, value):
         self._content = kms_client.encrypt(value)
+        self.__dict__.pop("_decrypted_content", None)
+
+    @staticmethod
+    def decrypt_contents(messages: Iterable["Message"]) -> None:
+        """Decrypts the content of every message in one batch, e.g. a page."""
+        messages = [m for m in messages if "_decrypted_content" not in m.__dict__]
+        contents = kms_client.decrypt_many(message._content for message in messages)
+
+        for message, content in zip(messages, contents):
+            message._decrypted_content = content
 
     @property
     def display_room_members(self):
@@ -82,8 +176,17 @@ class Message(Model):
 
     display_room_members.fget.short_description = "Room Members"
 
+    def refresh_from_db(self, *args, **kwargs):
+        self.__dict__.pop("_decrypted_content", None)
+        super(Message, self).refresh_from_db(*args, **kwargs)
+
     def save(self, *args, **kwargs):
-        if not self.pk:
-            self._content = kms_client.encrypt(self._content)
+        if self.pk:
+            return super(Message, self).save(*args, **kwargs)
+
+        self._content = kms_client.encrypt(self._content)
+        self.__dict__.pop("_decrypted_content", None)
 
-        super(Message, self).save(*args, **kwargs)
+        with transaction.atomic():
+            self.seq = Room.allocate_seq(self.room_id)
+            super(Message, self).save(*args, **kwargs)
@@ -0,0 +1,405 @@
+"""
+Who is online, shared by every worker.
+
+A user is online while at least one of their connections has heartbeated in
+the last PRESENCE_TTL seconds. Each process runs one PresenceTracker that
+buffers connects and disconnects and, every PRESENCE_FLUSH_INTERVAL seconds,
+writes them together with due heartbeats in one pipeline per redis shard.
+It then publishes one presence.diff event per affected room. A user who
+drops and reconnects within an interval produces no event at all.
+
+Users whose connections all expire without a disconnect, e.g. with a crashed
+worker, are pruned by whichever tracker's heartbeat comes first, and it
+publishes their offline diffs.
+"""
+
+import asyncio
+import collections
+import logging
+
+from abc import ABC, abstractmethod
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.module_loading import import_string
+from time import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from weakref import WeakKeyDictionary
+
+from api.db import database_sync_to_async
+from api.redis_client import get_shard, group_by_shard
+from .models import RoomMembership
+from .utils import RoomManager
+
+
+logger = logging.getLogger(__name__)
+
+_trackers: "WeakKeyDictionary[asyncio.AbstractEventLoop, PresenceTracker]" = (
+    WeakKeyDictionary()
+)
+
+
+# Users with connections on a shard, scored by their last heartbeat.
+PRESENCE_INDEX_KEY = "presence_index"
+
+# Drops a user from the index once their last connection is removed, so the
+# tracker that removed it publishes their offline diff and prune doesn't.
+FORGET_OFFLINE_LUA = """
+    if redis.call('ZCARD', KEYS[2]) == 0 then
+        redis.call('ZREM', KEYS[1], ARGV[1])
+    end
+"""
+
+# Claims up to ARGV[3] users whose last heartbeat is older than ARGV[1], drops
+# their expired connections and returns the ones left without any.
+PRUNE_PRESENCE_LUA = """
+    local cutoff = '(' .. ARGV[1]
+    local stale = redis.call(
+        'ZRANGEBYSCORE', KEYS[1], '-inf', cutoff, 'LIMIT', 0, ARGV[3]
+    )
+    local offline = {}
+    for _, username in ipairs(stale) do
+        redis.call('ZREM', KEYS[1], username)
+        local key = ARGV[2] .. username
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', cutoff)
+        if redis.call('ZCARD', key) == 0 then
+            table.insert(offline, username)
+        end
+    end
+    return offline
+"""
+
+
+@database_sync_to_async
+def get_memberships(usernames: List[str]) -> List[Tuple[str, int]]:
+    return list(
+        RoomMembership.objects.filter(user__username__in=usernames)
+        .order_by("user__username", "room_id")
+        .values_list("user__username", "room_id")
+    )
+
+
+def get_presence_tracker() -> "PresenceTracker":
+    """Returns the tracker of the running event loop."""
+    loop = asyncio.get_running_loop()
+
+    if loop not in _trackers:
+        _trackers[loop] = PresenceTracker(import_string(settings.PRESENCE_BACKEND)())
+
+    return _trackers[loop]
+
+
+class PresenceStore(ABC):
+    @abstractmethod
+    async def get_statuses(self, usernames: List[str]) -> Dict[str, bool]:
+        """Returns whether each user is online."""
+
+    @abstractmethod
+    async def update(
+        self,
+        refresh: Dict[str, Set[str]],
+        removed: Dict[str, Set[str]],
+        check: Set[str],
+    ) -> Dict[str, bool]:
+        """
+        Heartbeats the refresh connections, forgets the removed ones and
+        returns whether each user in check is online afterwards.
+        """
+
+    @abstractmethod
+    async def prune(self) -> List[str]:
+        """
+        Forgets connections that missed PRESENCE_TTL and returns the users
+        left without any, each to only one caller.
+        """
+
+
+class LocalPresenceStore(PresenceStore):
+    """
+    In-process stand-in for development and tests.
+
+    Attributes:
+        heartbeats (Dict[str, Dict[str, float]]):
+            A dictionary mapping usernames to their connections' channel
+            names and last heartbeat times.
+    """
+
+    def __init__(self) -> None:
+        self.heartbeats: Dict[str, Dict[str, float]] = collections.defaultdict(dict)
+
+    async def get_statuses(self, usernames: List[str]) -> Dict[str, bool]:
+        cutoff = time() - settings.PRESENCE_TTL
+        return {
+            username: any(
+                beat > cutoff for beat in self.heartbeats.get(username, {}).values()
+            )
+            for username in usernames
+        }
+
+    async def update(self, refresh, removed, check):
+        now = time()
+
+        for username, channels in refresh.items():
+            self.heartbeats[username].update(dict.fromkeys(channels, now))
+
+        for username, channels in removed.items():
+            for channel in channels:
+                self.heartbeats[username].pop(channel, None)
+
+        return await self.get_statuses(list(check))
+
+    async def prune(self):
+        cutoff = time() - settings.PRESENCE_TTL
+        offline = []
+
+        for username, beats in list(self.heartbeats.items()):
+            expired = [channel for channel, beat in beats.items() if beat <= cutoff]
+
+            for channel in expired:
+                del beats[channel]
+
+            # users whose last connection was removed were already published
+            if expired and not beats:
+                offline.append(username)
+            if not beats:
+                del self.heartbeats[username]
+
+        return offline
+
+
+class RedisPresenceStore(PresenceStore):
+    """
+    Keeps a sorted set per user of connection channel names scored by their
+    last heartbeat. Every update drops the members that missed PRESENCE_TTL,
+    so connections of crashed workers age out even while the user's other
+    connections keep the set alive; the set itself expires PRESENCE_TTL
+    seconds after the last heartbeat. Each shard also indexes its users by
+    last heartbeat, which prune() reads to find users nobody disconnected.
+    """
+
+    prune_batch_size = 1000
+
+    def get_key(self, username: str) -> str:
+        return f"presence:{username}"
+
+    async def get_statuses(self, usernames: List[str]) -> Dict[str, bool]:
+        return await self.update({}, {}, set(usernames))
+
+    async def update(self, refresh, removed, check):
+        now = time()
+        cutoff = now - settings.PRESENCE_TTL
+        keys = {
+            self.get_key(username): username
+            for username in (*refresh, *removed, *check)
+        }
+
+        async def update_shard(index: int, shard_keys: List[str]) -> Dict[str, bool]:
+            pipe = get_shard(index).pipeline(transaction=False)
+            counted = []
+
+            for key in shard_keys:
+                username = keys[key]
+
+                if refresh.get(username):
+                    pipe.zadd(key, dict.fromkeys(refresh[username], now))
+                    pipe.expire(key, settings.PRESENCE_TTL)
+                    pipe.zadd(PRESENCE_INDEX_KEY, {username: now})
+                if removed.get(username):
+                    pipe.zrem(key, *removed[username])
+                pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+                if removed.get(username):
+                    pipe.eval(FORGET_OFFLINE_LUA, 2, PRESENCE_INDEX_KEY, key, username)
+                if username in check:
+                    pipe.zcount(key, cutoff, "+inf")
+                    counted.append((username, len(pipe) - 1))
+
+            results = await pipe.execute()
+            return {username: results[position] > 0 for username, position in counted}
+
+        shards = group_by_shard(list(keys))
+        statuses = await asyncio.gather(
+            *[update_shard(index, names) for index, names in shards.items()]
+        )
+        return {
+            username: online for shard in statuses for username, online in shard.items()
+        }
+
+    async def prune(self):
+        cutoff = time() - settings.PRESENCE_TTL
+
+        async def prune_shard(index: int) -> List[str]:
+            usernames = await get_shard(index).eval(
+                PRUNE_PRESENCE_LUA,
+                1,
+                PRESENCE_INDEX_KEY,
+                cutoff,
+                self.get_key(""),
+                self.prune_batch_size,
+            )
+            return [username.decode() for username in usernames]
+
+        shards = await asyncio.gather(
+            *[prune_shard(index) for index in range(len(settings.REDIS_HOSTS))]
+        )
+        return [username for shard in shards for username in shard]
+
+
+class PresenceTracker:
+    """
+    Buffers this process's presence changes and flushes them on an interval.
+
+    Attributes:
+        connections (Dict[str, Set[str]]):
+            A dictionary mapping usernames to the channel names of their
+            connections to this process.
+        dirty (Set[str]):
+            Usernames whose status may have changed since the last flush.
+        removed (Dict[str, Set[str]]):
+            A dictionary mapping usernames to channel names that disconnected
+            since the last flush.
+        rooms (Dict[str, Set[int]]):
+            A dictionary mapping usernames to the room ids their status is
+            published to.
+        statuses (Dict[str, bool]):
+            A dictionary mapping usernames to the status this process last
+            published for them.
+    """
+
+    def __init__(self, store: PresenceStore) -> None:
+        self.connections: Dict[str, Set[str]] = collections.defaultdict(set)
+        self.dirty: Set[str] = set()
+        self.last_heartbeat = 0.0
+        self.removed: Dict[str, Set[str]] = collections.defaultdict(set)
+        self.rooms: Dict[str, Set[int]] = collections.defaultdict(set)
+        self.statuses: Dict[str, bool] = {}
+        self.store = store
+        self.task: Optional[asyncio.Task] = None
+
+    def connected(self, username: str, channel: str, room_ids: Iterable[int]) -> None:
+        self.connections[username].add(channel)
+        if username in self.removed:
+            self.removed[username].discard(channel)
+        self.rooms[username].update(room_ids)
+        self.dirty.add(username)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def disconnected(self, username: str, channel: str) -> None:
+        self.connections[username].discard(channel)
+        self.removed[username].add(channel)
+        self.dirty.add(username)
+
+    def joined_room(self, username: str, room_id: int) -> None:
+        if username in self.connections:
+            self.rooms[username].add(room_id)
+
+    async def get_statuses(self, usernames: List[str]) -> Dict[str, bool]:
+        return await self.store.get_statuses(usernames)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.PRESENCE_FLUSH_INTERVAL)
+
+            try:
+                await self.flush()
+            except Exception as exception:
+                logger.error(
+                    "Failed to flush presence: %s",
+                    exception,
+                    extra={"event": "presence.flush"},
+                )
+
+    async def flush(self) -> None:
+        now = time()
+        heartbeat_due = (
+            now - self.last_heartbeat >= settings.PRESENCE_HEARTBEAT_INTERVAL
+        )
+        dirty, self.dirty = self.dirty, set()
+        removed, self.removed = self.removed, collections.defaultdict(set)
+
+        if not dirty and not heartbeat_due:
+            return
+
+        refresh = {
+            username: channels
+            for username, channels in self.connections.items()
+            if channels and (heartbeat_due or username in dirty)
+        }
+
+        try:
+            statuses = await self.store.update(refresh, removed, dirty)
+        except Exception:
+            # retried on the next flush
+            self.dirty |= dirty
+            for username, channels in removed.items():
+                self.removed[username] |= channels
+            raise
+
+        if heartbeat_due:
+            self.last_heartbeat = now
+
+        diffs: Dict[int, Dict[str, List[str]]] = {}
+
+        for username, online in sorted(statuses.items()):
+            if self.statuses.get(username) != online:
+                for room_id in self.rooms.get(username, ()):
+                    diff = diffs.setdefault(room_id, {"offline": [], "online": []})
+                    diff["online" if online else "offline"].append(username)
+
+            self.statuses[username] = online
+
+            # forget users who no longer have connections here
+            if not self.connections.get(username):
+                self.connections.pop(username, None)
+                self.rooms.pop(username, None)
+                self.statuses.pop(username, None)
+
+        if diffs:
+            await self.publish(diffs)
+
+        if heartbeat_due:
+            await self.publish_expired()
+
+    async def publish_expired(self) -> None:
+        """Publishes offline diffs for users whose connections all expired."""
+        usernames = await self.store.prune()
+
+        if not usernames:
+            return
+
+        diffs: Dict[int, Dict[str, List[str]]] = {}
+
+        for username, room_id in await get_memberships(usernames):
+            diff = diffs.setdefault(room_id, {"offline": [], "online": []})
+            diff["offline"].append(username)
+
+        logger.info(
+            "Pruned %s users with expired connections.",
+            len(usernames),
+            extra={"event": "presence.flush"},
+        )
+
+        if diffs:
+            await self.publish(diffs)
+
+    async def publish(self, diffs: Dict[int, Dict[str, List[str]]]) -> None:
+        channel_layer = get_channel_layer()
+        results = await asyncio.gather(
+            *[
+                channel_layer.group_send(
+                    RoomManager().create_name(room_id),
+                    {"type": "presence.diff", "room": room_id, **diff},
+                )
+                for room_id, diff in diffs.items()
+            ],
+            return_exceptions=True,
+        )
+
+        for room_id, result in zip(diffs, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    "Failed to publish presence to room %s: %s",
+                    room_id,
+                    result,
+                    extra={"event": "presence.flush"},
+                )
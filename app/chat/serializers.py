@@ -1,11 +1,15 @@
 from django.contrib.auth import get_user_model
 from django.db import transaction
+from django.db.models import Q
 from rest_framework.exceptions import ValidationError
 from rest_framework.serializers import (
+    BooleanField,
     CharField,
     IntegerField,
+    ListField,
     ListSerializer,
     ModelSerializer,
+    Serializer,
     SerializerMethodField,
 )
 
@@ -30,6 +34,7 @@ class MessageSerializer(ModelSerializer):
             "room",
             "sender",
             "sender_id",
+            "seq",
             "_content",
         )
         model = Message
@@ -49,21 +54,37 @@ class RoomMembershipSerializer(ModelSerializer):
 
 
 class RoomSerializer(ModelSerializer):
-    member_ids = ListSerializer(child=IntegerField(), required=True, write_only=True)
+    member_ids = ListSerializer(child=IntegerField(), required=False, write_only=True)
+    usernames = ListSerializer(child=CharField(), required=False, write_only=True)
 
     class Meta:
-        fields = ("id", "created_at", "member_ids", "memberships")
+        fields = ("id", "created_at", "member_ids", "memberships", "usernames")
         model = Room
         read_only_fields = ("memberships",)
 
+    def validate(self, attrs):
+        if not attrs.get("member_ids") and not attrs.get("usernames"):
+            raise ValidationError("Provide member_ids or usernames.")
+
+        return attrs
+
     def create(self, validated_data):
-        member_ids = validated_data.pop("member_ids")
+        member_ids = set(validated_data.pop("member_ids", []))
+        usernames = validated_data.pop("usernames", [])
+
+        # Unknown usernames are skipped, unknown ids are an error.
+        users = list(
+            User.objects.filter(Q(id__in=member_ids) | Q(username__in=usernames))
+        )
+        missing_ids = member_ids - {user.id for user in users}
+
+        if missing_ids:
+            raise ValidationError(f"Users {sorted(missing_ids)} do not exist.")
 
         try:
             with transaction.atomic():
                 room = Room.objects.create(**validated_data)
-                for member_id in member_ids:
-                    RoomMembership.objects.create(room=room, user_id=member_id)
+                room.add_members(users, is_new=True)
 
         except Exception as exception:
             raise ValidationError(exception)
@@ -71,6 +92,26 @@ class RoomSerializer(ModelSerializer):
         return room
 
 
+class AddMembersSerializer(Serializer):
+    """Validates the payload of the add.members websocket command."""
+
+    room_id = IntegerField()
+    usernames = ListField(child=CharField())
+
+
+class QueryPresenceSerializer(Serializer):
+    """Validates the payload of the query.presence websocket command."""
+
+    usernames = ListField(child=CharField(), allow_empty=True)
+
+
+class TypingSerializer(Serializer):
+    """Validates the payload of the typing websocket command."""
+
+    room_id = IntegerField()
+    typing = BooleanField(default=True)
+
+
 class NestedRoomSerializer(ModelSerializer):
     memberships = RoomMembershipSerializer(many=True, read_only=True)
 
@@ -0,0 +1,5 @@
+from .membership import membership_cache
+
+
+def invalidate_membership(sender, instance, **kwargs) -> None:
+    membership_cache.invalidate(instance.room_id, [instance.user_id])
@@ -1,8 +1,325 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
 
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from io import StringIO
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from api.asgi import application
+from api.connections import connection_registry
+from api.kms import kms_client
+from api.profiling import QueryBudgetTestMixin, capture_profiles
+from .delivery_log import LocalDeliveryLog, get_delivery_log
+from .membership import membership_cache
+from .management.commands.benchmark_chat import percentile, summarize
+from .management.commands.import_data import read_records
+from .models import Message, Room, RoomMembership
+from .presence import (
+    PRESENCE_INDEX_KEY,
+    PRUNE_PRESENCE_LUA,
+    LocalPresenceStore,
+    PresenceTracker,
+    RedisPresenceStore,
+)
+from .serializers import RoomSerializer
 from .utils import RoomManager
 
 
+User = get_user_model()
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+}
+MD5_PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
+
+def create_room(users) -> Room:
+    room = Room.objects.create()
+    RoomMembership.objects.bulk_create(
+        [RoomMembership(room=room, user=user) for user in users]
+    )
+    return room
+
+
+def create_users(count: int) -> list:
+    return [
+        User.objects.create_user(
+            email=f"user{index}@example.com",
+            password="password",
+            username=f"user{index}",
+        )
+        for index in range(count)
+    ]
+
+
+class TestBenchmarkStats(TestCase):
+    def test_percentile(self):
+        values = [float(value) for value in range(1, 101)]
+        self.assertEqual(percentile(values, 50), 50.0)
+        self.assertEqual(percentile(values, 95), 95.0)
+        self.assertEqual(percentile(values, 99), 99.0)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_summarize(self):
+        summary = summarize([3.0, 1.0, 2.0])
+        self.assertEqual(summary["count"], 3)
+        self.assertEqual(summary["max"], 3.0)
+        self.assertEqual(summary["mean"], 2.0)
+        self.assertEqual(summary["p50"], 2.0)
+
+
+class TestRoomMembers(TestCase):
+    def setUp(self):
+        self.users = create_users(4)
+
+    def test_create_room_by_usernames(self):
+        usernames = [user.username for user in self.users] + ["missing"]
+        serializer = RoomSerializer(data={"usernames": usernames})
+        self.assertTrue(serializer.is_valid())
+
+        # user lookup, room insert, membership insert, plus the savepoint
+        with self.assertNumQueries(5):
+            room = serializer.save()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(len(serializer.data["memberships"]), 4)
+            self.assertEqual(set(room.members.all()), set(self.users))
+
+    def test_create_room_with_unknown_member_id(self):
+        serializer = RoomSerializer(data={"member_ids": [self.users[0].id, 0]})
+        self.assertTrue(serializer.is_valid())
+
+        with self.assertRaises(ValidationError):
+            serializer.save()
+
+    def test_create_room_without_members(self):
+        self.assertFalse(RoomSerializer(data={}).is_valid())
+
+    def test_add_members_skips_existing(self):
+        room = create_room(self.users[:2])
+        memberships = room.add_members(self.users)
+
+        self.assertEqual([m.user for m in memberships], self.users[2:])
+        self.assertEqual(room.memberships.count(), 4)
+        self.assertEqual(room.add_members(self.users), [])
+
+
+class TestLocalDeliveryLog(TestCase):
+    def setUp(self):
+        self.log = LocalDeliveryLog()
+
+    def test_read_after(self):
+        async_to_sync(self.log.append)(["user1", "user2"], 1)
+        async_to_sync(self.log.append)(["user1"], 2)
+
+        self.assertEqual(async_to_sync(self.log.read)("user1", 1, 10), [2])
+        self.assertEqual(async_to_sync(self.log.read)("user2", 1, 10), [])
+        self.assertEqual(async_to_sync(self.log.read)("user1", 0, 1), [1])
+
+    def test_read_follows_send_order(self):
+        # 7 was committed first but sent after 8
+        for message_id in (5, 8, 7, 9):
+            async_to_sync(self.log.append)(["user1"], message_id)
+
+        self.assertEqual(async_to_sync(self.log.read)("user1", 8, 10), [7, 9])
+        # trimmed from the log, so id order is all there is
+        self.assertEqual(async_to_sync(self.log.read)("user1", 6, 10), [8, 7, 9])
+
+
+class TestMessageSeq(TestCase):
+    def test_seq_is_per_room(self):
+        users = create_users(1)
+        rooms = [create_room(users), create_room(users)]
+
+        seqs = [
+            Message.objects.create(room=room, sender=users[0], _content="hi").seq
+            for room in (rooms[0], rooms[0], rooms[1], rooms[0])
+        ]
+
+        self.assertEqual(seqs, [1, 2, 1, 3])
+        rooms[0].refresh_from_db()
+        self.assertEqual(rooms[0].last_seq, 3)
+
+    def test_allocate_seq_for_missing_room(self):
+        with self.assertRaises(Room.DoesNotExist):
+            Room.allocate_seq(0)
+
+
+class TestPresenceTracker(TransactionTestCase):
+    def setUp(self):
+        self.tracker = PresenceTracker(LocalPresenceStore())
+        self.published = []
+
+        async def publish(diffs):
+            self.published.append(diffs)
+
+        self.tracker.publish = publish
+
+    def test_flush_publishes_coalesced_diffs(self):
+        self.tracker.connections["user1"].add("channel1")
+        self.tracker.rooms["user1"].update([1, 2])
+        self.tracker.dirty.add("user1")
+        self.tracker.connections["user2"].add("channel2")
+        self.tracker.rooms["user2"].add(1)
+        self.tracker.dirty.add("user2")
+
+        async_to_sync(self.tracker.flush)()
+        self.assertEqual(
+            self.published.pop(),
+            {
+                1: {"offline": [], "online": ["user1", "user2"]},
+                2: {"offline": [], "online": ["user1"]},
+            },
+        )
+
+        # a reconnect within one interval publishes nothing
+        self.tracker.disconnected("user1", "channel1")
+        self.tracker.connections["user1"].add("channel3")
+        async_to_sync(self.tracker.flush)()
+        self.assertEqual(self.published, [])
+
+        self.tracker.disconnected("user2", "channel2")
+        async_to_sync(self.tracker.flush)()
+        self.assertEqual(
+            self.published.pop(), {1: {"offline": ["user2"], "online": []}}
+        )
+        self.assertNotIn("user2", self.tracker.rooms)
+
+    def test_get_statuses(self):
+        self.tracker.connections["user1"].add("channel1")
+        self.tracker.dirty.add("user1")
+        async_to_sync(self.tracker.flush)()
+
+        self.assertEqual(
+            async_to_sync(self.tracker.get_statuses)(["user1", "user2"]),
+            {"user1": True, "user2": False},
+        )
+
+    def test_flush_publishes_expired_users_offline(self):
+        users = create_users(2)
+        rooms = [create_room(users), create_room(users[:1])]
+        crashed = PresenceTracker(self.tracker.store)
+        crashed.publish = self.tracker.publish
+
+        for username in ("user0", "user1"):
+            crashed.connections[username].add(f"crashed.{username}")
+            crashed.dirty.add(username)
+
+        async_to_sync(crashed.flush)()
+        self.tracker.connections["user1"].add("live.user1")
+        self.tracker.dirty.add("user1")
+        async_to_sync(self.tracker.flush)()
+        self.published.clear()
+
+        # the crashed worker's connections miss their heartbeats
+        for username in ("user0", "user1"):
+            self.tracker.store.heartbeats[username][f"crashed.{username}"] -= (
+                settings.PRESENCE_TTL + 1
+            )
+
+        self.tracker.last_heartbeat = 0
+        async_to_sync(self.tracker.flush)()
+        self.assertEqual(
+            self.published,
+            [
+                {
+                    rooms[0].id: {"offline": ["user0"], "online": []},
+                    rooms[1].id: {"offline": ["user0"], "online": []},
+                }
+            ],
+        )
+
+        # pruned users are published once
+        self.tracker.last_heartbeat = 0
+        async_to_sync(self.tracker.flush)()
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(
+            async_to_sync(self.tracker.get_statuses)(["user0", "user1"]),
+            {"user0": False, "user1": True},
+        )
+
+    def test_redis_prune(self):
+        shard = MagicMock(eval=AsyncMock(return_value=[b"user0"]))
+
+        with patch("chat.presence.get_shard", return_value=shard):
+            offline = async_to_sync(RedisPresenceStore().prune)()
+
+        self.assertEqual(offline, ["user0"] * len(settings.REDIS_HOSTS))
+        script, keys, key, _, prefix, _ = shard.eval.call_args.args
+        self.assertEqual(
+            (script, keys, key), (PRUNE_PRESENCE_LUA, 1, PRESENCE_INDEX_KEY)
+        )
+        self.assertEqual(prefix, "presence:")
+
+
+class TestMembershipCache(TestCase):
+    def setUp(self):
+        membership_cache.clear()
+        self.users = create_users(3)
+        self.room = create_room(self.users[:2])
+
+    def test_is_member(self):
+        self.assertTrue(membership_cache.is_member(self.users[0].id, self.room.id))
+        self.assertFalse(membership_cache.is_member(self.users[2].id, self.room.id))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(membership_cache.is_member(self.users[0].id, self.room.id))
+
+        # non-members are never cached
+        with self.assertNumQueries(1):
+            self.assertFalse(membership_cache.is_member(self.users[2].id, self.room.id))
+
+    def test_invalidated_on_delete(self):
+        self.assertTrue(membership_cache.is_member(self.users[0].id, self.room.id))
+        self.assertEqual(len(membership_cache.get_usernames(self.room.id)), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            RoomMembership.objects.filter(user=self.users[0]).delete()
+
+        self.assertFalse(membership_cache.is_member(self.users[0].id, self.room.id))
+        self.assertEqual(
+            membership_cache.get_usernames(self.room.id), [self.users[1].username]
+        )
+
+    @override_settings(MEMBERSHIP_CACHE_SHARED=True)
+    def test_shared_cache(self):
+        cache.clear()
+        self.assertTrue(membership_cache.is_member(self.users[0].id, self.room.id))
+        # another worker only has the shared layer
+        membership_cache.clear()
+
+        with self.assertNumQueries(0):
+            self.assertTrue(membership_cache.is_member(self.users[0].id, self.room.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            RoomMembership.objects.filter(user=self.users[0]).delete()
+
+        membership_cache.clear()
+        self.assertFalse(membership_cache.is_member(self.users[0].id, self.room.id))
+
+    def test_invalidated_by_add_members(self):
+        self.assertEqual(len(membership_cache.get_usernames(self.room.id)), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.room.add_members([self.users[2]])
+
+        self.assertEqual(len(membership_cache.get_usernames(self.room.id)), 3)
+
+
 class TestRoomManager(TestCase):
     def setUp(self):
         self.manager = RoomManager()
@@ -69,3 +386,688 @@ class TestRoomManager(TestCase):
         self.assertTrue(self.manager.user_is_in_room("user1", 1))
         self.assertFalse(self.manager.user_is_in_room("user1", 2))
         self.assertFalse(self.manager.user_is_in_room("user2", 1))
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    PASSWORD_HASHERS=MD5_PASSWORD_HASHERS,
+    # keeps presence.diff events out of tests that don't expect them
+    PRESENCE_FLUSH_INTERVAL=60,
+    # tests reap explicitly
+    WS_IDLE_TIMEOUT=0,
+)
+class ChatConsumerTestCase(TransactionTestCase):
+    """Three users sharing two rooms, connected through the ASGI application."""
+
+    def setUp(self):
+        cache.clear()
+        membership_cache.clear()
+        self.users = create_users(3)
+        self.rooms = [create_room(self.users), create_room(self.users[:2])]
+
+    async def connect(self, user, query: str = "") -> WebsocketCommunicator:
+        communicator = WebsocketCommunicator(
+            application,
+            f"/ws/chat?token={AccessToken.for_user(user)}{query}",
+            headers=[(b"origin", b"http://localhost")],
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+
+class TestChatConsumerQueryBudget(QueryBudgetTestMixin, ChatConsumerTestCase):
+    async def test_connect(self):
+        with self.assertQueryBudget("ws:connect", 1):
+            communicator = await self.connect(self.users[0])
+            # connect() returns on accept, before the groups are subscribed
+            self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    async def test_create_message(self):
+        communicator = await self.connect(self.users[0])
+
+        with self.assertQueryBudget("ws:create.message", 7):
+            await communicator.send_json_to(
+                {
+                    "type": "create.message",
+                    "payload": {
+                        "message": {"content": "hello", "room_id": self.rooms[0].id}
+                    },
+                }
+            )
+            response = await communicator.receive_json_from()
+
+        self.assertEqual(response["event"]["message"]["content"], "hello")
+        self.assertEqual(response["event"]["message"]["seq"], 1)
+
+        # the room's members are cached from here on
+        with self.assertQueryBudget("ws:create.message", 6):
+            await self.send_message(communicator, "again", self.rooms[0])
+            await communicator.receive_json_from()
+        await communicator.disconnect()
+
+    async def send_message(self, communicator, content: str, room: Room) -> None:
+        await communicator.send_json_to(
+            {
+                "type": "create.message",
+                "payload": {"message": {"content": content, "room_id": room.id}},
+            }
+        )
+
+    async def test_resume_from(self):
+        sender = await self.connect(self.users[0])
+        receiver = await self.connect(self.users[1])
+
+        await self.send_message(sender, "seen", self.rooms[1])
+        seen = (await receiver.receive_json_from())["event"]
+        await receiver.disconnect()
+
+        await self.send_message(sender, "missed 1", self.rooms[1])
+        await self.send_message(sender, "missed 2", self.rooms[1])
+        self.assertEqual(
+            (await sender.receive_json_from())["event"]["message"]["content"], "seen"
+        )
+        await sender.receive_json_from()
+        await sender.receive_json_from()
+
+        # the missed messages are re-read from the database in one query
+        with self.assertQueryBudget("ws:connect", 2):
+            receiver = await self.connect(
+                self.users[1], f"&resume_from={seen['delivery_id']}"
+            )
+            replayed = [
+                (await receiver.receive_json_from())["event"] for _ in range(2)
+            ]
+
+        self.assertEqual(
+            [event["message"]["content"] for event in replayed],
+            ["missed 1", "missed 2"],
+        )
+        self.assertEqual(
+            [event["delivery_id"] for event in replayed],
+            [str(event["message"]["id"]) for event in replayed],
+        )
+        self.assertEqual(seen["delivery_id"], str(seen["message"]["id"]))
+        self.assertTrue(await receiver.receive_nothing())
+
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    async def test_deliveries_logged_before_send(self):
+        sender = await self.connect(self.users[0])
+        channel_layer = get_channel_layer()
+        delivery_log = get_delivery_log()
+        append, group_send = delivery_log.append, channel_layer.group_send
+        logged = []
+
+        # a round trip, as with redis
+        async def slow_append(usernames, message_id):
+            await asyncio.sleep(0.01)
+            await append(usernames, message_id)
+
+        async def check_logged(group, message):
+            logged.append(await delivery_log.read("user1", 0, 1000))
+            await group_send(group, message)
+
+        with (
+            patch.object(delivery_log, "append", side_effect=slow_append),
+            patch.object(channel_layer, "group_send", side_effect=check_logged),
+        ):
+            await self.send_message(sender, "hello", self.rooms[1])
+            event = (await sender.receive_json_from())["event"]
+
+        # the log is per process, so earlier tests' ids come first
+        self.assertEqual(len(logged), 1)
+        self.assertEqual(logged[0][-1], event["message"]["id"])
+        await sender.disconnect()
+
+    @override_settings(PRESENCE_FLUSH_INTERVAL=0.01)
+    async def test_presence(self):
+        watcher = await self.connect(self.users[1])
+        # one diff for each of the watcher's rooms
+        events = [(await watcher.receive_json_from())["event"] for _ in range(2)]
+        self.assertEqual(
+            {event["room"] for event in events}, {room.id for room in self.rooms}
+        )
+        self.assertEqual(events[0]["online"], [self.users[1].username])
+
+        user = await self.connect(self.users[2])
+        event = (await watcher.receive_json_from())["event"]
+        self.assertEqual(event["online"], [self.users[2].username])
+        await user.disconnect()
+        event = (await watcher.receive_json_from())["event"]
+        self.assertEqual(event["offline"], [self.users[2].username])
+
+        await watcher.send_json_to(
+            {
+                "type": "query.presence",
+                "payload": {"usernames": [u.username for u in self.users]},
+            }
+        )
+        event = (await watcher.receive_json_from())["event"]
+        self.assertEqual(
+            event["statuses"],
+            {"user0": "offline", "user1": "online", "user2": "offline"},
+        )
+
+        await watcher.disconnect()
+
+    async def test_query_presence_validates_usernames(self):
+        stranger = await sync_to_async(User.objects.create_user)(
+            email="stranger@example.com", password="password", username="stranger"
+        )
+        communicator = await self.connect(self.users[0])
+
+        for usernames in ("user1", [["user1"]]):
+            await communicator.send_json_to(
+                {"type": "query.presence", "payload": {"usernames": usernames}}
+            )
+            self.assertIn("warning", await communicator.receive_json_from())
+
+        # users who share no room with the querying user are left out
+        await communicator.send_json_to(
+            {
+                "type": "query.presence",
+                "payload": {"usernames": ["user1", stranger.username]},
+            }
+        )
+        event = (await communicator.receive_json_from())["event"]
+        self.assertEqual(event["statuses"], {"user1": "offline"})
+
+        await communicator.disconnect()
+
+    async def send_typing(self, communicator, room: Room, typing: bool = True):
+        await communicator.send_json_to(
+            {"type": "typing", "payload": {"room_id": room.id, "typing": typing}}
+        )
+
+    async def test_typing(self):
+        typist = await self.connect(self.users[0])
+        watcher = await self.connect(self.users[1])
+        outsider = await self.connect(self.users[2])
+
+        with self.assertQueryBudget("ws:typing", 0):
+            await self.send_typing(typist, self.rooms[1])
+            event = (await watcher.receive_json_from())["event"]
+
+        self.assertEqual(event["type"], "typing.indicator")
+        self.assertEqual(event["username"], self.users[0].username)
+        self.assertTrue(event["typing"])
+
+        # throttled, then a stop that always goes through
+        await self.send_typing(typist, self.rooms[1])
+        await self.send_typing(typist, self.rooms[1], typing=False)
+        event = (await watcher.receive_json_from())["event"]
+        self.assertFalse(event["typing"])
+
+        self.assertTrue(await typist.receive_nothing())
+        self.assertTrue(await outsider.receive_nothing())
+
+        await self.send_typing(outsider, self.rooms[1])
+        self.assertIn("warning", await outsider.receive_json_from())
+
+        for communicator in (typist, watcher, outsider):
+            await communicator.disconnect()
+
+    async def test_typing_from_several_connections(self):
+        watcher = await self.connect(self.users[1])
+        first = await self.connect(self.users[0])
+        second = await self.connect(self.users[0])
+
+        await self.send_typing(first, self.rooms[1])
+        event = (await watcher.receive_json_from())["event"]
+        self.assertTrue(event["typing"])
+
+        # throttled per user, not per connection
+        await self.send_typing(second, self.rooms[1])
+        self.assertTrue(await watcher.receive_nothing())
+
+        # the other connection still counts as a member of the room
+        await first.disconnect()
+        await self.send_typing(second, self.rooms[1], typing=False)
+        event = (await watcher.receive_json_from())["event"]
+        self.assertFalse(event["typing"])
+
+        await second.disconnect()
+        await watcher.disconnect()
+
+    async def test_typing_send_error(self):
+        typist = await self.connect(self.users[0])
+
+        with patch.object(
+            get_channel_layer(), "group_send", side_effect=Exception("down")
+        ):
+            await self.send_typing(typist, self.rooms[1])
+            self.assertIn("error", await typist.receive_json_from())
+
+        # the connection survives the error
+        await typist.send_json_to({"type": "heartbeat"})
+        event = (await typist.receive_json_from())["event"]
+        self.assertEqual(event["type"], "heartbeat")
+        await typist.disconnect()
+
+    async def test_typing_rejects_invalid_payload(self):
+        typist = await self.connect(self.users[0])
+        payloads = (None, [self.rooms[1].id], "typing", {"room_id": "abc"})
+
+        for payload in payloads:
+            await typist.send_json_to({"type": "typing", "payload": payload})
+            self.assertIn("warning", await typist.receive_json_from())
+
+        await typist.disconnect()
+
+    async def test_add_members(self):
+        owner = await self.connect(self.users[0])
+        invitee = await self.connect(self.users[2])
+
+        with self.assertQueryBudget("ws:add.members", 6):
+            await owner.send_json_to(
+                {
+                    "type": "add.members",
+                    "payload": {
+                        "room_id": self.rooms[1].id,
+                        "usernames": [self.users[2].username],
+                    },
+                }
+            )
+            event = (await owner.receive_json_from())["event"]
+
+        self.assertEqual(event["usernames"], [self.users[2].username])
+        self.assertEqual(
+            (await invitee.receive_json_from())["event"]["room"], self.rooms[1].id
+        )
+
+        # the invitee is now subscribed to the room group
+        await owner.send_json_to(
+            {
+                "type": "create.message",
+                "payload": {
+                    "message": {"content": "welcome", "room_id": self.rooms[1].id}
+                },
+            }
+        )
+        response = await invitee.receive_json_from()
+        self.assertEqual(response["event"]["message"]["content"], "welcome")
+
+        await owner.disconnect()
+        await invitee.disconnect()
+
+    async def test_add_members_rejects_invalid_usernames(self):
+        owner = await self.connect(self.users[0])
+
+        for usernames in (self.users[2].username, [{"username": "user2"}], None):
+            await owner.send_json_to(
+                {
+                    "type": "add.members",
+                    "payload": {"room_id": self.rooms[1].id, "usernames": usernames},
+                }
+            )
+            self.assertIn("warning", await owner.receive_json_from())
+
+        self.assertEqual(await self.rooms[1].memberships.acount(), 2)
+        await owner.disconnect()
+
+
+class TestConnectionLifecycle(ChatConsumerTestCase):
+    @override_settings(WS_MAX_CONNECTIONS_PER_WORKER=1)
+    async def test_connection_limit(self):
+        communicator = await self.connect(self.users[0])
+        rejected = WebsocketCommunicator(
+            application,
+            f"/ws/chat?token={AccessToken.for_user(self.users[1])}",
+            headers=[(b"origin", b"http://localhost")],
+        )
+
+        connected, _ = await rejected.connect()
+        closed = await rejected.receive_output()
+
+        self.assertTrue(connected)
+        self.assertEqual(closed, {"code": 4503, "type": "websocket.close"})
+
+        await communicator.disconnect()
+        communicator = await self.connect(self.users[1])
+        await communicator.disconnect()
+
+    @override_settings(WS_RECONNECT_DELAY_SECONDS=2)
+    async def test_drain(self):
+        communicator = await self.connect(self.users[0])
+        self.assertTrue(await communicator.receive_nothing())
+        await get_channel_layer().group_send(
+            "chat_user_user0", {"type": "presence.diff", "room": 1}
+        )
+
+        try:
+            await connection_registry.drain(0, timeout=0)
+
+            # events queued before the drain still go out first
+            event = (await communicator.receive_json_from())["event"]
+            self.assertEqual(event["type"], "presence.diff")
+            event = (await communicator.receive_json_from())["event"]
+            self.assertEqual(event["type"], "reconnect")
+            self.assertTrue(0 <= event["delay"] <= 2)
+            closed = await communicator.receive_output()
+            self.assertEqual(closed, {"code": 4503, "type": "websocket.close"})
+            await communicator.disconnect()
+
+            rejected = WebsocketCommunicator(
+                application,
+                f"/ws/chat?token={AccessToken.for_user(self.users[1])}",
+                headers=[(b"origin", b"http://localhost")],
+            )
+            await rejected.connect()
+            closed = await rejected.receive_output()
+            self.assertEqual(closed, {"code": 4503, "type": "websocket.close"})
+        finally:
+            connection_registry.draining = False
+
+        self.assertEqual(connection_registry.consumers, {})
+
+    async def test_heartbeat(self):
+        communicator = await self.connect(self.users[0])
+        (channel,) = connection_registry.consumers
+        connection_registry.last_seen[channel] -= 100
+
+        await communicator.send_json_to({"type": "heartbeat"})
+        event = (await communicator.receive_json_from())["event"]
+
+        self.assertEqual(event, {"type": "heartbeat", "interval": 25})
+        self.assertEqual(await connection_registry.reap(50), 0)
+        await communicator.disconnect()
+
+    async def test_reap(self):
+        idle = await self.connect(self.users[0])
+        active = await self.connect(self.users[1])
+        self.assertTrue(await idle.receive_nothing())
+        channel_layer = get_channel_layer()
+        idle_channel, active_channel = connection_registry.consumers
+        connection_registry.last_seen[idle_channel] -= 100
+
+        self.assertEqual(await connection_registry.reap(50), 1)
+
+        closed = await idle.receive_output()
+        self.assertEqual(closed, {"code": 4408, "type": "websocket.close"})
+        self.assertEqual(list(connection_registry.consumers), [active_channel])
+        # the idle channel left its room groups and its user group
+        for group, channels in channel_layer.groups.items():
+            self.assertNotIn(idle_channel, channels, group)
+        room_group = f"chat_room_{self.rooms[0].id}"
+        self.assertIn(active_channel, channel_layer.groups[room_group])
+
+        await idle.disconnect()
+        await active.disconnect()
+
+
+class TestImportData(TestCase):
+    def write(self, suffix: str, content: str) -> str:
+        file = tempfile.NamedTemporaryFile("w", delete=False, suffix=suffix)
+        self.addCleanup(os.remove, file.name)
+
+        with file:
+            file.write(content)
+
+        return file.name
+
+    def load(self, kind: str, content: str, suffix: str = ".ndjson") -> str:
+        stdout = StringIO()
+        call_command(
+            "import_data",
+            kind,
+            self.write(suffix, content),
+            batch_size=2,
+            stderr=StringIO(),
+            stdout=stdout,
+            workers=2,
+        )
+        return stdout.getvalue()
+
+    def test_import(self):
+        self.load(
+            "users",
+            "id,email,username,first_name\n"
+            "10,ann@example.com,ann,Ann\n"
+            "11,bob@example.com,bob,\n",
+            suffix=".csv",
+        )
+        self.load("rooms", '{"id": 20}\n{"id": 21}\n')
+        output = self.load(
+            "memberships",
+            '{"room_id": 20, "username": "ann"}\n'
+            '{"room_id": 20, "user_id": 11}\n'
+            '{"room_id": 21, "username": "nobody"}\n',
+        )
+        self.assertIn("Imported 2 memberships", output)
+        self.assertIn("skipped 1", output)
+
+        Message.objects.create(room_id=20, sender_id=10, _content="existing")
+        self.load(
+            "messages",
+            "".join(
+                json.dumps({"room_id": 20, "sender": "bob", "content": f"hi {i}"})
+                + "\n"
+                for i in range(3)
+            ),
+        )
+
+        self.assertFalse(User.objects.get(username="ann").has_usable_password())
+        self.assertEqual(User.objects.get(id=11).first_name, "")
+        self.assertEqual(
+            set(Room.objects.get(id=20).members.values_list("username", flat=True)),
+            {"ann", "bob"},
+        )
+        messages = Message.objects.filter(room_id=20).order_by("seq")
+        self.assertEqual(
+            [(m.seq, m.content) for m in messages],
+            [(1, "existing"), (2, "hi 0"), (3, "hi 1"), (4, "hi 2")],
+        )
+        self.assertEqual(Room.objects.get(id=20).last_seq, 4)
+
+    def test_read_records_csv_nulls(self):
+        path = self.write(".csv", "room_id,user_id,username\n1,,ann\n")
+
+        self.assertEqual(
+            list(read_records(path, "csv")),
+            [{"room_id": "1", "user_id": None, "username": "ann"}],
+        )
+
+
+@override_settings(EXPORT_DECRYPT_WORKERS=2, PASSWORD_HASHERS=MD5_PASSWORD_HASHERS)
+class TestRoomExport(APITransactionTestCase):
+    def setUp(self):
+        membership_cache.clear()
+        self.users = create_users(3)
+        self.room = create_room(self.users[:2])
+
+        for index in range(5):
+            Message.objects.create(
+                room=self.room, sender=self.users[index % 2], _content=f"hello {index}"
+            )
+
+    def parse(self, data: bytes) -> list:
+        return [json.loads(line) for line in data.decode().splitlines()]
+
+    async def stream(self, user, query: bytes = b"") -> tuple:
+        """Requests the export from the ASGI application, body by body."""
+        token = AccessToken.for_user(user)
+        communicator = ApplicationCommunicator(
+            application,
+            {
+                "type": "http",
+                "method": "GET",
+                "path": reverse("room-export", args=(self.room.id,)),
+                "query_string": query,
+                "headers": [
+                    (b"authorization", f"Bearer {token}".encode()),
+                    (b"host", b"localhost"),
+                ],
+            },
+        )
+        await communicator.send_input({"type": "http.request", "body": b""})
+        start = await communicator.receive_output()
+        bodies = [await communicator.receive_output()]
+
+        while bodies[-1].get("more_body"):
+            bodies.append(await communicator.receive_output())
+
+        await communicator.wait()
+        return start, [body["body"] for body in bodies if body.get("body")]
+
+    async def test_view(self):
+        with self.settings(EXPORT_CHUNK_SIZE=2):
+            start, chunks = await self.stream(self.users[0])
+
+        self.assertEqual(start["status"], 200)
+        self.assertIn((b"Content-Type", b"application/x-ndjson"), start["headers"])
+        # streamed one chunk of two messages at a time
+        self.assertEqual(len(chunks), 3)
+        lines = self.parse(b"".join(chunks))
+        self.assertEqual([line["seq"] for line in lines], [1, 2, 3, 4, 5])
+        self.assertEqual(lines[0]["content"], "hello 0")
+        self.assertEqual(lines[1]["sender"], "user1")
+
+        _, chunks = await self.stream(self.users[0], b"compress=gzip")
+        self.assertEqual(self.parse(gzip.decompress(b"".join(chunks))), lines)
+
+        start, _ = await self.stream(self.users[2])
+        self.assertEqual(start["status"], 401)
+
+    async def test_view_profiles_streamed_body(self):
+        with capture_profiles() as profiles:
+            start, chunks = await self.stream(self.users[0])
+
+        self.assertEqual(start["status"], 200)
+        (current,) = [item for item in profiles if item.name == "room-export"]
+        # the messages are read while the body streams, after the view returned
+        self.assertTrue(
+            any('"chat_message"' in statement for statement in current.statements)
+        )
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile() as output:
+            call_command(
+                "export_room",
+                self.room.id,
+                chunk_size=3,
+                gzip=True,
+                output=output.name,
+                stderr=StringIO(),
+            )
+            lines = self.parse(gzip.decompress(output.read()))
+
+        self.assertEqual([line["content"] for line in lines][-1], "hello 4")
+        self.assertEqual(len(lines), 5)
+
+
+@override_settings(PASSWORD_HASHERS=MD5_PASSWORD_HASHERS)
+class TestAdminQueryBudget(QueryBudgetTestMixin, TestCase):
+    def setUp(self):
+        users = create_users(4)
+        rooms = [create_room(users), create_room(users[:2])]
+
+        for user in users:
+            for room in rooms:
+                Message.objects.create(room=room, sender=user, _content="hello")
+
+        self.client.force_login(
+            User.objects.create_superuser(
+                email="admin@example.com", password="password", username="admin"
+            )
+        )
+
+    def test_message_changelist(self):
+        with (
+            self.assertQueryBudget("admin:chat_message_changelist", 5),
+            patch.object(kms_client, "decrypt", wraps=kms_client.decrypt) as decrypt,
+        ):
+            response = self.client.get(reverse("admin:chat_message_changelist"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "hello", count=8)
+        # decrypted as one page, not per row
+        decrypt.assert_not_called()
+
+    def test_room_changelist(self):
+        with self.assertQueryBudget("admin:chat_room_changelist", 5):
+            response = self.client.get(reverse("admin:chat_room_changelist"))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_room_membership_changelist(self):
+        with self.assertQueryBudget("admin:chat_roommembership_changelist", 5):
+            response = self.client.get(
+                reverse("admin:chat_roommembership_changelist")
+            )
+
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(PASSWORD_HASHERS=MD5_PASSWORD_HASHERS)
+class TestViewQueryBudget(QueryBudgetTestMixin, APITestCase):
+    def setUp(self):
+        membership_cache.clear()
+        self.users = create_users(4)
+        self.rooms = [create_room(self.users), create_room(self.users[:2])]
+
+        for user in self.users:
+            Message.objects.create(room=self.rooms[0], sender=user, _content="hello")
+
+        self.client.force_authenticate(self.users[0])
+
+    def test_message_list(self):
+        url = reverse("message-list", args=(self.rooms[0].id,))
+
+        with self.assertQueryBudget("message-list", 3):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 4)
+
+        # the membership check is cached from here on
+        with self.assertQueryBudget("message-list", 2):
+            self.client.get(url)
+
+    def test_message_list_seq_cursors(self):
+        url = reverse("message-list", args=(self.rooms[0].id,))
+
+        response = self.client.get(url, {"after_seq": 1, "before_seq": 4})
+        self.assertEqual([m["seq"] for m in response.data["results"]], [2, 3])
+
+        response = self.client.get(url, {"after_seq": "x"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_message_list_before_seq(self):
+        for _ in range(20):
+            Message.objects.create(
+                room=self.rooms[0], sender=self.users[0], _content="hello"
+            )
+
+        url = reverse("message-list", args=(self.rooms[0].id,))
+
+        # the page right before the cursor, not the oldest messages
+        response = self.client.get(url, {"before_seq": 20})
+        self.assertEqual(response.data["count"], 19)
+        self.assertEqual(
+            [m["seq"] for m in response.data["results"]], list(range(10, 20))
+        )
+
+        response = self.client.get(url, {"before_seq": 20, "page": 2})
+        self.assertEqual(
+            [m["seq"] for m in response.data["results"]], list(range(1, 10))
+        )
+
+    def test_room_detail(self):
+        with self.assertQueryBudget("room-detail", 3):
+            response = self.client.get(
+                reverse("room-detail"), {"room": self.rooms[0].id}
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["memberships"]), 4)
+
+    def test_room_list(self):
+        with self.assertQueryBudget("room-list", 4):
+            response = self.client.get(reverse("room-list"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 2)
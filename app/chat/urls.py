@@ -1,10 +1,11 @@
 from django.urls import path
 
-from .views import MessageListView, RoomDetailView, RoomListView
+from .views import MessageListView, RoomDetailView, RoomExportView, RoomListView
 
 
 urlpatterns = [
     path("room", RoomDetailView.as_view(), name="room-detail"),
     path("rooms", RoomListView.as_view(), name="room-list"),
     path("room/<int:room_id>/messages", MessageListView.as_view(), name="message-list"),
+    path("room/<int:room_id>/export", RoomExportView.as_view(), name="room-export"),
 ]
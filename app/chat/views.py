@@ -1,6 +1,9 @@
 import logging
 
 from django.contrib.auth import get_user_model
+from django.db import router
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
 from rest_framework.generics import ListAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.request import Request
@@ -11,37 +14,82 @@ from rest_framework.status import (
     HTTP_404_NOT_FOUND,
 )
 from rest_framework.views import APIView
+from typing import Optional
 
+from api.db_routers import ReplicaReadMixin
+from .export import aexport_room
+from .membership import membership_cache
 from .models import Message, Room
 from .serializers import MessageSerializer, NestedRoomSerializer
 
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
 
-class MessageListView(ListAPIView):
+
+def check_room_access(request: Request, room_id: int, event: str) -> Optional[Response]:
+    """Returns an error response unless the logged-in user is in the room."""
+    # a cached membership proves the room exists, so members skip both checks
+    if membership_cache.is_member(request.user.id, room_id):
+        return None
+
+    if not Room.objects.filter(id=room_id).exists():
+        warning = f"Room '{room_id}' does not exist."
+        logger.warning(warning, extra={"event": event})
+        return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
+
+    warning = f"Logged-in user '{request.user}' is not a memeber of this room."
+    logger.warning(warning, extra={"event": event})
+    return Response({"warning": warning}, status=HTTP_401_UNAUTHORIZED)
+
+
+class MessageListView(ReplicaReadMixin, ListAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = MessageSerializer
 
     def get(self, request, room_id, *args, **kwargs):
-        room = Room.objects.filter(id=room_id).first()
+        error = check_room_access(request, room_id, "message.list")
+        if error:
+            return error
+
+        self.queryset = Message.objects.filter(room_id=room_id).select_related("sender")
+
+        # seq cursors page through an exact range, e.g. a gap the client found
+        cursors = {"after_seq": "seq__gt", "before_seq": "seq__lt"}
+        filters = {}
+
+        for param, lookup in cursors.items():
+            value = request.query_params.get(param)
+            if value is None:
+                continue
+            if not value.isdigit():
+                warning = f"{param} must be a non-negative integer."
+                logger.warning(warning, extra={"event": "message.list"})
+                return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
+            filters[lookup] = int(value)
+
+        # before_seq alone pages back from the cursor, newest page first
+        self.newest_first = "seq__lt" in filters and "seq__gt" not in filters
+
+        if filters:
+            self.queryset = self.queryset.filter(**filters).order_by(
+                "-seq" if self.newest_first else "seq"
+            )
 
-        if room is None:
-            warning = f"Room '{room_id}' does not exist."
-            logging.warning(warning)
-            return Response({"warning": warning}, status=HTTP_400_BAD_REQUEST)
+        return self.list(request, *args, **kwargs)
 
-        if request.user not in room.members.all():
-            warning = f"Logged-in user '{request.user}' is not a memeber of this room."
-            logging.warning(warning)
-            return Response({"warning": warning}, status=HTTP_401_UNAUTHORIZED)
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
 
-        self.queryset = Message.objects.filter(room_id=room.id)
+        # each page still lists its messages in seq order
+        if page is not None and self.newest_first:
+            page.reverse()
 
-        return self.list(request, *args, **kwargs)
+        return page
 
 
-class RoomDetailView(APIView):
+class RoomDetailView(ReplicaReadMixin, APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request: Request, format=None) -> Response:
@@ -50,8 +98,10 @@ class RoomDetailView(APIView):
 
         if request.user.username not in usernames:
             usernames.append(request.user.username)
-            logging.info(
-                f"Automatically included '{request.user.username}' in usernames list."
+            logger.info(
+                "Automatically included '%s' in usernames list.",
+                request.user.username,
+                extra={"event": "room.detail"},
             )
 
         room = None
@@ -60,24 +110,73 @@ class RoomDetailView(APIView):
         if room_id:
             room = Room.objects.filter(id=room_id).first()
             if room:
-                logging.info(f"Found room with room_id='{room_id}' lookup.")
+                logger.info(
+                    "Found room with room_id='%s' lookup.",
+                    room_id,
+                    extra={"event": "room.detail"},
+                )
 
         # look up room by usernames
         if not room:
             room = Room.get_room_by_usernames(usernames)
             if room:
-                logging.info(f"Found room with usernames: {usernames}.")
+                logger.info(
+                    "Found room with usernames: %s.",
+                    usernames,
+                    extra={"event": "room.detail"},
+                )
 
         if not room:
-            logging.info(f"Could not find room via {room_id=}, {usernames=}.")
+            logger.info(
+                "Could not find room via room_id=%r, usernames=%r.",
+                room_id,
+                usernames,
+                extra={"event": "room.detail"},
+            )
             return Response(status=HTTP_404_NOT_FOUND)
 
+        prefetch_related_objects([room], "memberships__user")
+
         return Response(NestedRoomSerializer(room).data)
 
 
-class RoomListView(ListAPIView):
+class RoomExportView(ReplicaReadMixin, APIView):
+    """
+    Streams the whole room history as newline-delimited JSON, gzipped with
+    ?compress=gzip.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request: Request, room_id: int) -> StreamingHttpResponse:
+        error = check_room_access(request, room_id, "room.export")
+        if error:
+            return error
+
+        compress = request.query_params.get("compress") == "gzip"
+        filename = f"room-{room_id}.ndjson{'.gz' if compress else ''}"
+        response = StreamingHttpResponse(
+            aexport_room(
+                room_id, using=router.db_for_read(Message), compress=compress
+            ),
+            content_type="application/gzip" if compress else "application/x-ndjson",
+        )
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        logger.info(
+            "Exporting room '%s' for '%s'.",
+            room_id,
+            request.user,
+            extra={"event": "room.export"},
+        )
+
+        return response
+
+
+class RoomListView(ReplicaReadMixin, ListAPIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = NestedRoomSerializer
 
     def get_queryset(self):
-        return Room.objects.filter(members=self.request.user)
+        return Room.objects.filter(members=self.request.user).prefetch_related(
+            "memberships__user"
+        )
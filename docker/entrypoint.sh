@@ -1,23 +1,16 @@
 #!/bin/bash
 
-echo "Waiting for postgres.";
-while ! nc -z $DB_HOST $DB_PORT; do
-    sleep 1;
-done
-echo "Starting api.";
-
-echo "Applying database migrations.";
-python manage.py makemigrations;
-python manage.py migrate;
-
-echo "Loading fixtures.";
-python manage.py loaddata users.yaml;
+# Waits for postgres, then migrates, loads fixtures and collects static files
+# only when they changed; timings are served by /ready
+startup_args="--fixture users.yaml";
 
 # ENV variable is set and it not equal to "DEV"
 if [ -n "$ENV" ] && [ "$ENV" != "DEV" ]; then
-    echo "Collecting static files.";
-    python manage.py collectstatic --noinput;
+    startup_args="$startup_args --collectstatic";
 fi
 
+echo "Preparing the container.";
+python manage.py startup $startup_args || exit 1;
+
 # Execute the command passed to the Docker container
 exec "$@";